@@ -0,0 +1,97 @@
+"""
+Micro-benchmark of archive entries classification.
+
+Compares classify_archive_entry with the regex cascade it has replaced
+and checks that both classify a synthetic corpus the same way.
+
+    python3 -m benchmarks.bench_classifier [--size N]
+"""
+import argparse
+import random
+import re
+import timeit
+
+import flickr_archive_extractor as fae
+
+
+def legacy_classify(file_path):
+    """Regex cascade which was used in FlickrArchive.build"""
+    if file_path == 'albums.json':
+        return fae.ENTRY_ALBUMS, None, None, None
+
+    item_match_1 = re.match(r'(?P<name>.+)_(?P<id>[0-9]+)_o\.(?P<ext>[a-z0-9]+)', file_path)
+    item_match_2 = re.match(r'(?P<id>[0-9]+)_(?P<name>[0-9a-f]+)_o\.(?P<ext>[a-z0-9]+)', file_path)
+    item_match_video = re.match(r'(?P<name>.+)_(?P<id>[0-9]+)\.(?P<ext>avi|mov|mp4|m4v)', file_path)
+
+    item_match = item_match_1 or item_match_2 or item_match_video
+    if item_match and item_match.group('ext') != 'json':
+        return fae.ENTRY_ITEM, int(item_match.group('id')), item_match.group('name'), item_match.group('ext')
+
+    item_metadata_match = re.match(r'photo_(?P<id>[0-9]+).json', file_path)
+    if item_metadata_match:
+        return fae.ENTRY_METADATA, int(item_metadata_match.group('id')), None, None
+
+    if not fae.IGNORED_JSONS_RE.match(file_path):
+        return fae.ENTRY_UNKNOWN, None, None, None
+    return fae.ENTRY_IGNORED, None, None, None
+
+
+EDGE_CASES = [
+    'albums.json', 'photo_1.json', 'photo_12xjson', 'photo_12.jsonx', 'photo_.json', 'photo_123_o.json',
+    'name_123_o.json', '123_abc_o.json', '1_ab_o.json_2.mp4', 'a_1_o.jpg.bak', 'a_1.mp4.json', 'a_1.MOV',
+    '12_34_o.jpg', '34_12_o.png', 'x_0_o.gif', 'dir/a_1_o.jpg', 'video_15.m4v', 'video_15.mkv', '_1_o.jpg',
+    'groups.json', 'faves_part12.json', 'contacts_part.json', 'galleries.json', 'account_profile_x.json',
+    'readme.txt', '', '_', 'a__o.jpg', 'a_1_o.', 'a_1_o.JPG', 'a_١٢_o.jpg', 'name with spaces_77_o.jpeg',
+]
+
+
+def synthetic_corpus(size, seed=0):
+    rnd = random.Random(seed)
+    ignored = ['account_profile', 'account_testimonials', 'galleries', 'group_discussions', 'groups',
+               'faves_part{}', 'contacts_part{}', 'photos_comments_part{}', 'sent_flickrmail_part{}']
+    corpus = list(EDGE_CASES)
+    for _ in range(size):
+        item_id = rnd.randrange(10 ** 9, 10 ** 11)
+        kind = rnd.random()
+        if kind < 0.4:
+            corpus.append('photo_{}.json'.format(item_id))
+        elif kind < 0.65:
+            name = rnd.choice(['img', 'dsc', 'holiday-2015', 'my_photo', str(rnd.randrange(10 ** 6))])
+            corpus.append('{}_{}_o.{}'.format(name, item_id, rnd.choice(['jpg', 'png', 'gif', 'jpeg'])))
+        elif kind < 0.85:
+            corpus.append('{}_{:x}_o.{}'.format(item_id, rnd.randrange(16 ** 10), rnd.choice(['jpg', 'png'])))
+        elif kind < 0.95:
+            corpus.append('video_{}.{}'.format(item_id, rnd.choice(['avi', 'mov', 'mp4', 'm4v'])))
+        elif kind < 0.99:
+            corpus.append(rnd.choice(ignored).format(rnd.randrange(100)) + '.json')
+        else:
+            corpus.append(rnd.choice(EDGE_CASES))
+    return corpus
+
+
+def find_mismatches(corpus):
+    return [(path, legacy_classify(path), fae.classify_archive_entry(path)) for path in corpus
+            if legacy_classify(path) != fae.classify_archive_entry(path)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='archive entries classifier benchmark')
+    parser.add_argument('--size', type=int, default=200000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    corpus = synthetic_corpus(args.size)
+    mismatches = find_mismatches(corpus)
+    if mismatches:
+        for mismatch in mismatches[0:10]:
+            print('mismatch: {!r}: legacy={} new={}'.format(*mismatch))
+        raise SystemExit(1)
+    print('classification matches for {} entries'.format(len(corpus)))
+
+    for name, func in (('legacy', legacy_classify), ('new', fae.classify_archive_entry)):
+        best = min(timeit.repeat(lambda: [func(path) for path in corpus], number=1, repeat=args.repeat))
+        print('{:>8}: {:.3f} s, {:.0f} entries/s'.format(name, best, len(corpus) / best))
+
+
+if __name__ == '__main__':
+    main()
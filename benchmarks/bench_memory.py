@@ -0,0 +1,119 @@
+"""
+Memory benchmark of FlickrArchive index representations.
+
+Builds the same synthetic index as dicts of namedtuples (representation used before
+the columnar store) and as FlickrArchive with columnar stores, and reports memory
+retained by each of them after archive entries are released.
+
+    python3 -m benchmarks.bench_memory [--items N]
+"""
+import argparse
+import gc
+import random
+import time
+import tracemalloc
+
+import flickr_archive_extractor as fae
+
+
+class FakeZipFiles:
+
+    def __init__(self, albums_json):
+        self.albums_json = albums_json
+
+    def parse_json(self, file):
+        return self.albums_json
+
+    def __len__(self):
+        return 1
+
+
+def synthetic_index(items, archives=40, albums=2000, seed=0):
+    rnd = random.Random(seed)
+    indexes = [[] for _ in range(archives)]
+    albums_json = {'albums': [{'id': str(10 ** 17 + i), 'title': 'album {}'.format(i), 'url': 'https://a/{}'.format(i),
+                               'created': '1500000000', 'last_updated': '1500000000', 'photos': []}
+                              for i in range(albums)]}
+    for n in range(items):
+        item_id = 10 ** 10 + n * 7
+        entries = indexes[rnd.randrange(archives)]
+        if rnd.random() < 0.5:
+            path = 'img_{}_{}_o.jpg'.format(rnd.randrange(10 ** 4), item_id)
+            entries.append((fae.ENTRY_ITEM, path, item_id, path.rsplit('_', 2)[0], 'jpg'))
+        else:
+            entries.append((fae.ENTRY_ITEM, '{}_{:010x}_o.jpg'.format(item_id, n), item_id, '{:010x}'.format(n), 'jpg'))
+        if rnd.random() < 0.99:
+            entries.append((fae.ENTRY_METADATA, 'photo_{}.json'.format(item_id), item_id, {
+                'original': 'https://live.staticflickr.com/{}/{}_o.jpg'.format(rnd.randrange(10 ** 4), item_id),
+                'albums': [],
+                'photopage': 'https://www.flickr.com/photos/user/{}/'.format(item_id),
+                'date_taken': '20{:02d}-{:02d}-{:02d} 12:00:00'.format(rnd.randrange(25), rnd.randint(1, 12),
+                                                                       rnd.randint(1, 28)),
+            }))
+        if rnd.random() < 0.6:
+            albums_json['albums'][rnd.randrange(albums)]['photos'].append(str(item_id))
+    indexes[0].append((fae.ENTRY_ALBUMS, 'albums.json'))
+    return indexes, albums_json
+
+
+def build_legacy(items_count):
+    """Dicts of namedtuples as FlickrArchive kept them before the columnar store"""
+    indexes, albums_json = synthetic_index(items_count)
+    items = {}
+    items_metadata = {}
+    uid = 0
+    for archive_id, entries in enumerate(indexes):
+        for entry in entries:
+            file = fae.ArchiveFile(archive_id=archive_id, path=entry[1])
+            if entry[0] == fae.ENTRY_ITEM:
+                items.setdefault(entry[2], fae.Item(entry[2], uid, file=file, name=entry[3], type=entry[4]))
+                uid += 1
+            elif entry[0] == fae.ENTRY_METADATA:
+                items_metadata.setdefault(entry[2], fae.ItemMetadata(
+                    entry[2], metadata_file=file, original_name=entry[3]['original'], albums=entry[3]['albums'],
+                    page_url=entry[3]['photopage'], date_taken=entry[3]['date_taken']))
+    matched_keys = set(items).intersection(items_metadata)
+    matched = {key: fae.ItemWithMetadata(items[key], items_metadata[key]) for key in matched_keys}
+    without_metadata = {key: items[key] for key in set(items) - set(items_metadata)}
+    item_to_albums_index = {}
+    for album in albums_json['albums']:
+        for pid in album['photos']:
+            if int(pid) in matched:
+                item_to_albums_index.setdefault(int(pid), []).append(album['id'])
+    items_without_albums = [key for key in matched if key not in item_to_albums_index]
+    return items, items_metadata, matched, without_metadata, item_to_albums_index, items_without_albums
+
+
+def build_columnar(items_count):
+    indexes, albums_json = synthetic_index(items_count)
+    return fae.FlickrArchive._merge(FakeZipFiles(albums_json), indexes)
+
+
+def measure(name, func, *args):
+    gc.collect()
+    tracemalloc.start()
+    started = time.perf_counter()
+    result = func(*args)
+    elapsed = time.perf_counter() - started
+    gc.collect()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print('{:>9}: retained {:8.1f} MB, peak {:8.1f} MB, generated & built in {:.1f} s'.format(
+        name, current / 2 ** 20, peak / 2 ** 20, elapsed))
+    return result, current
+
+
+def main():
+    parser = argparse.ArgumentParser(description='index memory benchmark')
+    parser.add_argument('--items', type=int, default=1000000)
+    args = parser.parse_args()
+
+    print('synthetic index: {} items'.format(args.items))
+    legacy, legacy_size = measure('dicts', build_legacy, args.items)
+    del legacy
+    archive, columnar_size = measure('columnar', build_columnar, args.items)
+    print('columnar store uses {:.1f}x less memory'.format(legacy_size / columnar_size))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,173 @@
+"""
+Benchmark suite of indexing & upload on a synthetic Flickr export.
+
+Times FlickrArchive.build (with cold & warm index cache), _post_process, DB
+initialization and a full upload to the bundled mock Google Photos API, reports
+peak RSS and compares results with a stored baseline.
+
+    python3 -m benchmarks.bench_suite [--items N] [--save-baseline] [--baseline PATH]
+
+Baselines depend on the machine, so save one before changes & compare after them.
+Exits with code 1 if any phase is slower than baseline by more than --tolerance.
+"""
+import argparse
+import json
+import os.path
+import resource
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+import flickr_archive_extractor as fae
+from benchmarks import synthetic
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+# phases faster than this are too noisy to be compared
+MIN_COMPARED_SECONDS = 0.05
+
+
+def peak_rss_mb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes on linux
+    return rss / 2 ** 20 if sys.platform == 'darwin' else rss / 2 ** 10
+
+
+class Timings:
+
+    def __init__(self):
+        self.phases = {}
+
+    def measure(self, name, func, *args, repeat=1, **kwargs):
+        """Calls func `repeat` times and keeps the best time"""
+        best = None
+        for _ in range(repeat):
+            started = time.perf_counter()
+            result = func(*args, **kwargs)
+            elapsed = time.perf_counter() - started
+            best = elapsed if best is None else min(best, elapsed)
+        self.phases[name] = best
+        print('{:>16}: {:8.3f} s, peak RSS {:7.1f} MB'.format(name, self.phases[name], peak_rss_mb()))
+        return result
+
+
+def init_db(archive):
+    db = sqlite3.connect(':memory:')
+    fae.migrate_db(db)
+    fae.init_albums_to_upload_to_google_photos(archive.albums, db)
+    fae.init_items_to_upload_to_google_photos(archive.matched, archive.item_to_albums_index, db)
+    db.close()
+
+
+def build_with_index_cache(paths, index_cache_path, jobs, cold):
+    if cold and os.path.exists(index_cache_path):
+        os.remove(index_cache_path)
+    cache = fae.IndexCache.open(index_cache_path)
+    try:
+        return fae.FlickrArchive.build(paths, index_cache=cache, jobs=jobs)
+    finally:
+        cache.close()
+
+
+def upload(paths, work_dir, concurrency):
+    with fae.MockGooglePhotosServer() as server:
+        fae.upload_to_google_photos(paths, os.path.join(work_dir, 'db'), None, concurrency=concurrency,
+                                    limiter=fae.GoogleAPIRateLimiter(requests_per_second=10000.0),
+                                    api_url=server.url)
+    fae.http_pool.close()
+    return server.state.media_items, server.state.uploaded_bytes
+
+
+def run(args, work_dir):
+    timings = Timings()
+    export = timings.measure('generate', synthetic.generate_export, os.path.join(work_dir, 'export'),
+                             items=args.items, archives=args.archives, albums=args.albums)
+    print('export: {e.items} items, {e.metadata} metadata, {mb:.1f} MB in {n} archives'.format(
+        e=export, mb=export.content_bytes / 1e6, n=len(export.paths)))
+
+    index_cache_path = os.path.join(work_dir, 'index_cache')
+    repeat = args.repeat
+    timings.measure('build', fae.FlickrArchive.build, export.paths, jobs=args.jobs, repeat=repeat)
+    timings.measure('build_cold_cache', build_with_index_cache, export.paths, index_cache_path, args.jobs, cold=True,
+                    repeat=repeat)
+    archive = timings.measure('build_warm_cache', build_with_index_cache, export.paths, index_cache_path, args.jobs,
+                              cold=False, repeat=repeat)
+    timings.measure('post_process', fae.FlickrArchive, archive.zip_files, archive.albums_file,
+                    archive.items_metadata, archive.items, repeat=repeat)
+    timings.measure('db_init', init_db, archive, repeat=repeat)
+
+    upload_export = synthetic.generate_export(os.path.join(work_dir, 'upload'), items=args.upload_items,
+                                              archives=2, albums=max(args.upload_items // 100, 1), seed=1)
+    media_items, uploaded_bytes = timings.measure('upload', upload, upload_export.paths, work_dir, args.concurrency)
+    print('uploaded: {} items, {:.1f} MB ({:.1f} items/s, {:.1f} MB/s)'.format(
+        media_items, uploaded_bytes / 1e6, media_items / timings.phases['upload'],
+        uploaded_bytes / 1e6 / timings.phases['upload']))
+
+    return {
+        'config': {name: getattr(args, name) for name in ('items', 'archives', 'albums', 'jobs', 'upload_items',
+                                                          'concurrency')},
+        'phases': timings.phases,
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+
+def find_regressions(result, baseline, tolerance):
+    """Returns list of messages for phases & peak RSS which are worse than baseline * tolerance"""
+    regressions = []
+    for name, seconds in sorted(result['phases'].items()):
+        expected = baseline['phases'].get(name)
+        if name == 'generate' or expected is None or max(seconds, expected) < MIN_COMPARED_SECONDS:
+            continue
+        if seconds > expected * tolerance:
+            regressions.append('{}: {:.3f} s, baseline {:.3f} s ({:.2f}x)'.format(
+                name, seconds, expected, seconds / expected))
+    if result['peak_rss_mb'] > baseline['peak_rss_mb'] * tolerance:
+        regressions.append('peak RSS: {:.1f} MB, baseline {:.1f} MB'.format(result['peak_rss_mb'],
+                                                                            baseline['peak_rss_mb']))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='indexing & upload benchmark suite')
+    parser.add_argument('--items', type=int, default=20000)
+    parser.add_argument('--archives', type=int, default=8)
+    parser.add_argument('--albums', type=int, default=200)
+    parser.add_argument('--jobs', type=int, default=1)
+    parser.add_argument('--upload-items', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--repeat', type=int, default=3, help='runs of every indexing phase, the best is kept')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--save-baseline', action='store_true', help='save results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=1.5, help='allowed slowdown ratio. default: 1.5')
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='fae-bench-')
+    try:
+        result = run(args, work_dir)
+    finally:
+        shutil.rmtree(work_dir)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as fp:
+            json.dump(result, fp, indent=2, sort_keys=True)
+        print('baseline saved to {}'.format(args.baseline))
+        return 0
+    if not os.path.exists(args.baseline):
+        print('baseline {} not found, run with --save-baseline first'.format(args.baseline))
+        return 0
+    with open(args.baseline) as fp:
+        baseline = json.load(fp)
+    if baseline['config'] != result['config']:
+        print('baseline was saved with different config {}, not compared'.format(baseline['config']))
+        return 0
+    regressions = find_regressions(result, baseline, args.tolerance)
+    for regression in regressions:
+        print('REGRESSION {}'.format(regression))
+    if not regressions:
+        print('no regressions compared with baseline')
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
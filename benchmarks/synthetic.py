@@ -0,0 +1,165 @@
+"""
+Generator of synthetic Flickr exports.
+
+Writes N zip archives with originals in all filename styles used by Flickr
+(`<name>_<id>_o.<ext>`, `<id>_<secret>_o.<ext>`, `<name>_<id>.<video ext>`),
+`photo_<id>.json` metadata, metadata of unprocessed videos, `albums.json`
+and account JSON files which are ignored by the indexer.
+
+    python3 -m benchmarks.synthetic OUT_DIR [--items N] [--archives N] [--albums N]
+"""
+import argparse
+import collections
+import json
+import os
+import random
+import zipfile
+
+IGNORED_JSONS = ['account_profile.json', 'account_testimonials.json', 'contacts_part1.json', 'faves_part1.json',
+                 'followers_part1.json', 'galleries.json', 'groups.json', 'group_discussions.json',
+                 'photos_comments_part1.json', 'received_flickrmail_part1.json', 'sets_comments_part1.json']
+PHOTO_EXTS = ['jpg', 'jpg', 'jpg', 'png', 'gif']
+VIDEO_EXTS = ['mp4', 'mov', 'avi', 'm4v']
+NAMES = ['img', 'dsc', 'holiday-photo', 'family', 'sunset', 'p1010', 'scan']
+
+SyntheticExport = collections.namedtuple('SyntheticExport', ['paths', 'items', 'metadata', 'matched', 'albums',
+                                                             'without_metadata', 'without_items',
+                                                             'unprocessed_videos', 'alternative_ids',
+                                                             'content_bytes'])
+
+
+def metadata_json(rnd, item_id, original, album_refs):
+    return {
+        'id': str(item_id),
+        'name': '{}_{}'.format(rnd.choice(NAMES), rnd.randrange(10000)),
+        'description': 'description of {}'.format(item_id) if rnd.random() < 0.3 else '',
+        'count_views': str(rnd.randrange(1000)),
+        'count_faves': str(rnd.randrange(20)),
+        'count_comments': '0',
+        'date_taken': '2015-0{}-1{} 12:00:00'.format(rnd.randrange(1, 10), rnd.randrange(10)),
+        'count_tags': '2',
+        'count_notes': '0',
+        'rotation': 0,
+        'date_imported': '2016-01-01 00:00:00',
+        'photopage': 'https://www.flickr.com/photos/user/{}/'.format(item_id),
+        'original': original,
+        'license': 'All Rights Reserved',
+        'geo': [],
+        'groups': [],
+        'albums': album_refs,
+        'tags': [{'tag': 'tag{}'.format(rnd.randrange(50)), 'user': 'user'} for _ in range(2)],
+        'people': [],
+        'notes': [],
+        'privacy': 'private',
+        'comment_permissions': 'friends and family',
+        'tagging_permissions': 'you',
+        'safety': 'safe',
+        'comments': [],
+    }
+
+
+def generate_export(out_dir, items=1000, archives=4, albums=20, seed=0, min_size=1024, max_size=16 * 1024,
+                    videos=0.05, without_metadata=0.01, without_items=0.01, unprocessed_videos=0.005,
+                    in_albums=0.6):
+    """
+    Writes data_<n>.zip archives to out_dir & returns SyntheticExport with expected index counts.
+    `items` is the number of ids, ratios define which of them are videos, lack metadata or an original file.
+    """
+    rnd = random.Random(seed)
+    os.makedirs(out_dir, exist_ok=True)
+    paths = [os.path.join(out_dir, 'data_{}.zip'.format(n)) for n in range(archives)]
+    zips = [zipfile.ZipFile(path, 'w') for path in paths]
+    album_ids = [str(72157600000000000 + n) for n in range(albums)]
+    album_photos = collections.defaultdict(list)
+    counts = collections.Counter()
+    try:
+        for n in range(items):
+            item_id = 1000000000 + n * 13
+            zf = zips[n % archives]
+            item_albums = rnd.sample(album_ids, min(albums, rnd.choice([1, 1, 2]))) \
+                if albums and rnd.random() < in_albums else []
+            for album_id in item_albums:
+                album_photos[album_id].append(str(item_id))
+
+            kind = rnd.random()
+            if kind < unprocessed_videos:
+                original = 'https://live.staticflickr.com/video/{}/video_encoding.jpg'.format(item_id)
+                zf.writestr('photo_{}.json'.format(item_id), json.dumps(metadata_json(rnd, item_id, original, [])),
+                            compress_type=zipfile.ZIP_DEFLATED)
+                counts['metadata'] += 1
+                counts['unprocessed_videos'] += 1
+                continue
+
+            alternative = False
+            if kind < unprocessed_videos + videos:
+                ext = rnd.choice(VIDEO_EXTS)
+                path = '{}_{}.{}'.format(rnd.choice(NAMES), item_id, ext)
+            elif rnd.random() < 0.5:
+                ext = rnd.choice(PHOTO_EXTS)
+                path = '{}_{}_{}_o.{}'.format(rnd.choice(NAMES), rnd.randrange(10000), item_id, ext)
+            else:
+                ext = rnd.choice(PHOTO_EXTS)
+                secret = '{:010x}'.format(rnd.getrandbits(40))
+                path = '{}_{}_o.{}'.format(item_id, secret, ext)
+                # indexer adds an alternative item with swapped id & name for digits only secrets
+                alternative = secret.isdigit()
+
+            has_item = rnd.random() >= without_items
+            has_metadata = rnd.random() >= without_metadata
+            if has_item:
+                size = rnd.randint(min_size, max_size)
+                zf.writestr(path, rnd.getrandbits(size * 8).to_bytes(size, 'little'), compress_type=zipfile.ZIP_STORED)
+                counts['items'] += 1
+                counts['alternative_ids'] += alternative
+                counts['content_bytes'] += size
+            if has_metadata:
+                original = 'https://live.staticflickr.com/{}/{}_o.{}'.format(rnd.randrange(10000), item_id, ext)
+                album_refs = [{'id': album_id, 'title': 'album {}'.format(album_id), 'url': ''}
+                              for album_id in item_albums]
+                zf.writestr('photo_{}.json'.format(item_id),
+                            json.dumps(metadata_json(rnd, item_id, original, album_refs)),
+                            compress_type=zipfile.ZIP_DEFLATED)
+                counts['metadata'] += 1
+            if has_item and has_metadata:
+                counts['matched'] += 1
+            elif has_item:
+                counts['without_metadata'] += 1
+            elif has_metadata:
+                counts['without_items'] += 1
+
+        albums_json = {'albums': [{
+            'id': album_id,
+            'title': 'album {}'.format(n),
+            'description': '',
+            'view_count': '0',
+            'created': str(1400000000 + n * 3600),
+            'last_updated': str(1500000000 + n * 3600),
+            'cover_photo': '',
+            'url': 'https://www.flickr.com/photos/user/albums/{}'.format(album_id),
+            'photos': album_photos[album_id],
+        } for n, album_id in enumerate(album_ids)]}
+        zips[0].writestr('albums.json', json.dumps(albums_json), compress_type=zipfile.ZIP_DEFLATED)
+        for name in IGNORED_JSONS:
+            zips[0].writestr(name, json.dumps({'data': []}), compress_type=zipfile.ZIP_DEFLATED)
+    finally:
+        for zf in zips:
+            zf.close()
+
+    return SyntheticExport(paths=paths, albums=albums, **{field: counts[field] for field in (
+        'items', 'metadata', 'matched', 'without_metadata', 'without_items', 'unprocessed_videos', 'alternative_ids',
+        'content_bytes')})
+
+
+def main():
+    parser = argparse.ArgumentParser(description='synthetic flickr export generator')
+    parser.add_argument('out_dir')
+    parser.add_argument('--items', type=int, default=1000)
+    parser.add_argument('--archives', type=int, default=4)
+    parser.add_argument('--albums', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    print(generate_export(args.out_dir, args.items, args.archives, args.albums, args.seed))
+
+
+if __name__ == '__main__':
+    main()
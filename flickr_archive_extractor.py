@@ -13,10 +13,25 @@ import random
 import datetime
 import pickle
 import urllib.request
-import urllib.error
+import urllib.parse
 import http
+import http.client
+import http.server
+import socketserver
+import select
 import time
-import socket
+import zlib
+import hashlib
+import concurrent.futures
+import threading
+import array
+import bisect
+import operator
+import itertools
+import collections.abc
+import contextlib
+import mmap
+import struct
 
 __version__ = '0.1.1'
 
@@ -42,32 +57,474 @@ def check_path(path):
     return path
 
 
+def check_date(value):
+    datetime.datetime.strptime(value, '%Y-%m-%d')
+    return value
+
+
+DEFAULT_CONFIG_DIR = os.path.expanduser('~/.config/flickr_archive_extractor')
+
+
+def add_archive_args(parser):
+    parser.add_argument('--archive', help='path to archives. globs may be used', action='append',
+                        type=convert_archive_param, required=True)
+    parser.add_argument('--index-cache', type=str, default=None,
+                        help='path to file with archives index cache. will be created if missing. '
+                             'default: index_cache in the config dir or next to the --db')
+    parser.add_argument('--no-index-cache', action='store_true', help="don't use archives index cache")
+    parser.add_argument('--jobs', type=int, default=1, metavar='N',
+                        help='number of worker processes used for indexing and extracting archives')
+
+
+DEDUP_HELP = 'find items with the same content by size & CRC32, sha256 is calculated only on collisions'
+
+
 def parse_args():
     parser = argparse.ArgumentParser(description='flickr archive extractor v{}'.format(__version__))
     parser.add_argument('-v', '--verbose', action='store_true')
+    parser.add_argument('--metrics-file', type=str, default=None, metavar='metrics.json',
+                        help='write timings, throughput & latency metrics to json file on exit')
+    parser.add_argument('--profile', choices=('cpu', 'mem'), default=None,
+                        help='profile with cProfile (cpu) or tracemalloc (mem). '
+                             'cpu profile includes worker threads & processes, mem - only threads')
+    parser.add_argument('--profile-scope', choices=PROFILE_SCOPES, default='command',
+                        help='what to profile: the whole command, FlickrArchive.build, _post_process or upload loop')
+    parser.add_argument('--profile-output', type=str, default=None, metavar='PATH',
+                        help='pstats file for cpu or text report for mem profile. '
+                             'default: profile.pstats / profile-mem.txt')
+    parser.add_argument('--profile-top', type=int, default=30, metavar='N',
+                        help='number of top functions or allocations logged. default: 30')
+    parser.add_argument('--metrics-interval', type=float, default=60.0, metavar='SECONDS',
+                        help='log metrics every SECONDS, 0 disables periodic logging. default: 60')
 
     subparsers = parser.add_subparsers(help='command --help', dest='command')
 
     check = subparsers.add_parser('check', help='check archives')
-    check.add_argument('--archive', help='path to archives. globs may be used', action='append',
-                       type=convert_archive_param, required=True)
+    add_archive_args(check)
     check.add_argument('--samples-size', default=10, type=int,
                        help='Size of displayed detailed samples for different kinds of data')
+    check.add_argument('--dedup', action='store_true', help=DEDUP_HELP)
+    check.add_argument('--report', type=str, default=None, metavar='out.jsonl',
+                       help='write all findings to JSON Lines file, the last line is a summary')
+    check.add_argument('--report-summary-only', action='store_true',
+                       help='write only the summary line to --report file')
+    check.add_argument('--incremental', action='store_true',
+                       help='check only archives added since the previous check & show what has changed')
+    check.add_argument('--verify-content', action='store_true',
+                       help='decompress all archives members checking CRC. '
+                            "results are stored in index cache & archives which haven't changed are skipped")
 
     upload = subparsers.add_parser('upload-to-google-photo', help='upload photos to google photos')
-    upload.add_argument('--archive', help='path to archives. globs may be used', action='append',
-                        type=convert_archive_param, required=True)
+    add_archive_args(upload)
     upload.add_argument('--app-credentials', type=check_path, metavar='client_id.json',
                         help='path to app credentials in json format')
-    upload.add_argument('--db', type=str, default=os.path.expanduser('~/.config/flickr_archive_extractor/db'),
+    upload.add_argument('--db', type=str, default=os.path.join(DEFAULT_CONFIG_DIR, 'db'),
                         help='path to file with database. will be created if missing.')
+    upload.add_argument('--concurrency', type=int, default=4, metavar='N',
+                        help='number of items uploaded simultaneously')
+    upload.add_argument('--requests-per-second', type=float, default=5.0, metavar='RPS',
+                        help='max rate of Google API requests. upload chunks are not limited')
+    upload.add_argument('--daily-quota', type=int, default=None, metavar='N',
+                        help='max number of Google API requests per 24h. not limited by default')
+    upload.add_argument('--exit-on-quota', action='store_true',
+                        help='exit when daily quota is spent instead of waiting for the next 24h')
+    upload.add_argument('--dedup', action='store_true',
+                        help=DEDUP_HELP + '. content is uploaded once & added to other albums')
+    upload.add_argument('--order', choices=UPLOAD_ORDERS, default='album',
+                        help='upload order: albums in creation order, the smallest files first, '
+                             'items taken within --date-from & --date-to first or items & albums from '
+                             '--priority-file first. default: %(default)s')
+    upload.add_argument('--date-from', type=check_date, default=None, metavar='YYYY-MM-DD',
+                        help='start of date range for --order date')
+    upload.add_argument('--date-to', type=check_date, default=None, metavar='YYYY-MM-DD',
+                        help='end of date range for --order date, inclusive')
+    upload.add_argument('--priority-file', type=check_path, default=None, metavar='priority.txt',
+                        help='priority list for --order priority: item id or album:<album id or title> per line')
+    upload.add_argument('--no-interleave', action='store_true',
+                        help="don't interleave small & large files. they are interleaved in every "
+                             '{} * --concurrency scheduled items of the same album by default'
+                             .format(UPLOAD_INTERLEAVE_WINDOW))
+    upload.add_argument('--prefetch-chunks', type=int, default=UPLOAD_PREFETCH_CHUNKS, metavar='K',
+                        help='number of chunks read from archive ahead of the chunk being sent, '
+                             '0 disables read-ahead. default: %(default)s')
+    upload.add_argument('--upload-buffers', type=float, default=UPLOAD_BUFFERS_BUDGET / 2 ** 20, metavar='MB',
+                        help='memory budget of chunk buffers shared by all uploads. default: %(default)g MB')
+    upload.add_argument('--api-url', type=str, default=GOOGLE_PHOTOS_API_URL, metavar='URL',
+                        help='Google Photos API base url, for ex. url of mock-google-photos. '
+                             '--app-credentials are optional for non-default url. default: %(default)s')
+
+    extract = subparsers.add_parser('extract', help='extract library to album/<title>/ and unsorted/ dirs')
+    add_archive_args(extract)
+    extract.add_argument('--output', type=str, required=True, help='output dir. will be created if missing')
+
+    status = subparsers.add_parser('status', help='show upload progress. may be used while upload is running')
+    status.add_argument('--db', type=str, default=os.path.join(DEFAULT_CONFIG_DIR, 'db'),
+                        help='path to file with database')
+
+    mock = subparsers.add_parser('mock-google-photos',
+                                 help='run local Google Photos API stand-in with fault injection for upload testing')
+    mock.add_argument('--host', type=str, default='127.0.0.1')
+    mock.add_argument('--port', type=int, default=8080)
+    mock.add_argument('--latency', type=float, default=0.0, metavar='SECONDS',
+                      help='mean delay of every request, jittered by ±50%%. default: 0')
+    mock.add_argument('--rate-limited', type=float, default=0.0, metavar='P',
+                      help='probability of 429 Too Many Requests reply. default: 0')
+    mock.add_argument('--server-errors', type=float, default=0.0, metavar='P',
+                      help='probability of 500, 502 or 503 reply. default: 0')
+    mock.add_argument('--dropped', type=float, default=0.0, metavar='P',
+                      help='probability of closing connection without reply, upload chunk is received partially. '
+                           'default: 0')
+    mock.add_argument('--granularity', type=int, action='append', metavar='BYTES',
+                      help='chunk granularity of upload sessions. if used several times, '
+                           'every session gets randomly chosen one. default: {}'.format(MOCK_CHUNK_GRANULARITY))
+    mock.add_argument('--retry-after', type=float, default=1.0, metavar='SECONDS',
+                      help='Retry-After of 429 replies. default: 1')
+    mock.add_argument('--seed', type=int, default=None, help='random seed of injected faults')
 
     args = parser.parse_args()
     if args.command is None:
         parser.error('command is required')
+    if getattr(args, 'incremental', False) and args.dedup:
+        parser.error("--dedup can't be used with --incremental")
+    if getattr(args, 'incremental', False) and args.report:
+        parser.error("--report can't be used with --incremental")
+    if getattr(args, 'concurrency', 1) < 1:
+        parser.error('--concurrency should be positive')
+    if getattr(args, 'requests_per_second', 1.0) <= 0:
+        parser.error('--requests-per-second should be positive')
+    if getattr(args, 'order', None) == 'date' and args.date_from is None and args.date_to is None:
+        parser.error('--order date requires --date-from or --date-to')
+    if getattr(args, 'order', None) == 'priority' and args.priority_file is None:
+        parser.error('--order priority requires --priority-file')
+    if getattr(args, 'prefetch_chunks', 0) < 0:
+        parser.error("--prefetch-chunks can't be negative")
+    if getattr(args, 'upload_buffers', 1.0) <= 0:
+        parser.error('--upload-buffers should be positive')
+    if args.command == 'mock-google-photos':
+        probabilities = (args.rate_limited, args.server_errors, args.dropped)
+        if min(probabilities) < 0 or sum(probabilities) > 1:
+            parser.error('--rate-limited, --server-errors & --dropped should be probabilities with sum <= 1')
+        if args.granularity and min(args.granularity) < 1:
+            parser.error('--granularity should be positive')
+    if getattr(args, 'archive', None) is not None:
+        if args.jobs < 1:
+            parser.error('--jobs should be positive')
+        if args.no_index_cache:
+            args.index_cache = None
+        elif args.index_cache is None:
+            config_dir = os.path.dirname(args.db) if args.command == 'upload-to-google-photo' else DEFAULT_CONFIG_DIR
+            args.index_cache = os.path.join(config_dir, 'index_cache')
     return args
 
 
+# metrics
+
+LATENCY_RESERVOIR_SIZE = 2048
+
+
+class LatencyReservoir:
+    """
+    Uniform random sample of at most `size` latencies (reservoir sampling), so memory & percentiles cost
+    don't grow with the number of observed values. Count & max are exact.
+    """
+
+    def __init__(self, size=LATENCY_RESERVOIR_SIZE, seed=None):
+        self.size = size
+        self.count = 0
+        self.max = None
+        self.samples = array.array('d')
+        self._random = random.Random(seed)
+
+    def add(self, value):
+        self.count += 1
+        if self.max is None or value > self.max:
+            self.max = value
+        if len(self.samples) < self.size:
+            self.samples.append(value)
+        else:
+            position = self._random.randrange(self.count)
+            if position < self.size:
+                self.samples[position] = value
+
+
+class Metrics:
+    """
+    Thread-safe phase timers, counters & latency samples. Module wide instance `metrics` is used
+    by indexing & upload, worker processes return their phases to be merged into it.
+    """
+
+    def __init__(self, clock=time.monotonic):
+        self._clock = clock
+        self._lock = threading.Lock()
+        self.started = clock()
+        self.phases = {}
+        self.counters = collections.Counter()
+        self.latencies = {}
+
+    def add_phase(self, name, seconds, count=1):
+        with self._lock:
+            phase = self.phases.setdefault(name, [0, 0.0])
+            phase[0] += count
+            phase[1] += seconds
+
+    def phase(self, name):
+        """Context manager which adds elapsed time to the phase"""
+        return _MetricsPhase(self, name)
+
+    def add(self, name, value=1):
+        with self._lock:
+            self.counters[name] += value
+
+    def observe(self, name, value):
+        with self._lock:
+            reservoir = self.latencies.get(name)
+            if reservoir is None:
+                reservoir = self.latencies[name] = LatencyReservoir()
+            reservoir.add(value)
+
+    def merge_phases(self, phases):
+        for name, (count, seconds) in phases.items():
+            self.add_phase(name, seconds, count)
+
+    def snapshot(self):
+        with self._lock:
+            elapsed = max(self._clock() - self.started, 1e-6)
+            phases = sorted(self.phases.items())
+            counters = sorted(self.counters.items())
+            reservoirs = [(name, r.count, r.max, array.array('d', r.samples)) for name, r in self.latencies.items()]
+        latencies = {}
+        for name, count, max_value, samples in reservoirs:
+            ordered = sorted(samples)
+            latencies[name] = dict(count=count, max=max_value,
+                                   **{'p{}'.format(p): percentile(ordered, p) for p in (50, 95, 99)})
+        return {
+            'elapsed': elapsed,
+            'phases': {name: {'count': count, 'seconds': seconds} for name, (count, seconds) in phases},
+            'counters': dict(counters),
+            'rates': {name + '_per_second': value / elapsed for name, value in counters},
+            'latencies': latencies,
+        }
+
+    def format(self, snapshot=None):
+        snapshot = snapshot or self.snapshot()
+        parts = ['{} {:.1f} s'.format(name, phase['seconds']) for name, phase in snapshot['phases'].items()]
+        for name, value in snapshot['counters'].items():
+            rate = snapshot['rates'][name + '_per_second']
+            if name.endswith('bytes'):
+                parts.append('{} {:.1f} MB ({:.2f} MB/s)'.format(name, value / 1e6, rate / 1e6))
+            else:
+                parts.append('{} {} ({:.2f}/s)'.format(name, value, rate))
+        for name, latency in snapshot['latencies'].items():
+            parts.append('{} p50 {:.3f} s, p95 {:.3f} s, p99 {:.3f} s'.format(
+                name, latency['p50'], latency['p95'], latency['p99']))
+        return ', '.join(parts) or 'nothing measured yet'
+
+    def log(self):
+        logger.info('📈 Metrics after %.0f s: %s', self._clock() - self.started, self.format())
+
+    def write(self, path):
+        with open(path, 'w') as fp:
+            json.dump(self.snapshot(), fp, indent=2, sort_keys=True)
+
+
+class _MetricsPhase:
+
+    def __init__(self, owner, name):
+        self._owner = owner
+        self._name = name
+        self._started = None
+
+    def __enter__(self):
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._owner.add_phase(self._name, time.perf_counter() - self._started)
+
+
+def percentile(ordered, p):
+    """Nearest-rank percentile of sorted samples"""
+    if not ordered:
+        return None
+    rank = max(int(-(-p * len(ordered) // 100)), 1)
+    return ordered[rank - 1]
+
+
+class MetricsReporter(threading.Thread):
+    """Logs metrics every `interval` seconds until stopped"""
+
+    def __init__(self, metrics, interval):
+        super(MetricsReporter, self).__init__(name='metrics-reporter', daemon=True)
+        self._metrics = metrics
+        self._interval = interval
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self._interval):
+            self._metrics.log()
+
+    def stop(self):
+        self._stopped.set()
+
+
+metrics = Metrics()
+
+
+# profiling
+
+PROFILE_SCOPES = ('command', 'build', 'post-process', 'upload')
+
+
+class Profiling:
+    """
+    Optional cProfile (`cpu`) or tracemalloc (`mem`) profiling of one scope. Code marks scopes with
+    `with profiling('scope'):`, only the configured one is profiled, other scopes cost nothing.
+    Repeated entries of the scope are accumulated. cProfile measures the thread which enters the scope,
+    so calls in worker threads & processes have to be started with `profiling.thread_target()` & `profiling.map()`
+    to be profiled too, their stats are merged into the scope profile. tracemalloc traces all threads
+    of the main process, allocations of worker processes aren't traced.
+    """
+
+    def __init__(self):
+        self.mode = None
+        self.scope = 'command'
+        self.output = None
+        self.top = 30
+        self._profile = None
+        self._baseline = None
+        self._snapshot = None
+        self._depth = 0
+        self._lock = threading.Lock()
+        self._workers_stats = []
+
+    def configure(self, mode, scope='command', output=None, top=30):
+        self.mode = mode
+        self.scope = scope
+        self.output = output or ('profile.pstats' if mode == 'cpu' else 'profile-mem.txt')
+        self.top = top
+
+    @contextlib.contextmanager
+    def __call__(self, scope):
+        if self.mode is None or scope != self.scope:
+            yield
+            return
+        self._depth += 1
+        if self._depth == 1:
+            self._start()
+        try:
+            yield
+        finally:
+            self._depth -= 1
+            if self._depth == 0:
+                self._stop()
+
+    def map(self, executor, func, *iterables):
+        """`executor.map(func, *iterables)` profiling calls in worker processes while cpu profiled scope is active"""
+        if not self._cpu_profiled():
+            return executor.map(func, *iterables)
+        return self._collect_workers_stats(executor.map(_ProfiledCall(func), *iterables))
+
+    def thread_target(self, func):
+        """Returns `func` which is profiled in the thread it runs in, if cpu profiled scope is active"""
+        if not self._cpu_profiled():
+            return func
+
+        def profiled(*args, **kwargs):
+            return next(self._collect_workers_stats([_ProfiledCall(func)(*args, **kwargs)]))
+
+        return profiled
+
+    def _cpu_profiled(self):
+        return self.mode == 'cpu' and self._depth > 0
+
+    def _collect_workers_stats(self, results):
+        for result, stats in results:
+            with self._lock:
+                self._workers_stats.append(stats)
+            yield result
+
+    def _start(self):
+        if self.mode == 'cpu':
+            import cProfile
+            if self._profile is None:
+                self._profile = cProfile.Profile()
+            self._profile.enable()
+        else:
+            import tracemalloc
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            if self._baseline is None:
+                self._baseline = tracemalloc.take_snapshot()
+
+    def _stop(self):
+        if self.mode == 'cpu':
+            self._profile.disable()
+        else:
+            import tracemalloc
+            self._snapshot = tracemalloc.take_snapshot()
+
+    def finish(self):
+        """Writes pstats file or allocations report & logs top entries"""
+        if self.mode == 'cpu' and self._profile is not None:
+            import pstats
+            import io
+            report = io.StringIO()
+            stats = pstats.Stats(self._profile, stream=report)
+            with self._lock:
+                for workers_stats in self._workers_stats:
+                    stats.add(_ProfileStats(workers_stats))
+                if self._workers_stats:
+                    logger.debug('Profile stats of %d worker calls are merged', len(self._workers_stats))
+            stats.dump_stats(self.output)
+            stats.sort_stats('cumulative').print_stats(self.top)
+            logger.info('CPU profile of "%s" has been written to %s\n%s', self.scope, self.output, report.getvalue())
+        elif self.mode == 'mem' and self._snapshot is not None:
+            import tracemalloc
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            lines = ['Memory profile of "{}": traced {:.1f} MB, peak {:.1f} MB'.format(
+                self.scope, current / 1e6, peak / 1e6), 'Top {} allocations growth by line:'.format(self.top)]
+            lines.extend(str(stat) for stat in self._snapshot.compare_to(self._baseline, 'lineno')[:self.top])
+            with open(self.output, 'w') as fp:
+                fp.write('\n'.join(lines) + '\n')
+            logger.info('%s has been written to %s\n%s', lines[0], self.output, '\n'.join(lines[1:]))
+
+
+class _ProfiledCall:
+    """Picklable wrapper which profiles a call in worker & returns (result, profile stats)"""
+
+    def __init__(self, func):
+        self.func = func
+
+    def __call__(self, *args, **kwargs):
+        import cProfile
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # since python 3.12 one profiler measures all threads & the scope profiler is already enabled
+            return self.func(*args, **kwargs), {}
+        try:
+            result = self.func(*args, **kwargs)
+        finally:
+            profile.disable()
+        profile.create_stats()
+        return result, profile.stats
+
+
+class _ProfileStats:
+    """Raw stats of worker profile in the form accepted by pstats.Stats"""
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
+profiling = Profiling()
+
+
 # parse archives
 
 def list_archives(archive_globs):
@@ -110,11 +567,13 @@ def log_sample(sample, orig_size, format_func, what='items'):
 
 class FlickrArchive:
 
-    def __init__(self, zip_files, albums_file, items_metadata, items):
+    def __init__(self, zip_files, albums_file, items_metadata, items, duplicate_items=None):
         self.zip_files = zip_files
         self.albums_file = albums_file
         self.items_metadata = items_metadata
         self.items = items
+        # (id, 'item' | 'metadata' | 'album', first file, duplicate file)
+        self.duplicate_items = list(duplicate_items or [])
         self.without_metadata = None
         self.without_items = None
         self.unprocessed_videos_metadata = None
@@ -124,7 +583,8 @@ class FlickrArchive:
         self.wrong_items_in_albums = []
         self.item_to_albums_index = {}
         self.items_without_albums = []
-        self._post_process()
+        with metrics.phase('index.post_process'), profiling('post-process'):
+            self._post_process()
 
     def __str__(self):
         return ('FlickrArchive<zip_files: {z}, items metadata: {pi}, items: {i}, albums: {al}>'
@@ -132,36 +592,54 @@ class FlickrArchive:
                         al='found' if self.albums_file else 'not found'))
 
     def _post_process(self):
-        items_keys = set(self.items.keys())
-        metadata_keys = set(self.items_metadata.keys())
-
-        matched_keys = items_keys.intersection(metadata_keys)
-
-        matched_uid = {self.items[key].uid for key in matched_keys}
-
-        self.unprocessed_videos_metadata = {key: meta for key, meta in self.items_metadata.items()
-                                            if meta.is_unprocessed_video}
-        unprocessed_videos_metadata_keys = set(self.unprocessed_videos_metadata.keys())
+        items_ids = self.items.ids
+        metadata_ids = self.items_metadata.ids
+        only_items, matched_items, matched_metadata, only_metadata = merge_sorted_ids(items_ids, metadata_ids)
+
+        # item & its alternative item with swapped name and id share uid
+        uids = self.items.uids
+        matched_uid = bytearray(max(uids) + 1 if uids else 0)
+        for index in matched_items:
+            matched_uid[uids[index]] = 1
+
+        original_names = self.items_metadata.original_names
+        unprocessed_videos = bytearray(len(metadata_ids))
+        for index in range(len(metadata_ids)):
+            if is_unprocessed_video_original(original_names[index]):
+                unprocessed_videos[index] = 1
+        self.unprocessed_videos_metadata = IdsView(
+            array.array('q', (metadata_ids[i] for i in range(len(metadata_ids)) if unprocessed_videos[i])),
+            self.items_metadata.__getitem__
+        )
 
-        without_metadata_unfiltered = items_keys - metadata_keys
-        self.without_metadata = {key: self.items[key] for key in without_metadata_unfiltered
-                                 if self.items[key].uid not in matched_uid}
+        self.without_metadata = IdsView(
+            array.array('q', (items_ids[i] for i in only_items if not matched_uid[uids[i]])),
+            self.items.__getitem__
+        )
 
-        self.without_items = {key: self.items_metadata[key] for key in
-                              (metadata_keys - items_keys - unprocessed_videos_metadata_keys)}
+        self.without_items = IdsView(
+            array.array('q', (metadata_ids[i] for i in only_metadata if not unprocessed_videos[i])),
+            self.items_metadata.__getitem__
+        )
 
-        self.matched = {key: ItemWithMetadata(self.items[key], self.items_metadata[key])
-                        for key in matched_keys}
+        self.matched = IdsView(
+            array.array('q', (items_ids[i] for i in matched_items)),
+            lambda key: ItemWithMetadata(self.items[key], self.items_metadata[key])
+        )
 
+        album_pairs = []
+        album_ids = []
         if self.albums_file:
             albums_json = self.zip_files.parse_json(self.albums_file)
             for album_json in (albums_json.get('albums') or []):
                 items = []
                 album_id = album_json['id']
+                album_index = len(album_ids)
+                album_ids.append(album_id)
                 for pid in (album_json.get('photos') or []):
                     if pid == '0':  # wrong photos ids
                         continue
-                    if not re.match(r'^\d+$', pid):
+                    if not DIGITS_RE.match(pid):
                         self.wrong_items_in_albums.append((album_id, pid))
                     else:
                         pid_int = int(pid)
@@ -170,9 +648,7 @@ class FlickrArchive:
                         elif pid_int not in self.matched:
                             self.missed_items_in_albums.append((album_id, pid_int))
                         else:
-                            if pid_int not in self.item_to_albums_index:
-                                self.item_to_albums_index[pid_int] = []
-                            self.item_to_albums_index[pid_int].append(album_id)
+                            album_pairs.append((pid_int, album_index))
                             items.append(pid_int)
                 album = Album(
                     id=album_id,
@@ -185,85 +661,257 @@ class FlickrArchive:
                 )
                 if album_id in self.albums:
                     logger.warning('Duplicate album with id %s. %s, %s', album_id, self.albums[album_id], album)
+                    self.duplicate_items.append((album_id, 'album', self.albums_file, self.albums_file))
                 else:
                     self.albums[album_id] = album
+        self.item_to_albums_index = AlbumsIndex(album_pairs, album_ids)
+
+        matched_ids = self.matched.ids
+        without_albums, _, _, _ = merge_sorted_ids(matched_ids, self.item_to_albums_index.ids)
+        self.items_without_albums = array.array('q', (matched_ids[i] for i in without_albums))
 
-        self.items_without_albums = [key for key in self.matched.keys() if key not in self.item_to_albums_index]
+    @classmethod
+    def build(cls, archives, index_cache=None, jobs=1):
+        with profiling('build'):
+            zip_files, indexes = cls.index(archives, index_cache, jobs)
+            with metrics.phase('index.merge'):
+                return cls._merge(zip_files, indexes)
 
     @classmethod
-    def build(cls, archives):
+    def index(cls, archives, index_cache=None, jobs=1):
+        """Returns ZipFiles & list of entries for every archive. Entries are loaded from index cache or scanned"""
         zip_files = ZipFiles()
-        albums_file = None
-        items_metadata = {}
-        items = {}
-        types = set()
-        items_ids = iter(range(0, 10**7))
+        indexes = []
+        to_scan = []
         for archive_id, archive in enumerate(archives):
-            zf = zipfile.ZipFile(archive)
-            zip_files.add_archive(archive_id, zf)
-            for file_path in zf.namelist():
-                file = ArchiveFile(archive_id=archive_id, path=file_path)
-                if file_path == 'albums.json':
-                    albums_file = file
-                    continue
+            with metrics.phase('index.zip_open'):
+                zf = zipfile.ZipFile(archive)
+                zip_files.add_archive(archive_id, zf)
+                fingerprint = ArchiveFingerprint.of(archive, zf)
+            with metrics.phase('index.cache_load'):
+                entries = index_cache.get(archive, fingerprint) if index_cache is not None else None
+            if entries is None:
+                to_scan.append((archive_id, archive, fingerprint))
+            indexes.append(entries)
+
+        if jobs > 1 and len(to_scan) > 1:
+            logger.debug('Scanning %d archives in %d processes', len(to_scan), jobs)
+            with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+                scanned = profiling.map(executor, _scan_archive_file, [archive for _, archive, _ in to_scan])
+                cls._collect_scanned(indexes, to_scan, cls._merge_worker_metrics(scanned), index_cache)
+        else:
+            scanned = (cls._scan_archive(zip_files.archive_by_id(archive_id)) for archive_id, _, _ in to_scan)
+            cls._collect_scanned(indexes, to_scan, scanned, index_cache)
 
-                item_match_1 = re.match(r'(?P<name>.+)_(?P<id>[0-9]+)_o\.(?P<ext>[a-z0-9]+)', file_path)
-                item_match_2 = re.match(r'(?P<id>[0-9]+)_(?P<name>[0-9a-f]+)_o\.(?P<ext>[a-z0-9]+)', file_path)
-                item_match_video = re.match(r'(?P<name>.+)_(?P<id>[0-9]+)\.(?P<ext>avi|mov|mp4|m4v)', file_path)
+        if index_cache is not None:
+            logger.info('Archives loaded from index cache: %d, scanned: %d', len(indexes) - len(to_scan), len(to_scan))
+        return zip_files, indexes
 
-                item_match = item_match_1 or item_match_2 or item_match_video
-                if item_match and item_match.group('ext') != 'json':
-                    item_type, main_res, alt_res = cls._process_item_original_file(file, item_match, next(items_ids))
-                    if main_res.id in items:
-                        logger.warning('Duplicate item with id %s. %s, %s', main_res.id, items[main_res.id], main_res)
-                    else:
-                        items[main_res.id] = main_res
-                    if alt_res is not None and alt_res.id not in items:
-                        items[alt_res.id] = alt_res
-                    continue
+    @staticmethod
+    def _merge_worker_metrics(scanned):
+        for entries, phases in scanned:
+            metrics.merge_phases(phases)
+            yield entries
 
-                item_metadata_match = re.match(r'photo_(?P<id>[0-9]+).json', file_path)
-                if item_metadata_match:
-                    item_metadata = cls._process_item_metadata(file, zip_files, item_metadata_match)
-                    if item_metadata.id in items_metadata:
-                        logger.warning('Duplicate item info with id %s. %s, %s',
-                                       item_metadata.id, items_metadata[item_metadata.id], item_metadata)
-                    else:
-                        items_metadata[item_metadata.id] = item_metadata
-                    continue
+    @classmethod
+    def _collect_scanned(cls, indexes, to_scan, scanned, index_cache):
+        for (archive_id, archive, fingerprint), entries in zip(to_scan, scanned):
+            logger.debug('Archive %s has been scanned', archive)
+            indexes[archive_id] = entries
+            if index_cache is not None:
+                index_cache.put(archive, fingerprint, entries)
+
+    @classmethod
+    def _scan_archive(cls, zip_file, archive_metrics=None):
+        """
+        Returns list of archive entries in namelist order. Entries don't depend on archive position,
+        so they may be cached or built independently for every archive.
+        """
+        archive_metrics = archive_metrics or metrics
+        started = time.perf_counter()
+        json_seconds = 0.0
+        json_count = 0
+        entries = []
+        for file_path in zip_file.namelist():
+            kind, item_id, name, ext = classify_archive_entry(file_path)
+            if kind == ENTRY_ITEM:
+                entries.append((ENTRY_ITEM, file_path, item_id, name, ext))
+            elif kind == ENTRY_METADATA:
+                json_started = time.perf_counter()
+                metadata = parse_json_fields(zip_file.read(file_path).decode('utf-8'), INDEXED_METADATA_FIELDS)
+                json_seconds += time.perf_counter() - json_started
+                json_count += 1
+                entries.append((ENTRY_METADATA, file_path, item_id, metadata))
+            elif kind != ENTRY_IGNORED:
+                entries.append((kind, file_path))
+        archive_metrics.add_phase('index.json_parse', json_seconds, json_count)
+        archive_metrics.add_phase('index.namelist_scan', time.perf_counter() - started - json_seconds)
+        return entries
 
-                if not IGNORED_JSONS_RE.match(file_path):
-                    logger.warning('Unknown file in archive: %s', file)
+    @classmethod
+    def _merge(cls, zip_files, indexes):
+        albums_file = None
+        # columns of files, items & metadata in order of entries, duplicates are detected with temporary dicts
+        files_archive_ids = array.array('H')
+        files_paths = []
+        items_rows = {}
+        items_columns = ([], array.array('q'), array.array('l'), [], [])  # id, uid, file id, name, type
+        metadata_rows = {}
+        # id, file id, original name, albums, page url, date taken
+        metadata_columns = ([], array.array('l'), [], [], [], [])
+        duplicate_items = []  # (id, kind, first file, duplicate file)
+        types = set()
+        uid = 0
+
+        def file_by_id(file_id):
+            return ArchiveFile(archive_id=files_archive_ids[file_id], path=files_paths[file_id])
+
+        def item_by_row(index):
+            item_id, item_uid, file_id, name, item_type = (column[index] for column in items_columns)
+            return Item(item_id, item_uid, file=file_by_id(file_id), name=name, type=item_type)
+
+        def metadata_by_row(index):
+            item_id, file_id, original_name, albums, page_url, date_taken = (
+                column[index] for column in metadata_columns)
+            return ItemMetadata(item_id, metadata_file=file_by_id(file_id), original_name=original_name,
+                                albums=albums, page_url=page_url, date_taken=date_taken or None)
+
+        for archive_id, entries in enumerate(indexes):
+            for entry in entries:
+                kind = entry[0]
+                file_id = len(files_paths)
+                files_archive_ids.append(archive_id)
+                files_paths.append(entry[1])
+                if kind == ENTRY_ITEM:
+                    for item_id, name, is_main in cls._process_item_original_file(entry[2], entry[3]):
+                        if item_id not in items_rows:
+                            items_rows[item_id] = len(items_columns[0])
+                            items_columns[0].append(item_id)
+                            items_columns[1].append(uid)
+                            items_columns[2].append(file_id)
+                            items_columns[3].append(name)
+                            items_columns[4].append(entry[4])
+                        elif is_main:
+                            first = item_by_row(items_rows[item_id])
+                            duplicate = Item(item_id, uid, file=file_by_id(file_id), name=name, type=entry[4])
+                            logger.warning('Duplicate item with id %s. %s, %s', item_id, first, duplicate)
+                            duplicate_items.append((item_id, 'item', first.file, duplicate.file))
+                    uid += 1
+                elif kind == ENTRY_METADATA:
+                    item_id = entry[2]
+                    metadata = entry[3]
+                    if item_id in metadata_rows:
+                        first = metadata_by_row(metadata_rows[item_id])
+                        duplicate = cls._process_item_metadata(file_by_id(file_id), item_id, metadata)
+                        logger.warning('Duplicate item info with id %s. %s, %s', item_id, first, duplicate)
+                        duplicate_items.append((item_id, 'metadata', first.metadata_file, duplicate.metadata_file))
+                    else:
+                        metadata_rows[item_id] = len(metadata_columns[0])
+                        metadata_columns[0].append(item_id)
+                        metadata_columns[1].append(file_id)
+                        metadata_columns[2].append(metadata['original'])
+                        metadata_columns[3].append(metadata['albums'])
+                        metadata_columns[4].append(metadata['photopage'])
+                        metadata_columns[5].append(metadata.get('date_taken') or '')
+                elif kind == ENTRY_ALBUMS:
+                    albums_file = file_by_id(file_id)
+                else:
+                    logger.warning('Unknown file in archive: %s', file_by_id(file_id))
+        del items_rows, metadata_rows
 
         logger.debug('Item types in archive: {}'.format(', '.join(types)))
-        return FlickrArchive(zip_files, albums_file, items_metadata, items)
+        files = ArchiveFilesTable(files_archive_ids, files_paths)
+        return FlickrArchive(zip_files, albums_file, ItemsMetadataStore(files, *metadata_columns),
+                             ItemsStore(files, *items_columns), duplicate_items)
 
     @classmethod
-    def _process_item_original_file(cls, file, item_match, uid):
-        item_type = item_match.group('ext')
-        item_id = int(item_match.group('id'))
-        name = item_match.group('name')
-        main_item = Item(item_id, uid, file=file, name=name, type=item_type)
-        alt_item = None
-        if re.match(r'^\d+$', name) is not None:
+    def _process_item_original_file(cls, item_id, name):
+        """Returns (item id, name, is main item) for item and an alternative item if name looks like id"""
+        if DIGITS_RE.match(name) is not None:
             # swap name & item id
-            alt_item = Item(id=int(name), uid=uid, file=file, name=str(item_id), type=item_type)
-        return item_type, main_item, alt_item
+            return (item_id, name, True), (int(name), str(item_id), False)
+        return (item_id, name, True),
 
     @classmethod
-    def _process_item_metadata(cls, file, zip_files, item_match):
-        photo_id = int(item_match.group('id'))
-        metadata = zip_files.parse_json(file)
+    def _process_item_metadata(cls, file, photo_id, metadata):
         return ItemMetadata(
             photo_id,
-            data=metadata,
             metadata_file=file,
             original_name=metadata['original'],
             albums=metadata['albums'],
-            page_url=metadata['photopage']
+            page_url=metadata['photopage'],
+            date_taken=metadata.get('date_taken')
         )
 
 
+def _scan_archive_file(archive_path):
+    """Scans archive in worker process, returns entries & phases measured in the worker"""
+    worker_metrics = Metrics()
+    with zipfile.ZipFile(archive_path) as zf:
+        entries = FlickrArchive._scan_archive(zf, worker_metrics)
+    return entries, worker_metrics.phases
+
+
+ENTRY_ALBUMS = 'albums'
+ENTRY_ITEM = 'item'
+ENTRY_METADATA = 'metadata'
+ENTRY_IGNORED = 'ignored'
+ENTRY_UNKNOWN = 'unknown'
+
+DIGITS_RE = re.compile(r'^\d+$')
+METADATA_FILE_RE = re.compile(r'photo_(?P<id>[0-9]+).json')
+# Alternatives are tried in the same order as separate patterns were, so match is the same.
+# The last matched group name tells which alternative has matched.
+_ARCHIVE_ENTRY_TAIL = (
+    r'(?P<name3>.+)_(?P<id3>[0-9]+)\.(?P<item3>avi|mov|mp4|m4v)'
+    r'|photo_(?P<metadata>[0-9]+).json'
+    r'|(?:' + IGNORED_JSONS_RE.pattern + ')'
+)
+ARCHIVE_ENTRY_RE = re.compile(
+    r'(?P<name1>.+)_(?P<id1>[0-9]+)_o\.(?P<item1>[a-z0-9]+)'
+    r'|(?P<id2>[0-9]+)_(?P<name2>[0-9a-f]+)_o\.(?P<item2>[a-z0-9]+)'
+    r'|' + _ARCHIVE_ENTRY_TAIL
+)
+# the first two alternatives can't match without '_o.', skipping them is faster for metadata & video files
+ARCHIVE_ENTRY_WITHOUT_ORIGINAL_SUFFIX_RE = re.compile(_ARCHIVE_ENTRY_TAIL)
+_ITEM_GROUPS = {
+    'item1': ('id1', 'name1'),
+    'item2': ('id2', 'name2'),
+    'item3': ('id3', 'name3'),
+}
+
+
+def classify_archive_entry(file_path):
+    """
+    Returns (kind, item_id, name, ext) for archive file path with one regex match in most cases.
+    Fields which don't make sense for the kind are None.
+    """
+    if file_path == 'albums.json':
+        return ENTRY_ALBUMS, None, None, None
+    if '_o.' in file_path:
+        match = ARCHIVE_ENTRY_RE.match(file_path)
+    else:
+        match = ARCHIVE_ENTRY_WITHOUT_ORIGINAL_SUFFIX_RE.match(file_path)
+    if match is None:
+        return ENTRY_UNKNOWN, None, None, None
+    group = match.lastgroup
+    if group in _ITEM_GROUPS:
+        ext = match.group(group)
+        id_group, name_group = _ITEM_GROUPS[group]
+        if ext != 'json':
+            return ENTRY_ITEM, int(match.group(id_group)), match.group(name_group), ext
+        # original file pattern with json extension isn't an item, other original file patterns aren't checked
+        metadata_match = METADATA_FILE_RE.match(file_path)
+        if metadata_match:
+            return ENTRY_METADATA, int(metadata_match.group('id')), None, None
+        if IGNORED_JSONS_RE.match(file_path):
+            return ENTRY_IGNORED, None, None, None
+        return ENTRY_UNKNOWN, None, None, None
+    if group == 'metadata':
+        return ENTRY_METADATA, int(match.group('metadata')), None, None
+    return ENTRY_IGNORED, None, None, None
+
+
 class ArchiveFile(collections.namedtuple('ArchiveFile', ['archive_id', 'path'])):
 
     @property
@@ -279,16 +927,304 @@ ItemWithMetadata = collections.namedtuple('ItemWithMetadata', ['item', 'metadata
 Album = collections.namedtuple('Album', ['id', 'title', 'description', 'url', 'created', 'updated', 'items_ids'])
 
 
-class ItemMetadata(collections.namedtuple('ItemMetadata', ['id', 'data', 'metadata_file', 'original_name',
-                                                           'albums', 'page_url'])):
+class ItemMetadata(collections.namedtuple('ItemMetadata', ['id', 'metadata_file', 'original_name', 'albums',
+                                                           'page_url', 'date_taken'])):
+    """
+    Only fields required for archive checks & upload scheduling are kept in memory, full metadata is loaded on demand
+    """
     @property
     def is_unprocessed_video(self):
-        return self.original_name.split('/')[-1] == 'video_encoding.jpg'
+        return is_unprocessed_video_original(self.original_name)
+
+    def load_data(self, zip_files):
+        return zip_files.parse_json_cached(self.metadata_file)
+
+
+def is_unprocessed_video_original(original_name):
+    return original_name.split('/')[-1] == 'video_encoding.jpg'
+
+
+INDEXED_METADATA_FIELDS = frozenset(['original', 'albums', 'photopage', 'date_taken'])
+
+_json_decoder = json.JSONDecoder()
+_json_whitespace = re.compile(r'[ \t\n\r]*').match
+
+
+def parse_json_fields(text, fields):
+    """
+    Decodes only given top-level fields of JSON object and stops as soon as all of them are found,
+    so large tail fields like comments aren't decoded. Falls back to json.loads on malformed JSON.
+    """
+    try:
+        found = {}
+        idx = _json_whitespace(text, 0).end()
+        if text[idx:idx + 1] != '{':
+            raise ValueError('object expected')
+        idx = _json_whitespace(text, idx + 1).end()
+        if text[idx:idx + 1] == '}':
+            return found
+        while True:
+            if text[idx:idx + 1] != '"':
+                raise ValueError('property name expected')
+            key, idx = json.decoder.scanstring(text, idx + 1)
+            idx = _json_whitespace(text, idx).end()
+            if text[idx:idx + 1] != ':':
+                raise ValueError("':' expected")
+            idx = _json_whitespace(text, idx + 1).end()
+            value, idx = _json_decoder.scan_once(text, idx)
+            if key in fields:
+                found[key] = value
+                if len(found) == len(fields):
+                    return found
+            idx = _json_whitespace(text, idx).end()
+            delimiter = text[idx:idx + 1]
+            if delimiter == '}':
+                return found
+            if delimiter != ',':
+                raise ValueError("',' expected")
+            idx = _json_whitespace(text, idx + 1).end()
+    except (ValueError, StopIteration):
+        data = json.loads(text)
+        return {key: value for key, value in data.items() if key in fields}
+
+
+class StringColumn(collections.abc.Sequence):
+    """Immutable sequence of strings packed into one str, with array of offsets"""
+
+    __slots__ = ('_data', '_offsets')
+
+    def __init__(self, values=()):
+        offsets = array.array('q', [0])
+        total = 0
+        parts = []
+        for value in values:
+            parts.append(value)
+            total += len(value)
+            offsets.append(total)
+        self._data = ''.join(parts)
+        self._offsets = offsets
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        return self._data[self._offsets[index]:self._offsets[index + 1]]
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+
+class ArchiveFilesTable:
+    """Archive files referenced by index. Archive ids are stored as small ints, paths are packed"""
+
+    __slots__ = ('_archive_ids', '_paths')
+
+    def __init__(self, archive_ids, paths):
+        self._archive_ids = array.array('H', archive_ids)
+        self._paths = StringColumn(paths)
+
+    def __getitem__(self, file_id):
+        return ArchiveFile(archive_id=self._archive_ids[file_id], path=self._paths[file_id])
+
+    def __len__(self):
+        return len(self._archive_ids)
+
+
+def _sorted_positions(ids):
+    return sorted(range(len(ids)), key=ids.__getitem__)
+
+
+class SortedIdsStore(collections.abc.Mapping):
+    """
+    Base for id -> record mappings stored as parallel columns sorted by id.
+    Lookups are binary searches over the ids array.
+    """
+
+    def __init__(self, ids):
+        self.ids = ids
+
+    def row(self, key):
+        """Returns position of key in columns or -1"""
+        index = bisect.bisect_left(self.ids, key)
+        if index < len(self.ids) and self.ids[index] == key:
+            return index
+        return -1
+
+    def __getitem__(self, key):
+        index = self.row(key) if isinstance(key, int) else -1
+        if index < 0:
+            raise KeyError(key)
+        return self.record(index)
+
+    def __contains__(self, key):
+        return isinstance(key, int) and self.row(key) >= 0
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def record(self, index):
+        raise NotImplementedError
+
+
+class ItemsStore(SortedIdsStore):
+    """id -> Item mapping"""
+
+    def __init__(self, files, ids, uids, file_ids, names, types):
+        order = _sorted_positions(ids)
+        super(ItemsStore, self).__init__(array.array('q', (ids[i] for i in order)))
+        self._files = files
+        self.uids = array.array('q', (uids[i] for i in order))
+        self._file_ids = array.array('l', (file_ids[i] for i in order))
+        self._names = StringColumn(names[i] for i in order)
+        self._types = sorted(set(types))
+        type_codes = {item_type: code for code, item_type in enumerate(self._types)}
+        self._type_codes = array.array('B', (type_codes[types[i]] for i in order))
+
+    def record(self, index):
+        return Item(id=self.ids[index], uid=self.uids[index], file=self._files[self._file_ids[index]],
+                    name=self._names[index], type=self._types[self._type_codes[index]])
+
+
+class ItemsMetadataStore(SortedIdsStore):
+    """id -> ItemMetadata mapping"""
+
+    def __init__(self, files, ids, file_ids, original_names, albums, page_urls, dates_taken):
+        order = _sorted_positions(ids)
+        super(ItemsMetadataStore, self).__init__(array.array('q', (ids[i] for i in order)))
+        self._files = files
+        self._file_ids = array.array('l', (file_ids[i] for i in order))
+        self.original_names = StringColumn(original_names[i] for i in order)
+        self._albums = StringColumn(json.dumps(albums[i], separators=(',', ':')) if albums[i] else ''
+                                    for i in order)
+        self._page_urls = StringColumn(page_urls[i] for i in order)
+        self._dates_taken = StringColumn(dates_taken[i] for i in order)
+
+    def record(self, index):
+        return ItemMetadata(id=self.ids[index], metadata_file=self._files[self._file_ids[index]],
+                            original_name=self.original_names[index],
+                            albums=json.loads(self._albums[index] or '[]'),
+                            page_url=self._page_urls[index], date_taken=self._dates_taken[index] or None)
+
+
+class IdsView(SortedIdsStore):
+    """Mapping over a sorted subset of ids, values are built by a function of id"""
+
+    def __init__(self, ids, value_func):
+        super(IdsView, self).__init__(ids)
+        self._value_func = value_func
+
+    def record(self, index):
+        return self._value_func(self.ids[index])
+
+
+class AlbumsIndex(SortedIdsStore):
+    """item id -> list of album ids mapping in CSR layout: albums of i-th item are values[offsets[i]:offsets[i+1]]"""
+
+    def __init__(self, pairs, album_ids):
+        pairs = sorted(pairs, key=operator.itemgetter(0))
+        ids = array.array('q')
+        offsets = array.array('l')
+        for position, (item_id, _) in enumerate(pairs):
+            if not ids or ids[-1] != item_id:
+                ids.append(item_id)
+                offsets.append(position)
+        offsets.append(len(pairs))
+        super(AlbumsIndex, self).__init__(ids)
+        self._offsets = offsets
+        self._values = array.array('l', (album_index for _, album_index in pairs))
+        self._album_ids = album_ids
+
+    def record(self, index):
+        return [self._album_ids[i] for i in self._values[self._offsets[index]:self._offsets[index + 1]]]
+
+
+def merge_sorted_ids(a, b):
+    """
+    Linear merge of two sorted unique ids arrays.
+    Returns positions (only in a, in both from a, in both from b, only in b) as arrays.
+    """
+    only_a, both_a, both_b, only_b = (array.array('l') for _ in range(4))
+    i = j = 0
+    len_a = len(a)
+    len_b = len(b)
+    while i < len_a and j < len_b:
+        x = a[i]
+        y = b[j]
+        if x == y:
+            both_a.append(i)
+            both_b.append(j)
+            i += 1
+            j += 1
+        elif x < y:
+            only_a.append(i)
+            i += 1
+        else:
+            only_b.append(j)
+            j += 1
+    only_a.extend(range(i, len_a))
+    only_b.extend(range(j, len_b))
+    return only_a, both_a, both_b, only_b
+
+
+METADATA_CACHE_SIZE = 1024
+
+
+class MmapReader:
+    """Read-only file object over mmap with its own position, so every opened member may be read by other thread"""
+
+    def __init__(self, mapped, position=0):
+        self._mapped = mapped
+        self._position = position
+
+    def read(self, size=-1):
+        end = len(self._mapped) if size is None or size < 0 else min(self._position + size, len(self._mapped))
+        data = self._mapped[self._position:end]
+        self._position = max(self._position, end)
+        return data
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self._position
+        elif whence == os.SEEK_END:
+            offset += len(self._mapped)
+        self._position = offset
+        return offset
+
+    def tell(self):
+        return self._position
+
+    def close(self):
+        pass
 
 
 class ZipFiles:
-    def __init__(self):
+    """
+    Archives by id. Safe to use from several threads: members are read from read-only mmap of the archive,
+    every opened member has its own position, so threads don't share file position & don't wait for each other.
+    Stored (uncompressed) members are also available as zero-copy memoryview slices of the mmap.
+    Local header of every member is parsed & checked once, offsets of members data are cached.
+    If archive can't be mapped, members are read through its ZipFile. close() unmaps & closes all archives.
+    """
+
+    def __init__(self, json_cache_size=METADATA_CACHE_SIZE):
         self._zip_files = {}
+        self._mapped = {}
+        self._data_offsets = {}
+        self._lock = threading.Lock()
+        self._json_cache = collections.OrderedDict()
+        self._json_cache_size = json_cache_size
+        self._json_cache_lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
 
     def add_archive(self, archive_id, zip_file):
         self._zip_files[archive_id] = zip_file
@@ -296,25 +1232,70 @@ class ZipFiles:
     def archive_by_id(self, archive_id):
         return self._zip_files.get(archive_id)
 
+    def ids(self):
+        return self._zip_files.keys()
+
     def file_size(self, file: ArchiveFile):
+        return self.getinfo(file).file_size
+
+    def getinfo(self, file: ArchiveFile):
         if file.archive_id not in self._zip_files:
             raise RuntimeError("archive with id '{}' not found".format(file.archive_id))
-        zf = self._zip_files[file.archive_id]
         try:
-            return zf.getinfo(file.path).file_size
+            return self._zip_files[file.archive_id].getinfo(file.path)
         except KeyError as e:
             raise RuntimeError("path '{}' not found in archive".format(file.path)) from e
 
     def open_file(self, file: ArchiveFile, mode='r'):
-        if file.archive_id not in self._zip_files:
-            raise RuntimeError("archive with id '{}' not found".format(file.archive_id))
-
-        zf = self._zip_files[file.archive_id]
-        try:
-            zf.getinfo(file.path)
-        except KeyError as e:
-            raise RuntimeError("path '{}' not found in archive".format(file.path)) from e
-        return zf.open(file.path, mode)
+        info = self.getinfo(file)
+        mapped = self._mapped_archive(file.archive_id)
+        if mapped is None or info.flag_bits & 0x1:
+            return self._zip_files[file.archive_id].open(info, mode)
+        return zipfile.ZipExtFile(MmapReader(mapped, self._data_offset(file, info, mapped)), mode, info)
+
+    def member_view(self, file: ArchiveFile):
+        """Returns zero-copy memoryview of stored member content or None if member is compressed or encrypted"""
+        info = self.getinfo(file)
+        if info.compress_type != zipfile.ZIP_STORED or info.flag_bits & 0x1:
+            return None
+        mapped = self._mapped_archive(file.archive_id)
+        if mapped is None:
+            return None
+        offset = self._data_offset(file, info, mapped)
+        if offset + info.file_size > len(mapped):
+            raise zipfile.BadZipFile('Truncated file {} in archive'.format(file.path))
+        return memoryview(mapped)[offset:offset + info.file_size]
+
+    def _mapped_archive(self, archive_id):
+        with self._lock:
+            if archive_id not in self._mapped:
+                try:
+                    with open(self._zip_files[archive_id].filename, 'rb') as fp:
+                        self._mapped[archive_id] = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+                except (OSError, ValueError, TypeError) as e:
+                    logger.debug('Unable to mmap archive #%s, reading it through ZipFile: %s', archive_id, e)
+                    self._mapped[archive_id] = None
+            return self._mapped[archive_id]
+
+    def _data_offset(self, file, info, mapped):
+        offset = self._data_offsets.get(file)
+        if offset is None:
+            header = mapped[info.header_offset:info.header_offset + zipfile.sizeFileHeader]
+            if len(header) != zipfile.sizeFileHeader:
+                raise zipfile.BadZipFile('Truncated file header of {}'.format(file.path))
+            fields = struct.unpack(zipfile.structFileHeader, header)
+            if fields[0] != zipfile.stringFileHeader:
+                raise zipfile.BadZipFile('Bad magic number for file header of {}'.format(file.path))
+            # flag bits go after version fields, file name length & extra field length are the last fields
+            flag_bits, name_length, extra_length = fields[3], fields[-2], fields[-1]
+            name_offset = info.header_offset + zipfile.sizeFileHeader
+            name = mapped[name_offset:name_offset + name_length].decode('utf-8' if flag_bits & 0x800 else 'cp437')
+            if name != info.orig_filename:
+                raise zipfile.BadZipFile('File name in directory {!r} and header {!r} differ.'.format(
+                    info.orig_filename, name))
+            offset = name_offset + name_length + extra_length
+            self._data_offsets[file] = offset
+        return offset
 
     def get_file_content(self, file):
         return self.open_file(file).read()
@@ -322,31 +1303,648 @@ class ZipFiles:
     def parse_json(self, file):
         return json.loads(self.get_file_content(file).decode('utf-8'))
 
+    def parse_json_cached(self, file):
+        """parse_json with bounded LRU cache"""
+        with self._json_cache_lock:
+            if file in self._json_cache:
+                self._json_cache.move_to_end(file)
+                return self._json_cache[file]
+        data = self.parse_json(file)
+        with self._json_cache_lock:
+            self._json_cache[file] = data
+            if len(self._json_cache) > self._json_cache_size:
+                self._json_cache.popitem(last=False)
+        return data
+
+    def close(self):
+        """Unmaps & closes archives. Mmap with member views still in use is left to be unmapped when they're released"""
+        with self._lock:
+            for archive_id, mapped in self._mapped.items():
+                if mapped is None:
+                    continue
+                try:
+                    mapped.close()
+                except BufferError:
+                    logger.debug('Member views of archive #%s are still in use, it stays mapped', archive_id)
+            self._mapped.clear()
+            self._data_offsets.clear()
+        for zip_file in self._zip_files.values():
+            zip_file.close()
+
     def __len__(self) -> int:
         return len(self._zip_files)
 
 
+# index cache
+
+INDEX_CACHE_VERSION = 3
+
+
+class ArchiveFingerprint(collections.namedtuple('ArchiveFingerprint', ['size', 'mtime', 'cd_crc'])):
+
+    @classmethod
+    def of(cls, path, zip_file):
+        stat = os.stat(path)
+        cd_crc = 0
+        for info in zip_file.infolist():
+            record = '{i.filename}:{i.CRC}:{i.compress_size}:{i.file_size}:{i.header_offset}\n'.format(i=info)
+            cd_crc = zlib.crc32(record.encode('utf-8'), cd_crc)
+        return cls(size=stat.st_size, mtime=stat.st_mtime_ns, cd_crc=cd_crc)
+
+
+class IndexCache:
+    """
+    Persistent per-archive index storage. Entries are reused only if archive path, size, mtime and
+    central directory records checksum are the same as on the previous scan.
+    """
+
+    def __init__(self, db):
+        self._db = db
+        self._db.execute(
+            "create table if not exists archive_index ("
+            "  path text primary key,"
+            "  size integer not null,"
+            "  mtime integer not null,"
+            "  cd_crc integer not null,"
+            "  version integer not null,"
+            "  entries blob not null"
+            ")"
+        )
+        self._db.execute(
+            "create table if not exists content_hashes ("
+            "  path text not null,"
+            "  member text not null,"
+            "  size integer not null,"
+            "  crc integer not null,"
+            "  sha256 text not null,"
+            "  primary key (path, member)"
+            ")"
+        )
+        self._db.execute(
+            "create table if not exists check_state ("
+            "  id integer primary key check (id = 0),"
+            "  state blob not null"
+            ")"
+        )
+        self._db.execute(
+            "create table if not exists verified_archives ("
+            "  path text primary key,"
+            "  size integer not null,"
+            "  mtime integer not null,"
+            "  cd_crc integer not null,"
+            "  result text not null"
+            ")"
+        )
+        self._db.commit()
+
+    @classmethod
+    def open(cls, path):
+        try:
+            import sqlite3
+        except ImportError:
+            logger.warning("sqlite3 isn't available, index cache is disabled")
+            return None
+        cache_dir = os.path.dirname(path)
+        if cache_dir and not os.path.exists(cache_dir):
+            os.makedirs(cache_dir, mode=0o755, exist_ok=True)
+        return cls(sqlite3.connect(path))
+
+    def get(self, archive_path, fingerprint):
+        row = self._db.execute('select size, mtime, cd_crc, version, entries from archive_index where path = ?',
+                               (os.path.abspath(archive_path), )).fetchone()
+        if row is None or tuple(row[0:3]) != tuple(fingerprint) or row[3] != INDEX_CACHE_VERSION:
+            return None
+        return pickle.loads(row[4])
+
+    def put(self, archive_path, fingerprint, entries):
+        self._db.execute(
+            'insert or replace into archive_index (path, size, mtime, cd_crc, version, entries) '
+            'values (?, ?, ?, ?, ?, ?)',
+            (os.path.abspath(archive_path), fingerprint.size, fingerprint.mtime, fingerprint.cd_crc,
+             INDEX_CACHE_VERSION, pickle.dumps(entries, protocol=pickle.HIGHEST_PROTOCOL))
+        )
+        self._db.commit()
+
+    def get_content_hash(self, archive_path, member, size, crc):
+        row = self._db.execute('select size, crc, sha256 from content_hashes where path = ? and member = ?',
+                               (os.path.abspath(archive_path), member)).fetchone()
+        if row is None or tuple(row[0:2]) != (size, crc):
+            return None
+        return row[2]
+
+    def put_content_hashes(self, rows):
+        """rows are (archive path, member, size, crc, sha256)"""
+        self._db.executemany(
+            'insert or replace into content_hashes (path, member, size, crc, sha256) values (?, ?, ?, ?, ?)',
+            ((os.path.abspath(path), member, size, crc, sha256) for path, member, size, crc, sha256 in rows)
+        )
+        self._db.commit()
+
+    def get_verification(self, archive_path, fingerprint):
+        row = self._db.execute('select size, mtime, cd_crc, result from verified_archives where path = ?',
+                               (os.path.abspath(archive_path), )).fetchone()
+        if row is None or tuple(row[0:3]) != tuple(fingerprint):
+            return None
+        return ContentVerification.from_json(row[3])
+
+    def put_verification(self, archive_path, fingerprint, verification):
+        self._db.execute(
+            'insert or replace into verified_archives (path, size, mtime, cd_crc, result) values (?, ?, ?, ?, ?)',
+            (os.path.abspath(archive_path), fingerprint.size, fingerprint.mtime, fingerprint.cd_crc,
+             verification.to_json())
+        )
+        self._db.commit()
+
+    def get_check_state(self):
+        row = self._db.execute('select state from check_state where id = 0').fetchone()
+        return row[0] if row else None
+
+    def put_check_state(self, state):
+        self._db.execute('insert or replace into check_state (id, state) values (0, ?)', (state, ))
+        self._db.commit()
+
+    def close(self):
+        self._db.close()
+
+
+# content verification
+
+class ContentVerification(collections.namedtuple('ContentVerification', ['members', 'bytes', 'errors', 'elapsed'])):
+    """Result of decompressing all archive members. `errors` is a list of (member path, error message)"""
+
+    def to_json(self):
+        return json.dumps(self._asdict())
+
+    @classmethod
+    def from_json(cls, text):
+        data = json.loads(text)
+        data['errors'] = [tuple(error) for error in data['errors']]
+        return cls(**data)
+
+
+def verify_archive_content(archive_path, buffer_size=4 * 1024 * 1024):
+    """Decompresses every archive member checking its CRC & size. Safe to call in worker processes"""
+    started = time.monotonic()
+    members = 0
+    total_bytes = 0
+    errors = []
+    view = memoryview(bytearray(buffer_size))
+    with zipfile.ZipFile(archive_path) as zf:
+        for info in zf.infolist():
+            if info.is_dir():
+                continue
+            members += 1
+            if info.file_size == 0:
+                errors.append((info.filename, 'empty member'))
+                continue
+            read_bytes = 0
+            try:
+                # ZipExtFile checks CRC when the whole member is read
+                with zf.open(info) as fp:
+                    while True:
+                        read = read_chunk(fp, view)
+                        read_bytes += read
+                        if read < buffer_size:
+                            break
+                if read_bytes != info.file_size:
+                    errors.append((info.filename, 'truncated: {} of {} bytes'.format(read_bytes, info.file_size)))
+            except EOFError:
+                errors.append((info.filename, 'truncated: {} of {} bytes'.format(read_bytes, info.file_size)))
+            except (zipfile.BadZipFile, zlib.error, OSError, NotImplementedError) as e:
+                errors.append((info.filename, str(e) or e.__class__.__name__))
+            total_bytes += read_bytes
+    return ContentVerification(members=members, bytes=total_bytes, errors=errors,
+                               elapsed=time.monotonic() - started)
+
+
+def verify_archives_content(zip_files, index_cache=None, jobs=1):
+    """
+    Verifies content of all archives in parallel processes. Archives which haven't changed since
+    the previous verification stored in index cache are skipped.
+    Returns list of (archive path, ContentVerification, is result from cache) in archives order.
+    """
+    results = []
+    to_verify = []
+    for archive_id in sorted(zip_files.ids()):
+        zf = zip_files.archive_by_id(archive_id)
+        fingerprint = ArchiveFingerprint.of(zf.filename, zf)
+        verification = index_cache.get_verification(zf.filename, fingerprint) if index_cache is not None else None
+        if verification is None:
+            to_verify.append((len(results), zf.filename, fingerprint))
+        results.append((zf.filename, verification, verification is not None))
+
+    paths = [path for _, path, _ in to_verify]
+    if jobs > 1 and len(paths) > 1:
+        logger.debug('Verifying %d archives in %d processes', len(paths), jobs)
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+            _collect_verified(results, to_verify, profiling.map(executor, verify_archive_content, paths), index_cache)
+    else:
+        _collect_verified(results, to_verify, map(verify_archive_content, paths), index_cache)
+    return results
+
+
+def _collect_verified(results, to_verify, verified, index_cache):
+    for done, ((position, path, fingerprint), verification) in enumerate(zip(to_verify, verified), 1):
+        logger.info('.. %d / %d archives verified "%s"', done, len(to_verify), path)
+        results[position] = (path, verification, False)
+        if index_cache is not None:
+            index_cache.put_verification(path, fingerprint, verification)
+
+
+# content duplicates
+
+class ContentDuplicates:
+    """
+    Groups of matched items with the same content. Items are grouped by size & CRC32 from zip
+    central directory, sha256 of the content is calculated only for items which share both.
+    """
+
+    def __init__(self, groups):
+        self.groups = groups
+        self._group_by_id = {}
+        for group in groups:
+            for item_id in group:
+                self._group_by_id[item_id] = group
+
+    def group(self, item_id):
+        """Returns sorted ids of items with the same content including item_id"""
+        return self._group_by_id.get(item_id) or [item_id]
+
+    def key(self, item_id):
+        return self.group(item_id)[0]
+
+    @property
+    def redundant_items(self):
+        return sum(len(group) - 1 for group in self.groups)
+
+    @classmethod
+    def find(cls, archive, index_cache=None):
+        candidates = collections.defaultdict(list)
+        for item_id in archive.matched.ids:
+            file = archive.items[item_id].file
+            info = archive.zip_files.archive_by_id(file.archive_id).getinfo(file.path)
+            candidates[(info.file_size, info.CRC)].append((item_id, file))
+
+        hashes = {}
+        new_hashes = []
+        groups = []
+        for (size, crc), items in candidates.items():
+            if len(items) < 2:
+                continue
+            by_hash = collections.defaultdict(list)
+            for item_id, file in items:
+                if file not in hashes:
+                    archive_path = archive.zip_files.archive_by_id(file.archive_id).filename
+                    sha256 = index_cache.get_content_hash(archive_path, file.path, size, crc) if index_cache else None
+                    if sha256 is None:
+                        sha256 = content_sha256(archive.zip_files, file)
+                        new_hashes.append((archive_path, file.path, size, crc, sha256))
+                    hashes[file] = sha256
+                by_hash[hashes[file]].append(item_id)
+            groups.extend(sorted(group) for group in by_hash.values() if len(group) > 1)
+        if index_cache is not None and new_hashes:
+            index_cache.put_content_hashes(new_hashes)
+        logger.debug('Content hashes calculated: %d, loaded from index cache: %d',
+                     len(new_hashes), len(hashes) - len(new_hashes))
+        groups.sort()
+        return cls(groups)
+
+
+def content_sha256(zip_files, file, buffer_size=1024 * 1024):
+    sha256 = hashlib.sha256()
+    member_view = zip_files.member_view(file)
+    if member_view is not None:
+        with member_view:
+            sha256.update(member_view)
+        return sha256.hexdigest()
+    view = memoryview(bytearray(buffer_size))
+    with zip_files.open_file(file) as fp:
+        while True:
+            read = read_chunk(fp, view)
+            sha256.update(view[:read])
+            if read < buffer_size:
+                return sha256.hexdigest()
+
+
+def find_content_duplicates(archive, index_cache_path=None):
+    logger.info('Looking for items with the same content ...')
+    index_cache = IndexCache.open(index_cache_path) if index_cache_path else None
+    try:
+        duplicates = ContentDuplicates.find(archive, index_cache)
+    finally:
+        if index_cache is not None:
+            index_cache.close()
+    logger.info('Groups of items with the same content: %d, redundant items: %d',
+                len(duplicates.groups), duplicates.redundant_items)
+    return duplicates
+
+
+# incremental check
+
+def _sorted_contains(ids, value):
+    index = bisect.bisect_left(ids, value)
+    return index < len(ids) and ids[index] == value
+
+
+def _sorted_set(ids, value, present):
+    """Inserts value to or removes it from sorted array, returns True if array has been changed"""
+    index = bisect.bisect_left(ids, value)
+    found = index < len(ids) and ids[index] == value
+    if present and not found:
+        ids.insert(index, value)
+    elif found and not present:
+        del ids[index]
+    else:
+        return False
+    return True
+
+
+ItemCheckStatus = collections.namedtuple('ItemCheckStatus', ['matched', 'without_metadata', 'without_items',
+                                                             'albums', 'missed_in_albums'])
+CHECK_STATE_VERSION = 1
+
+
+class CheckState:
+    """
+    Results of the previous check reduced to ids, so newly added archives can be applied to them
+    without merging & post processing the whole library again.
+    Sorted id arrays: `items`, `metadata`, `unprocessed` (unprocessed videos metadata), `matched`,
+    `without_metadata`. `without_items` maps id to page url, `partners` maps id of an item with
+    an alternative id to all ids of the original file, `album_members` maps item id to album ids
+    as listed in albums.json including items which aren't matched.
+    """
+
+    def __init__(self, archives, items, metadata, unprocessed, partners, matched, without_metadata, without_items,
+                 album_titles, album_members):
+        self.archives = archives
+        self.items = items
+        self.metadata = metadata
+        self.unprocessed = unprocessed
+        self.partners = partners
+        self.matched = matched
+        self.without_metadata = without_metadata
+        self.without_items = without_items
+        self.album_titles = album_titles
+        self.album_members = album_members
+
+    @classmethod
+    def from_archive(cls, archive, fingerprints):
+        uids = collections.defaultdict(list)
+        for item_id, uid in zip(archive.items.ids, archive.items.uids):
+            uids[uid].append(item_id)
+        partners = {}
+        for ids in uids.values():
+            if len(ids) > 1:
+                for item_id in ids:
+                    partners[item_id] = tuple(ids)
+
+        missed = collections.defaultdict(list)
+        for album_id, item_id in archive.missed_items_in_albums:
+            missed[album_id].append(item_id)
+        album_members = collections.defaultdict(list)
+        for album in archive.albums.values():
+            for item_id in album.items_ids + missed[album.id]:
+                album_members[item_id].append(album.id)
+
+        return cls(
+            archives=dict(fingerprints),
+            items=array.array('q', archive.items.ids),
+            metadata=array.array('q', archive.items_metadata.ids),
+            unprocessed=array.array('q', archive.unprocessed_videos_metadata.ids),
+            partners=partners,
+            matched=array.array('q', archive.matched.ids),
+            without_metadata=array.array('q', archive.without_metadata.ids),
+            without_items={m.id: m.page_url for m in archive.without_items.values()},
+            album_titles={album.id: album.title for album in archive.albums.values()},
+            album_members=dict(album_members),
+        )
+
+    def status(self, item_id):
+        matched = _sorted_contains(self.matched, item_id)
+        albums = ()
+        missed = ()
+        if not _sorted_contains(self.unprocessed, item_id):
+            if matched:
+                albums = tuple(self.album_members.get(item_id, ()))
+            else:
+                missed = tuple(self.album_members.get(item_id, ()))
+        return ItemCheckStatus(matched=matched, without_metadata=_sorted_contains(self.without_metadata, item_id),
+                               without_items=item_id in self.without_items, albums=albums, missed_in_albums=missed)
+
+    def all_ids(self):
+        return set(self.items) | set(self.metadata) | set(self.album_members)
+
+    def apply(self, archives_entries, fingerprints):
+        """
+        Applies entries of new archives. `archives_entries` is a list of (zip file, entries).
+        Duplicates are resolved as in FlickrArchive.build: the first item or metadata with an id wins,
+        the last albums.json wins. Returns dict id -> (status before, status after) for affected ids.
+        """
+        new_ids = set()
+        page_urls = {}
+        albums_json = None
+        for zip_file, entries in archives_entries:
+            for entry in entries:
+                kind = entry[0]
+                if kind == ENTRY_ITEM:
+                    ids = [item_id for item_id, _, _ in FlickrArchive._process_item_original_file(entry[2], entry[3])
+                           if not _sorted_contains(self.items, item_id)]
+                    for item_id in ids:
+                        _sorted_set(self.items, item_id, True)
+                        if len(ids) > 1:
+                            self.partners[item_id] = tuple(ids)
+                    new_ids.update(ids)
+                elif kind == ENTRY_METADATA:
+                    item_id = entry[2]
+                    if _sorted_set(self.metadata, item_id, True):
+                        new_ids.add(item_id)
+                        page_urls[item_id] = entry[3]['photopage']
+                        if is_unprocessed_video_original(entry[3]['original']):
+                            _sorted_set(self.unprocessed, item_id, True)
+                elif kind == ENTRY_ALBUMS:
+                    albums_json = json.loads(zip_file.read(entry[1]).decode('utf-8'))
+
+        affected = set(new_ids)
+        for item_id in new_ids:
+            affected.update(self.partners.get(item_id, ()))
+        album_members = None
+        if albums_json is not None:
+            album_members = collections.defaultdict(list)
+            album_titles = {}
+            for album_json in (albums_json.get('albums') or []):
+                album_titles.setdefault(album_json['id'], album_json.get('title') or '')
+                for pid in (album_json.get('photos') or []):
+                    if pid != '0' and DIGITS_RE.match(pid):
+                        album_members[int(pid)].append(album_json['id'])
+            affected.update(self.album_members)
+            affected.update(album_members)
+        before = {item_id: self.status(item_id) for item_id in affected}
+
+        if album_members is not None:
+            self.album_titles = album_titles
+            self.album_members = dict(album_members)
+        for item_id in affected:
+            in_items = _sorted_contains(self.items, item_id)
+            in_metadata = _sorted_contains(self.metadata, item_id)
+            _sorted_set(self.matched, item_id, in_items and in_metadata)
+            if in_metadata and not in_items and not _sorted_contains(self.unprocessed, item_id):
+                self.without_items.setdefault(item_id, page_urls.get(item_id, ''))
+            else:
+                self.without_items.pop(item_id, None)
+        for item_id in affected:
+            without_metadata = (_sorted_contains(self.items, item_id) and
+                                not _sorted_contains(self.metadata, item_id) and
+                                not any(_sorted_contains(self.matched, i) for i in self.partners.get(item_id, ())))
+            _sorted_set(self.without_metadata, item_id, without_metadata)
+        self.archives.update(fingerprints)
+        return {item_id: (before[item_id], self.status(item_id)) for item_id in affected}
+
+    @staticmethod
+    def diff(before, after, ids=None):
+        """Returns dict id -> (status before, status after) for ids which status differs"""
+        ids = before.all_ids() | after.all_ids() if ids is None else ids
+        changes = {}
+        for item_id in ids:
+            status_before, status_after = before.status(item_id), after.status(item_id)
+            if status_before != status_after:
+                changes[item_id] = (status_before, status_after)
+        return changes
+
+    def save(self, index_cache):
+        index_cache.put_check_state(pickle.dumps((CHECK_STATE_VERSION, self.__dict__),
+                                                 protocol=pickle.HIGHEST_PROTOCOL))
+
+    @classmethod
+    def load(cls, index_cache):
+        data = index_cache.get_check_state()
+        if data is None:
+            return None
+        version, fields = pickle.loads(data)
+        if version != CHECK_STATE_VERSION:
+            return None
+        return cls(**fields)
+
+
+def log_check_changes(changes, state, samples_size=30):
+    """Logs only changes of items statuses since the previous check"""
+    def ids_where(field, value):
+        return sorted(item_id for item_id, (before, after) in changes.items()
+                      if bool(getattr(before, field)) != value and bool(getattr(after, field)) == value)
+
+    def log_ids(ids, what, format_func=str):
+        if ids:
+            log_sample(sample(ids, samples_size), len(ids), format_func, what)
+
+    logger.info('Items which changed status: %d', len(changes))
+    log_ids(ids_where('matched', True), 'new valid items')
+    log_ids(ids_where('matched', False), 'items which are no longer valid')
+    log_ids(ids_where('without_metadata', True), 'new items without metadata')
+    log_ids(ids_where('without_metadata', False), 'items which have got metadata')
+    log_ids(ids_where('without_items', True), 'new items without an original file',
+            lambda item_id: 'id={}: {}'.format(item_id, state.without_items.get(item_id)))
+    log_ids(ids_where('without_items', False), 'items which have got an original file')
+
+    album_changes = collections.Counter()
+    for before, after in changes.values():
+        for album_id in set(after.albums) - set(before.albums):
+            album_changes[album_id] += 1
+    log_ids(sorted(album_changes), 'albums with new items',
+            lambda album_id: '"{}" (#{}): +{}'.format(state.album_titles.get(album_id, ''), album_id,
+                                                      album_changes[album_id]))
+
+    def format_album_pair(pair):
+        return 'album_id={}, item id={}'.format(pair[0], pair[1])
+
+    log_ids(sorted((album_id, item_id) for item_id, (before, after) in changes.items()
+                   for album_id in set(after.missed_in_albums) - set(before.missed_in_albums)),
+            'new missed items in albums', format_album_pair)
+    log_ids(sorted((album_id, item_id) for item_id, (before, after) in changes.items()
+                   for album_id in set(before.missed_in_albums) - set(after.missed_in_albums)),
+            'items in albums which are no longer missed', format_album_pair)
+
+
 # db
 
+NO_ALBUM = ''
+
+
 def init_db(db_path):
     try:
         import sqlite3
     except ImportError:
         logger.critical("sqlite3 is required. it should be in the python stdlib")
         return None
-    db = sqlite3.connect(db_path)
-    tables = (db
-              .execute(r"select name from sqlite_master where type in ('table','view') and name not like 'sqlite_%'")
-              .fetchall())
-    if not tables:
-        init_tables(db)
+    db = connect_db(db_path)
+    migrate_db(db)
+    return db
+
+
+def connect_db(db_path, **kwargs):
+    """
+    WAL journal allows reading progress from other processes while upload is running.
+    With synchronous=normal WAL isn't synced on every commit, DB stays consistent but
+    the last transactions may be lost on power failure, they will be uploaded again on the next run.
+    """
+    import sqlite3
+    db = sqlite3.connect(db_path, timeout=30.0, **kwargs)
+    db.execute('pragma journal_mode = wal')
+    db.execute('pragma synchronous = normal')
+    return db
+
+
+def connect_db_readonly(db_path):
+    """
+    Read-only connection which doesn't migrate or otherwise change DB, so it's safe while upload is running.
+    Returns None if DB schema is older than the current one.
+    """
+    import sqlite3
+    uri = 'file:{}?mode=ro'.format(urllib.request.pathname2url(os.path.abspath(db_path)))
+    db = sqlite3.connect(uri, uri=True, timeout=30.0)
+    try:
+        row = db.execute('select version from schema_version').fetchone()
+    except sqlite3.OperationalError:
+        row = None
+    if row is None or row[0] < len(DB_MIGRATIONS):
+        db.close()
+        return None
+    return db
+
+
+def migrate_db(db):
+    """
+    Every migration is applied in its own transaction. Transactions are managed manually in autocommit mode,
+    otherwise sqlite3 module (before python 3.6) commits before DDL statements & failed migration is half-applied.
+    """
+    db.commit()
+    isolation_level = db.isolation_level
+    db.isolation_level = None
+    try:
+        db.execute('create table if not exists schema_version (version integer not null)')
+        row = db.execute('select version from schema_version').fetchone()
+        version = row[0] if row else 0
+        for target_version, migration in enumerate(DB_MIGRATIONS, start=1):
+            if target_version <= version:
+                continue
+            logger.debug('Migrating DB to schema version %d', target_version)
+            db.execute('begin')
+            try:
+                migration(db)
+                db.execute('delete from schema_version')
+                db.execute('insert into schema_version (version) values (?)', (target_version, ))
+            except BaseException:
+                db.execute('rollback')
+                raise
+            db.execute('commit')
+    finally:
+        db.isolation_level = isolation_level
     return db
 
 
-def init_tables(db):
-    db.execute("create table gphotos_token (token blob)")
+def _migration_init_tables(db):
+    # DB created before schema versioning may already contain these tables
+    db.execute("create table if not exists gphotos_token (token blob)")
     db.execute(
-        "create table gphotos_albums ("
+        "create table if not exists gphotos_albums ("
         "  seq_id integer primary key autoincrement,"
         "  album_id text not null,"
         "  status text not null default 'none',"
@@ -354,7 +1952,7 @@ def init_tables(db):
         ")"
     )
     db.execute(
-        "create table gphotos_items ("
+        "create table if not exists gphotos_items ("
         "  item_id integer,"
         "  album_id text,"
         "  status text not null default 'none',"
@@ -362,8 +1960,88 @@ def init_tables(db):
         "  primary key (item_id, album_id)"
         ")"
     )
-    db.commit()
-    return db
+    db.execute(
+        "create table if not exists gphotos_upload_sessions ("
+        "  item_id integer not null,"
+        "  album_id text not null,"
+        "  upload_url text not null,"
+        "  file_size integer not null,"
+        "  chunk_size integer not null,"
+        "  confirmed_offset integer not null default 0,"
+        "  primary key (item_id, album_id)"
+        ")"
+    )
+
+
+def _migration_unique_keys(db):
+    # null album_id isn't unique in primary key, so items without album use NO_ALBUM sentinel
+    db.execute(
+        "create table gphotos_items_new ("
+        "  item_id integer not null,"
+        "  album_id text not null default '',"
+        "  status text not null default 'none',"
+        "  google_id text,"
+        "  primary key (item_id, album_id)"
+        ")"
+    )
+    db.execute("insert or ignore into gphotos_items_new (item_id, album_id, status, google_id) "
+               "select item_id, coalesce(album_id, ?), status, google_id from gphotos_items "
+               "order by status = 'none'", (NO_ALBUM, ))
+    db.execute("drop table gphotos_items")
+    db.execute("alter table gphotos_items_new rename to gphotos_items")
+    db.execute("delete from gphotos_albums where seq_id not in "
+               "(select min(seq_id) from gphotos_albums group by album_id)")
+    db.execute("create unique index gphotos_albums_album_id on gphotos_albums (album_id)")
+
+
+def _migration_status_indexes(db):
+    db.execute("create index gphotos_items_status on gphotos_items (status)")
+    db.execute("create index gphotos_albums_status on gphotos_albums (status)")
+
+
+DB_MIGRATIONS = (
+    _migration_init_tables,
+    _migration_unique_keys,
+    _migration_status_indexes,
+)
+
+
+UploadSession = collections.namedtuple('UploadSession', ['upload_url', 'file_size', 'chunk_size', 'confirmed_offset'])
+
+
+class UploadSessions:
+    """
+    Thread-safe storage for resumable upload sessions. Uses a separate DB connection,
+    so sessions may be saved from upload worker threads.
+    """
+
+    def __init__(self, db_path):
+        self._db = connect_db(db_path, check_same_thread=False)
+        self._lock = threading.Lock()
+
+    def get(self, item_id, album_id):
+        with self._lock:
+            row = self._db.execute('select upload_url, file_size, chunk_size, confirmed_offset '
+                                   'from gphotos_upload_sessions where item_id = ? and album_id = ?',
+                                   (item_id, album_id)).fetchone()
+        return UploadSession(*row) if row else None
+
+    def save(self, item_id, album_id, session):
+        with self._lock:
+            self._db.execute('insert or replace into gphotos_upload_sessions '
+                             '(item_id, album_id, upload_url, file_size, chunk_size, confirmed_offset) '
+                             'values (?, ?, ?, ?, ?, ?)', (item_id, album_id) + tuple(session))
+            self._db.commit()
+
+    def delete(self, item_id, album_id):
+        with self._lock:
+            self._db.execute('delete from gphotos_upload_sessions where item_id = ? and album_id = ?',
+                             (item_id, album_id))
+            self._db.commit()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
 
 
 # google api
@@ -371,22 +2049,42 @@ def init_tables(db):
 GOOGLE_PHOTOS_SCOPES = [
     'https://www.googleapis.com/auth/photoslibrary'
 ]
+GOOGLE_PHOTOS_API_URL = 'https://photoslibrary.googleapis.com'
 
 
 class GoogleAPILimitReached(Exception):
     pass
 
 
-def init_google_photos_api(credentials_path, db):
+def init_google_photos_api(credentials_path, db, api_url=GOOGLE_PHOTOS_API_URL):
+    """
+    Returns (credentials, photoslibrary client). Client of non-default `api_url` is built from discovery document
+    served by that url. If app credentials aren't given for such url, static token is used without OAuth flow.
+    """
     try:
         from googleapiclient import discovery
         from google_auth_oauthlib import flow
         from google.auth.transport import requests
+        from google.oauth2 import credentials
     except ImportError:
         logger.critical('extra requirements needed for working with google photo.\n'
                         '  python3 -m pip install -r requirements-google-photo.txt')
         return None, None
 
+    if api_url == GOOGLE_PHOTOS_API_URL:
+        creds = _load_google_photos_credentials(credentials_path, db, flow, requests)
+        return creds, discovery.build('photoslibrary', 'v1', credentials=creds)
+
+    if credentials_path is None:
+        creds = credentials.Credentials('local-token')
+    else:
+        creds = _load_google_photos_credentials(credentials_path, db, flow, requests)
+    discovery_url = api_url.rstrip('/') + '/$discovery/rest?version={apiVersion}'
+    return creds, discovery.build('photoslibrary', 'v1', credentials=creds, discoveryServiceUrl=discovery_url,
+                                  cache_discovery=False)
+
+
+def _load_google_photos_credentials(credentials_path, db, flow, requests):
     creds = None
     token_res = db.execute('select token from gphotos_token').fetchone()
 
@@ -401,47 +2099,34 @@ def init_google_photos_api(credentials_path, db):
             creds = flow.run_local_server()
         db.execute('delete from gphotos_token')
         db.execute('insert into gphotos_token (token) values(?)', (pickle.dumps(creds), ))
-
-    return creds, discovery.build('photoslibrary', 'v1', credentials=creds)
+    return creds
 
 
-def init_albums_to_upload_to_google_photos(albums_sorted, db):
-    existed = 0
-    created = 0
-    albums_sorted = sorted(albums_sorted.items(), key=lambda x: x[1].created)
-    for album_id, album in albums_sorted:
-        seq_id_res = db.execute('select seq_id from gphotos_albums where album_id = ?', (album_id, )).fetchone()
-        if not seq_id_res:
-            db.execute('insert into gphotos_albums (album_id) values (?)', (album_id, ))
-            created += 1
-        else:
-            existed += 1
+def init_albums_to_upload_to_google_photos(albums, db):
+    albums_sorted = sorted(albums.items(), key=lambda x: x[1].created)
+    changes_before = db.total_changes
+    db.executemany('insert or ignore into gphotos_albums (album_id) values (?)',
+                   ((album_id, ) for album_id, _ in albums_sorted))
+    created = db.total_changes - changes_before
     db.commit()
-    return existed, created
+    return len(albums_sorted) - created, created
 
 
 def init_items_to_upload_to_google_photos(items_with_metadata, item_to_albums_index, db):
-    existed = 0
-    created = 0
-
-    for index, i in enumerate(items_with_metadata.values()):
-        albums_ids = item_to_albums_index.get(i.item.id, [None])
-        if index != 0 and index % 1000 == 0:
-            db.commit()
-        for album_id in albums_ids:
-            if album_id is not None:
-                in_db = db.execute('select 1 from gphotos_items where item_id = ? and album_id = ?',
-                                   (i.item.id, album_id)).fetchone()
-            else:
-                in_db = db.execute('select 1 from gphotos_items where item_id = ? and album_id is null',
-                                   (i.item.id, )).fetchone()
-            if not in_db:
-                db.execute('insert into gphotos_items (item_id, album_id) values (?, ?)', (i.item.id, album_id))
-                created += 1
-            else:
-                existed += 1
+    total = 0
+
+    def rows():
+        nonlocal total
+        for i in items_with_metadata.values():
+            for album_id in item_to_albums_index.get(i.item.id, [NO_ALBUM]):
+                total += 1
+                yield i.item.id, album_id
+
+    changes_before = db.total_changes
+    db.executemany('insert or ignore into gphotos_items (item_id, album_id) values (?, ?)', rows())
+    created = db.total_changes - changes_before
     db.commit()
-    return existed, created
+    return total - created, created
 
 
 class RetryException(Exception):
@@ -452,193 +2137,1633 @@ class RetryException(Exception):
         super(RetryException, self).__init__(message)
 
 
-def create_google_photos_album(album, album_status, album_google_id, gclient, db):
+class RateLimitedException(RetryException):
+
+    def __init__(self, message, retry_after=None):
+        self.retry_after = retry_after
+        super(RateLimitedException, self).__init__(message)
+
+
+def parse_retry_after(value):
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        import email.utils
+        retry_at = email.utils.parsedate_to_datetime(value)
+        return max(0.0, retry_at.timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class GoogleAPIRateLimiter:
+    """
+    Rate limiter shared by all threads calling Google API.
+
+    Requests are limited with a token bucket and a daily quota budget. When the budget is spent,
+    requests wait for the next 24h window (or GoogleAPILimitReached is raised if `wait_for_quota` is false).
+    When API responds with 429 all requests are paused with jittered exponential backoff or for Retry-After time.
+    """
+
+    def __init__(self, requests_per_second=5.0, daily_quota=None, wait_for_quota=True, max_backoff=3600.0,
+                 clock=time.monotonic, sleep=time.sleep):
+        self.requests_per_second = requests_per_second
+        self.daily_quota = daily_quota
+        self.wait_for_quota = wait_for_quota
+        self.max_backoff = max_backoff
+        self._clock = clock
+        self._sleep = sleep
+        self._lock = threading.Lock()
+        self._capacity = max(1.0, requests_per_second)
+        self._tokens = self._capacity
+        self._refilled_at = clock()
+        self._paused_until = 0.0
+        self._day_started_at = None
+        self._day_requests = 0
+        self.requests = 0
+        self.throttled = 0
+
+    def acquire(self):
+        """Blocks until request may be sent"""
+        while True:
+            with self._lock:
+                now = self._clock()
+                delay = self._paused_until - now
+                if delay <= 0:
+                    delay = self._quota_delay(now)
+                if delay <= 0:
+                    self._tokens = min(self._capacity,
+                                       self._tokens + (now - self._refilled_at) * self.requests_per_second)
+                    self._refilled_at = now
+                    if self._tokens >= 1.0:
+                        self._tokens -= 1.0
+                        self._day_requests += 1
+                        self.requests += 1
+                        break
+                    delay = (1.0 - self._tokens) / self.requests_per_second
+            self._sleep(delay)
+        metrics.add('api.requests')
+
+    def remaining_quota(self):
+        """Returns number of requests left in the current 24h window or None if daily quota isn't limited"""
+        if self.daily_quota is None:
+            return None
+        with self._lock:
+            if self._day_started_at is None or self._clock() - self._day_started_at >= 24 * 3600:
+                return self.daily_quota
+            return max(0, self.daily_quota - self._day_requests)
+
+    def wait_if_paused(self):
+        """Blocks while requests are paused, doesn't spend tokens. Used for upload chunks"""
+        while True:
+            with self._lock:
+                delay = self._paused_until - self._clock()
+            if delay <= 0:
+                return
+            self._sleep(delay)
+
+    def pause(self, attempt, retry_after=None):
+        """Pauses all requests after `attempt`-th rate limited response in a row. Returns pause time"""
+        if retry_after is not None:
+            delay = min(retry_after, self.max_backoff)
+        else:
+            delay = self.backoff_delay(attempt, base=15.0)
+        with self._lock:
+            self.throttled += 1
+            self._paused_until = max(self._paused_until, self._clock() + delay)
+        return delay
+
+    def backoff_delay(self, attempt, base):
+        return min(self.max_backoff, base * 2 ** (attempt - 1)) * random.uniform(0.5, 1.0)
+
+    def _quota_delay(self, now):
+        if self.daily_quota is None:
+            return 0.0
+        if self._day_started_at is None or now - self._day_started_at >= 24 * 3600:
+            self._day_started_at = now
+            self._day_requests = 0
+        if self._day_requests < self.daily_quota:
+            return 0.0
+        if not self.wait_for_quota:
+            raise GoogleAPILimitReached()
+        delay = self._day_started_at + 24 * 3600 - now
+        logger.warning('Daily quota of %d requests is spent, waiting for %.1f h', self.daily_quota, delay / 3600)
+        return delay
+
+
+def call_with_retries(action, what, limiter, retries=5):
+    """
+    Calls action until it succeeds. Returns its result or None if all retries failed.
+    RetryException is retried with jittered exponential backoff up to `retries` times.
+    RateLimitedException pauses all API requests & isn't counted as a retry.
+    """
+    retry = 0
+    rate_limited = 0
+    while True:
+        try:
+            return action()
+        except RateLimitedException as e:
+            rate_limited += 1
+            metrics.add('api.rate_limited')
+            delay = limiter.pause(rate_limited, e.retry_after)
+            logger.warning('Google API rate limit reached while %s, pausing requests for %.0f s', what, delay)
+        except RetryException as e:
+            retry += 1
+            metrics.add('api.retries')
+            if retry >= retries:
+                logger.error('Unable %s, skipping. Last error was: %s', what, e)
+                return None
+            logger.warning('Retrying %s. Error: %s', what, e)
+            time.sleep(limiter.backoff_delay(retry, e.sleep_time))
+
+
+def execute_google_api_request(request, what, limiter):
     import googleapiclient.errors
+    limiter.acquire()
+    try:
+        return request.execute()
+    except googleapiclient.errors.HttpError as e:
+        if e.resp.status == http.HTTPStatus.TOO_MANY_REQUESTS:
+            raise RateLimitedException('too many requests', parse_retry_after(e.resp.get('retry-after')))
+        raise RetryException('unable {}: {}'.format(what, e))
+    except (http.client.HTTPException, OSError) as e:
+        raise RetryException('unable {}, connection error: {!r}'.format(what, e))
+
+
+def create_google_photos_album(album, album_status, album_google_id, gclient, db, limiter):
     if album_status == 'none':
         logger.info('Creating album "%s" (%s) (#%s)',
                     album.title, album.created.strftime('%Y-%m-%d'), album.id)
-        retry = 0
-        sleep_time = 15.0
-        while retry < 5:
-            if retry > 0:
-                time.sleep(sleep_time)
-            try:
-                try:
-                    resp = gclient.albums().create(body={'album': {'title': album.title}}).execute()
-                    if 'id' not in resp:
-                        raise RetryException('unable to get album id')
-                    album_google_id = resp['id']
-                except googleapiclient.errors.HttpError as e:
-                    if e.resp.status == http.HTTPStatus.TOO_MANY_REQUESTS:
-                        raise GoogleAPILimitReached()
-                    else:
-                        raise RetryException('unable to add item to album: {}'.format(e))
-                db.execute("update gphotos_albums "
-                           "set status = ?, google_id = ? "
-                           "where album_id = ?", ('created', album_google_id, album.id))
-                db.commit()
-                break
-            except RetryException as e:
-                retry += 1
-                sleep_time = e.sleep_time * retry
-                if retry < 5:
-                    logger.warning('Retrying creating album "%s" (#%s). Error: %s', album.title, album.id, e)
-                else:
-                    logger.error('Unable to create album "%s" (#%s), skipping. Last error was: %s',
-                                 album.title, album.id, e)
+
+        def create():
+            resp = execute_google_api_request(gclient.albums().create(body={'album': {'title': album.title}}),
+                                              'to create album', limiter)
+            if 'id' not in resp:
+                raise RetryException('unable to get album id')
+            return resp['id']
+
+        album_google_id = call_with_retries(create, 'creating album "{}" (#{})'.format(album.title, album.id),
+                                            limiter)
+        if album_google_id is not None:
+            db.execute("update gphotos_albums "
+                       "set status = ?, google_id = ? "
+                       "where album_id = ?", ('created', album_google_id, album.id))
+            db.commit()
 
     return album_google_id
 
 
-def http_request(req: urllib.request.Request, timeout=15.0):
+class HttpConnectionPool:
+    """
+    Thread-safe pool of keep-alive HTTP connections, one set of idle connections per scheme, host & port.
+    A pooled connection may be closed by server while idle, such request is resent once on a new connection.
+    """
+
+    def __init__(self, max_idle_per_host=16, max_idle_time=60.0):
+        self.max_idle_per_host = max_idle_per_host
+        self.max_idle_time = max_idle_time
+        self._idle = collections.defaultdict(list)
+        self._lock = threading.Lock()
+        self.created = 0
+        self.reused = 0
+        self.stale = 0
+
+    def request(self, method, url, headers, body=None, timeout=15.0):
+        parsed = urllib.parse.urlsplit(url)
+        key = (parsed.scheme, parsed.hostname, parsed.port)
+        path = parsed.path or '/'
+        if parsed.query:
+            path += '?' + parsed.query
+        while True:
+            conn, reused = self._acquire(key, timeout)
+            try:
+                conn.request(method, path, body=body, headers=headers)
+                response = conn.getresponse()
+                data = response.read()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                conn.close()
+                if not reused:
+                    raise
+                with self._lock:
+                    self.stale += 1
+                continue
+            except Exception:
+                conn.close()
+                raise
+            if response.will_close:
+                conn.close()
+            else:
+                self._release(key, conn)
+            return response.status, dict(response.getheaders()), data
+
+    def _acquire(self, key, timeout):
+        now = time.monotonic()
+        with self._lock:
+            idle = self._idle[key]
+            while idle:
+                conn, idle_since = idle.pop()
+                if now - idle_since > self.max_idle_time or self._is_dropped(conn):
+                    conn.close()
+                    continue
+                self.reused += 1
+                conn.timeout = timeout
+                conn.sock.settimeout(timeout)
+                return conn, True
+            self.created += 1
+        scheme, host, port = key
+        if scheme == 'https':
+            return http.client.HTTPSConnection(host, port, timeout=timeout), False
+        return http.client.HTTPConnection(host, port, timeout=timeout), False
+
+    def _release(self, key, conn):
+        with self._lock:
+            idle = self._idle[key]
+            if len(idle) < self.max_idle_per_host:
+                idle.append((conn, time.monotonic()))
+                return
+        conn.close()
+
+    @staticmethod
+    def _is_dropped(conn):
+        if conn.sock is None:
+            return True
+        # idle keep-alive socket is readable only if server has closed it
+        readable, _, _ = select.select([conn.sock], [], [], 0)
+        return bool(readable)
+
+    def close(self):
+        with self._lock:
+            for idle in self._idle.values():
+                for conn, _ in idle:
+                    conn.close()
+            self._idle.clear()
+
+    def log_stats(self):
+        logger.info('HTTP connections: %d created, %d reused, %d stale', self.created, self.reused, self.stale)
+
+
+http_pool = HttpConnectionPool()
+
+
+def http_request(req: urllib.request.Request, timeout=15.0, pool=None):
+    pool = pool or http_pool
     try:
-        response = urllib.request.urlopen(req, timeout=timeout)
-        return response.status, dict(response.getheaders()), response.read()
-    except urllib.request.HTTPError as e:
-        return e.code, dict(e.headers), e.read()
-    except urllib.error.URLError:
-        return 599, dict(), b''
-    except socket.timeout:
+        return pool.request(req.get_method(), req.full_url, dict(req.header_items()), req.data, timeout)
+    except (http.client.HTTPException, OSError):
         return 599, dict(), b''
 
 
-def upload_item_to_google_photos(archive, album_id, album_google_id, item_with_meta, gclient, gcreds, db):
-    import googleapiclient.errors
-    item = item_with_meta.item
-    meta = item_with_meta.metadata
-    if album_id is not None:
-        item_row = db.execute('select status, google_id from gphotos_items where item_id = ? and album_id = ?',
-                              (item.id, album_id)).fetchone()
-    else:
-        item_row = db.execute('select status, google_id from gphotos_items where item_id = ? and album_id is null',
-                              (item.id, )).fetchone()
-    item_status = item_row[0]
-    item_google_id = item_row[1]
-    if item_status == 'none':
-        retry = 0
-        sleep_time = 15.0
-        recalculate_size = False
-        preloaded_body = None
-        while retry < 5:
-            if retry > 0:
-                time.sleep(sleep_time)
+def check_upload_response(status, headers, what):
+    if status == http.HTTPStatus.TOO_MANY_REQUESTS:
+        retry_after = next((v for k, v in headers.items() if k.lower() == 'retry-after'), None)
+        raise RateLimitedException('too many requests', parse_retry_after(retry_after))
+    if status != http.HTTPStatus.OK:
+        raise RetryException('unable to {}'.format(what))
+
+
+def read_chunk(fp, view):
+    """Fills memoryview from file object, returns number of bytes read. It's less than view size only on EOF"""
+    filled = 0
+    size = len(view)
+    while filled < size:
+        read = fp.readinto(view[filled:])
+        if not read:
+            break
+        filled += read
+    return filled
+
+
+def measure_file_size(zip_files, file, buffer_size=1024 * 1024):
+    size = 0
+    view = memoryview(bytearray(buffer_size))
+    with zip_files.open_file(file) as fp:
+        while True:
+            read = read_chunk(fp, view)
+            size += read
+            if read < buffer_size:
+                return size
+
+
+UPLOAD_BUFFERS_BUDGET = 64 * 1024 * 1024
+UPLOAD_PREFETCH_CHUNKS = 2
+
+
+class ChunkBufferPool:
+    """
+    Reusable upload chunk buffers shared by upload threads & `prefetch` depth of read-ahead.
+    Total size of allocated buffers is capped by `budget` bytes, acquire blocks until enough buffers are released.
+    A buffer larger than the whole budget is allocated only when no other buffer is allocated.
+    """
+
+    def __init__(self, budget=UPLOAD_BUFFERS_BUDGET, prefetch=UPLOAD_PREFETCH_CHUNKS):
+        self.budget = budget
+        self.prefetch = prefetch
+        self._cond = threading.Condition()
+        self._free = collections.defaultdict(list)
+        self._allocated = 0
+        self.in_use = 0
+        self.peak = 0
+
+    def acquire(self, size, cancelled=None):
+        """Returns memoryview of `size` bytes or None if `cancelled()` became true while waiting"""
+        with self._cond:
+            while True:
+                if cancelled is not None and cancelled():
+                    return None
+                free = self._free[size]
+                if free:
+                    buffer = free.pop()
+                    break
+                self._evict(size)
+                if self._allocated == 0 or self._allocated + size <= self.budget:
+                    buffer = memoryview(bytearray(size))
+                    self._allocated += size
+                    break
+                self._cond.wait()
+            self.in_use += size
+            self.peak = max(self.peak, self.in_use)
+            return buffer
+
+    def release(self, buffer):
+        with self._cond:
+            self._free[len(buffer)].append(buffer)
+            self.in_use -= len(buffer)
+            self._cond.notify_all()
+
+    def wake(self):
+        """Wakes up waiting threads to check their `cancelled` callbacks"""
+        with self._cond:
+            self._cond.notify_all()
+
+    def _evict(self, size):
+        """Drops free buffers of other sizes while new buffer doesn't fit into budget"""
+        for other_size, free in self._free.items():
+            while free and other_size != size and self._allocated + size > self.budget:
+                free.pop()
+                self._allocated -= other_size
+
+    def log_stats(self):
+        logger.info('Upload buffers: peak %.1f MB in use of %.1f MB budget, read-ahead %d chunks',
+                    self.peak / 2 ** 20, self.budget / 2 ** 20, self.prefetch)
+
+
+class ChunkPrefetcher:
+    """
+    Reads file object by chunks of `chunk_size` starting from `offset` until `file_size` bytes are read.
+    With read-ahead of `buffers` the next chunks are read in background thread into pooled buffers,
+    so decompression of archive member overlaps with upload of the previous chunk.
+    Without `buffers` chunks are read on demand into one reusable buffer.
+
+    `next()` returns (buffer, read, trailing), `trailing` is true if file has more data than `file_size`.
+    Buffer should be passed to `release()` after use. Thread is stopped & buffers are returned on `close()`,
+    file object is closed too if `close_fileobj` is true.
+    """
+
+    def __init__(self, fp, chunk_size, file_size, offset=0, buffers=None, close_fileobj=False):
+        self._fp = fp
+        self._close_fileobj = close_fileobj
+        self._chunk_size = chunk_size
+        self._file_size = file_size
+        self._skip = offset
+        self._read = offset
+        self._buffers = buffers
+        self._own_buffer = memoryview(bytearray(chunk_size)) if buffers is None else None
+        self._depth = buffers.prefetch if buffers is not None else 0
+        self._cond = threading.Condition()
+        self._ready = collections.deque()
+        self._finished = False
+        self._closed = False
+        self._error = None
+        self._thread = None
+        if self._depth > 0:
+            self._thread = threading.Thread(target=profiling.thread_target(self._run), name='chunk-prefetch',
+                                            daemon=True)
+            self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def next(self):
+        if self._thread is None:
+            if self._finished:
+                return None, 0, False
+            buffer, read, trailing, self._finished = self._produce()
+            return buffer, read, trailing
+        with self._cond:
+            while not self._ready and self._error is None and not self._finished:
+                self._cond.wait()
+            if self._ready:
+                chunk = self._ready.popleft()
+                self._cond.notify_all()
+                return chunk
+            if self._error is not None:
+                raise self._error
+            return None, 0, False
+
+    def release(self, buffer):
+        if buffer is not None and self._buffers is not None:
+            self._buffers.release(buffer)
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            ready = list(self._ready)
+            self._ready.clear()
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._buffers.wake()
+            self._thread.join()
+        for buffer, _, _ in ready:
+            self.release(buffer)
+        if self._close_fileobj:
+            self._fp.close()
+
+    def _acquire(self):
+        if self._buffers is None:
+            return self._own_buffer
+        return self._buffers.acquire(self._chunk_size, lambda: self._closed)
+
+    def _produce(self):
+        """
+        Reads the next chunk. Returns (buffer, read, trailing, last) or None if closed while waiting for a buffer
+        """
+        buffer = self._acquire()
+        if buffer is None:
+            return None
+        try:
+            while self._skip > 0:
+                skip = min(self._chunk_size, self._skip)
+                if read_chunk(self._fp, buffer[:skip]) < skip:
+                    raise RetryException('Wrong archive file size', force_size_recalculate=True)
+                self._skip -= skip
+            read = read_chunk(self._fp, buffer)
+            self._read += read
+            last = read < self._chunk_size or self._read >= self._file_size
+            trailing = last and read > 0 and self._read >= self._file_size and self._fp.read(1) != b''
+        except BaseException:
+            self.release(buffer)
+            raise
+        return buffer, read, trailing, last
+
+    def _run(self):
+        try:
+            while True:
+                with self._cond:
+                    while len(self._ready) >= self._depth and not self._closed:
+                        self._cond.wait()
+                    if self._closed:
+                        return
+                chunk = self._produce()
+                if chunk is None:
+                    return
+                buffer, read, trailing, last = chunk
+                with self._cond:
+                    if self._closed:
+                        self.release(buffer)
+                        return
+                    self._ready.append((buffer, read, trailing))
+                    self._finished = last
+                    self._cond.notify_all()
+                    if last:
+                        return
+        except Exception as e:
+            with self._cond:
+                self._error = e
+                self._cond.notify_all()
+
+
+class MemberViewChunks:
+    """ChunkPrefetcher interface over memoryview of stored archive member, chunks are zero-copy slices of it"""
+
+    def __init__(self, view, chunk_size, file_size, offset=0):
+        self._view = view
+        self._chunk_size = chunk_size
+        self._file_size = file_size
+        self._position = min(offset, len(view))
+        self._finished = offset > len(view)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def next(self):
+        if self._finished:
+            return None, 0, False
+        chunk = self._view[self._position:self._position + self._chunk_size]
+        read = len(chunk)
+        self._position += read
+        self._finished = read < self._chunk_size or self._position >= self._file_size
+        trailing = self._finished and read > 0 and len(self._view) > self._position >= self._file_size
+        return chunk, read, trailing
+
+    def release(self, buffer):
+        pass
+
+    def close(self):
+        self._view.release()
+
+
+def open_member_chunks(zip_files, file, chunk_size, file_size, offset=0, buffers=None):
+    """
+    Returns chunks source of archive member starting from `offset`: zero-copy slices of stored member
+    or chunks decompressed (and read ahead with `buffers`) from member stream
+    """
+    view = zip_files.member_view(file)
+    if view is not None:
+        if offset > len(view):
+            view.release()
+            raise RetryException('Wrong archive file size', force_size_recalculate=True)
+        return MemberViewChunks(view, chunk_size, file_size, offset)
+    return ChunkPrefetcher(zip_files.open_file(file), chunk_size, file_size, offset, buffers, close_fileobj=True)
+
+
+def start_upload_session(file_name, file_size, gcreds, limiter, api_url=GOOGLE_PHOTOS_API_URL):
+    req = urllib.request.Request(
+        method='POST',
+        url=api_url.rstrip('/') + '/v1/uploads',
+        headers={
+            'Authorization': 'Bearer {}'.format(gcreds.token),
+            'Content-Length': '0',
+            'X-Goog-Upload-Command': 'start',
+            'X-Goog-Upload-Content-Type': 'application/octet-stream',
+            'X-Goog-Upload-File-Name': file_name,
+            'X-Goog-Upload-Protocol': 'resumable',
+            'X-Goog-Upload-Raw-Size': str(file_size),
+        }
+    )
+    limiter.acquire()
+    status, headers, _ = http_request(req)
+    check_upload_response(status, headers, 'start item upload')
+    return UploadSession(upload_url=headers['X-Goog-Upload-URL'], file_size=file_size,
+                         chunk_size=int(headers['X-Goog-Upload-Chunk-Granularity']), confirmed_offset=0)
+
+
+def query_upload_session(session, gcreds, limiter):
+    """
+    Asks server how many bytes it has received.
+    Returns (offset, upload_token), token is not None only for already finalized uploads.
+    Returns (None, None) if session can't be continued: it's gone (4xx) or server replied unexpectedly.
+    Rate limit, server & connection errors raise RetryException, so the session is queried again on retry.
+    """
+    req = urllib.request.Request(
+        method='POST',
+        url=session.upload_url,
+        headers={
+            'Authorization': 'Bearer {}'.format(gcreds.token),
+            'Content-Length': '0',
+            'X-Goog-Upload-Command': 'query',
+        }
+    )
+    limiter.acquire()
+    status, headers, body = http_request(req)
+    if status == http.HTTPStatus.TOO_MANY_REQUESTS or status >= 500:
+        check_upload_response(status, headers, 'query upload status')
+    upload_status = headers.get('X-Goog-Upload-Status')
+    if status != http.HTTPStatus.OK:
+        return None, None
+    if upload_status == 'final' and body:
+        return session.file_size, body.decode('utf-8')
+    if upload_status != 'active' or 'X-Goog-Upload-Size-Received' not in headers:
+        return None, None
+    return int(headers['X-Goog-Upload-Size-Received']), None
+
+
+UPLOAD_SESSION_SAVE_INTERVAL = 10.0
+
+
+def upload_item_to_google_photos(archive, item, gcreds, limiter, sessions=None, album_id=NO_ALBUM,
+                                 api_url=GOOGLE_PHOTOS_API_URL, buffers=None):
+    """
+    Uploads item content. Returns upload token or None if upload failed after all retries.
+    Content is streamed from archive by chunks, so memory usage doesn't depend on item size.
+    With `buffers` pool the next chunks are read ahead while the current one is being sent.
+    Resumable upload session is saved to `sessions`, so retries & next runs continue from the last confirmed offset.
+    Doesn't use DB & google api client, so it's safe to call it from worker threads.
+    """
+    recalculate_size = False
+    session = sessions.get(item.id, album_id) if sessions is not None else None
+
+    def upload():
+        nonlocal recalculate_size, session
+        try:
+            return _upload_item_content(archive, item, gcreds, limiter, sessions, album_id, session, recalculate_size,
+                                        api_url, buffers)
+        except RetryException as e:
+            if e.force_size_recalculate is not None:
+                recalculate_size = e.force_size_recalculate
+                session = None
+            elif sessions is not None:
+                session = sessions.get(item.id, album_id)
+            raise
+
+    return call_with_retries(upload, 'uploading item {} (#{})'.format(item.name, item.id), limiter)
+
+
+def _upload_item_content(archive, item, gcreds, limiter, sessions, album_id, session, recalculate_size, api_url,
+                         buffers):
+    file_size = archive.zip_files.file_size(item.file)
+    if file_size == 0 or recalculate_size:
+        file_size = measure_file_size(archive.zip_files, item.file)
+        if file_size == 0:
+            logger.warning('Unable to get photo size neither from zip metadata '
+                           'nor file content for item #%s',
+                           item.id)
+            raise RetryException('unable to get item size', sleep_time=0.5)
+    file_name = '{i.name}.{i.type}'.format(i=item)
+
+    offset = None
+    if session is not None and session.file_size == file_size:
+        offset, upload_token = query_upload_session(session, gcreds, limiter)
+        if upload_token:
+            return upload_token
+        if offset is not None and offset < file_size:
+            logger.debug('Resume upload item #%s %s from %d of %d bytes', item.id, file_name, offset, file_size)
+            session = session._replace(confirmed_offset=offset)
+        else:
+            offset = None
+    if offset is None:
+        logger.debug('Upload item #%s %s of %d bytes', item.id, file_name, file_size)
+        session = start_upload_session(file_name, file_size, gcreds, limiter, api_url)
+        if sessions is not None:
+            sessions.save(item.id, album_id, session)
+
+    with open_member_chunks(archive.zip_files, item.file, session.chunk_size, file_size, session.confirmed_offset,
+                            buffers) as chunks:
+        uploaded_bytes = session.confirmed_offset
+        saved_at = time.monotonic()
+        while True:
+            chunk_start = uploaded_bytes
+            read_started = time.perf_counter()
+            buffer, read, trailing = chunks.next()
+            metrics.observe('upload.chunk_read_wait', time.perf_counter() - read_started)
+            uploaded_bytes += read
+            is_last_chunk = uploaded_bytes >= file_size
+            if read == 0 or uploaded_bytes > file_size or (is_last_chunk and trailing) \
+                    or (read < session.chunk_size and not is_last_chunk):
+                chunks.release(buffer)
+                logger.debug('Wrong chunk size on upload #%s %s, expected size: %d, read at least: %d',
+                             item.id, file_name, file_size, uploaded_bytes)
+                raise RetryException('Wrong archive file size', force_size_recalculate=True)
+            command = 'upload, finalize' if is_last_chunk else 'upload'
+            chunk_req = urllib.request.Request(
+                method='POST',
+                url=session.upload_url,
+                headers={
+                    'Authorization': 'Bearer {}'.format(gcreds.token),
+                    'Content-Length': str(read),
+                    'X-Goog-Upload-Command': command,
+                    'X-Goog-Upload-Offset': str(chunk_start),
+                },
+                data=buffer[:read]
+            )
+            limiter.wait_if_paused()
+            chunk_started = time.perf_counter()
             try:
-                meta_json = meta.data
-                file_size = archive.zip_files.file_size(item.file)
-                if file_size == 0 or recalculate_size:
-                    fp = archive.zip_files.open_file(item.file)
-                    preloaded_body = fp.read()
-                    file_size = len(preloaded_body)
-                    fp.close()
-                    if file_size == 0:
-                        logger.warning('Unable to get photo size neither from zip metadata '
-                                       'nor file content for item #%s',
-                                       item.id)
-                        raise RetryException('unable to get item size', sleep_time=0.5)
-                file_name = '{i.name}.{i.type}'.format(i=item)
-                logger.debug('Upload item #%s %s of %d bytes', item.id, file_name, file_size)
-                req = urllib.request.Request(
-                    method='POST',
-                    url='https://photoslibrary.googleapis.com/v1/uploads',
-                    headers={
-                        'Authorization': 'Bearer {}'.format(gcreds.token),
-                        'Content-Length': '0',
-                        'X-Goog-Upload-Command': 'start',
-                        'X-Goog-Upload-Content-Type': 'application/octet-stream',
-                        'X-Goog-Upload-File-Name': file_name,
-                        'X-Goog-Upload-Protocol': 'resumable',
-                        'X-Goog-Upload-Raw-Size': str(file_size),
-                    }
+                status, headers, body = http_request(chunk_req, timeout=60.0)
+            finally:
+                chunks.release(buffer)
+            metrics.observe('upload.chunk_latency', time.perf_counter() - chunk_started)
+            metrics.add('upload.chunks')
+            logger.debug('upload chunk of %d bytes => %d', read, status)
+            if status != http.HTTPStatus.OK:
+                if sessions is not None:
+                    sessions.save(item.id, album_id, session)
+                check_upload_response(status, headers, 'upload chunk')
+            metrics.add('upload.bytes', read)
+            session = session._replace(confirmed_offset=uploaded_bytes)
+            if is_last_chunk:
+                upload_token = body.decode('utf-8')
+                if len(upload_token) == 0:
+                    raise RetryException('unable to get uploaded item token')
+                return upload_token
+            if sessions is not None and time.monotonic() - saved_at >= UPLOAD_SESSION_SAVE_INTERVAL:
+                sessions.save(item.id, album_id, session)
+                saved_at = time.monotonic()
+
+
+def create_google_photos_media_items(album_id, album_google_id, uploaded, zip_files, gclient, db, limiter):
+    """
+    Creates media items for a batch of uploaded items in one API call & updates their status in one transaction.
+    `uploaded` is a list of (item_with_meta, upload_token) pairs. Returns dict item id -> created media item id.
+    """
+    new_media_items = []
+    items_by_token = {}
+    for item_with_meta, upload_token in uploaded:
+        item = item_with_meta.item
+        file_name = '{i.name}.{i.type}'.format(i=item)
+        metadata = item_with_meta.metadata.load_data(zip_files)
+        new_media_items.append({
+            'description': metadata.get('description') or file_name,
+            'simpleMediaItem': {
+                'uploadToken': upload_token
+            }
+        })
+        items_by_token[upload_token] = item
+    body = {'newMediaItems': new_media_items}
+    if album_google_id is not None:
+        body['albumId'] = album_google_id
+
+    def batch_create():
+        response = execute_google_api_request(gclient.mediaItems().batchCreate(body=body), 'to add items to album',
+                                              limiter)
+        if 'newMediaItemResults' not in response:
+            raise RetryException('unable to add items to album: wrong Google API response')
+        return response['newMediaItemResults']
+
+    results = call_with_retries(batch_create, 'creating {} items'.format(len(uploaded)), limiter)
+    if results is None:
+        return {}
+
+    created = []
+    # tokens of failed items may be expired, their sessions are deleted, so the next run uploads them again
+    batch_ids = [item.id for item in items_by_token.values()]
+    for result in results:
+        item = items_by_token.get(result.get('uploadToken'))
+        if item is None:
+            continue
+        media_item = result.get('mediaItem') or {}
+        if 'id' not in media_item:
+            logger.error('Unable to create item %s (#%s), skipping. Error: %s',
+                         item.name, item.id, (result.get('status') or {}).get('message'))
+            continue
+        created.append((media_item['id'], item.id))
+
+    db.executemany("update gphotos_items "
+                   "set status = 'uploaded', google_id = ? "
+                   "where item_id = ? and album_id = ?", [(g, i, album_id) for g, i in created])
+    db.executemany("delete from gphotos_upload_sessions where item_id = ? and album_id = ?",
+                   [(i, album_id) for i in batch_ids])
+    db.commit()
+    return dict((item_id, google_id) for google_id, item_id in created)
+
+
+def add_google_photos_media_items_to_album(album_id, album_google_id, attachments, gclient, db, limiter):
+    """
+    Adds already uploaded media items to album instead of uploading items with the same content again.
+    `attachments` is a list of (item id, google media item id) pairs. Returns ids of attached items.
+    Items without album are already in the library, so only their status is updated.
+    """
+    if album_google_id is not None:
+        in_album = set(row[0] for row in db.execute("select google_id from gphotos_items "
+                                                    "where album_id = ? and status = 'uploaded'", (album_id, )))
+        media_item_ids = sorted(set(google_id for _, google_id in attachments) - in_album)
+        if media_item_ids:
+            def batch_add():
+                return execute_google_api_request(
+                    gclient.albums().batchAddMediaItems(albumId=album_google_id,
+                                                        body={'mediaItemIds': media_item_ids}),
+                    'to add existing items to album', limiter
                 )
-                status, headers, _ = http_request(req)
-                if status != http.HTTPStatus.OK:
-                    raise RetryException('unable to start item upload')
+
+            if call_with_retries(batch_add, 'adding {} existing items'.format(len(media_item_ids)), limiter) is None:
+                return []
+
+    db.executemany("update gphotos_items "
+                   "set status = 'uploaded', google_id = ? "
+                   "where item_id = ? and album_id = ?", [(g, i, album_id) for i, g in attachments])
+    db.commit()
+    return [item_id for item_id, _ in attachments]
+
+
+GOOGLE_PHOTOS_BATCH_SIZE = 50
+
+
+class GooglePhotosUploader:
+    """
+    Uploads items content in worker threads keeping up to `concurrency` uploads in flight.
+    Uploaded items are collected per album & created in batches of up to GOOGLE_PHOTOS_BATCH_SIZE items.
+    Media items are created & DB is updated only in the thread which owns the uploader,
+    so neither DB connection nor google api client are shared between threads.
+    """
+
+    def __init__(self, archive, gclient, gcreds, db, limiter, sessions=None, concurrency=1,
+                 batch_size=GOOGLE_PHOTOS_BATCH_SIZE, duplicates=None, api_url=GOOGLE_PHOTOS_API_URL, buffers=None):
+        self._archive = archive
+        self._gclient = gclient
+        self._gcreds = gcreds
+        self._db = db
+        self._limiter = limiter
+        self._sessions = sessions
+        self._concurrency = concurrency
+        self._batch_size = batch_size
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=concurrency)
+        self._pending = {}
+        self._batches = {}
+        self._progress = {}
+        self._duplicates = duplicates
+        self._api_url = api_url
+        self._buffers = buffers
+        # content key -> items waiting for the item with the same content which is being uploaded
+        self._waiting = {}
+        self._attachments = {}
+        self.skipped_items = 0
+        self.attached_items = 0
+
+    def start_album(self, album_id, album_google_id, title, total_items):
+        self._progress[album_id] = [0, total_items, title]
+        self._batches[album_id] = (album_google_id, [])
+        self._attachments[album_id] = []
+
+    def submit(self, album_id, item_with_meta):
+        item = item_with_meta.item
+        item_row = self._db.execute('select status from gphotos_items where item_id = ? and album_id = ?',
+                                    (item.id, album_id)).fetchone()
+        if item_row[0] != 'none':
+            self._items_done(album_id, 1)
+            return
+        if self._duplicates is not None:
+            key = self._duplicates.key(item.id)
+            if key in self._waiting:
+                self._waiting[key].append((album_id, item.id))
+                return
+            google_id = self._uploaded_google_id(item.id)
+            if google_id is not None:
+                self._attach(album_id, item.id, google_id)
+                return
+            self._waiting[key] = []
+        while len(self._pending) >= self._concurrency:
+            self._wait(concurrent.futures.FIRST_COMPLETED)
+        future = self._executor.submit(profiling.thread_target(upload_item_to_google_photos), self._archive, item,
+                                       self._gcreds, self._limiter, self._sessions, album_id, self._api_url,
+                                       self._buffers)
+        self._pending[future] = (album_id, item_with_meta)
+
+    def flush(self):
+        self._wait(concurrent.futures.ALL_COMPLETED)
+        for album_id in list(self._batches):
+            self._flush_batch(album_id)
+        for album_id in list(self._attachments):
+            self._flush_attachments(album_id)
+
+    def close(self):
+        for future in self._pending:
+            future.cancel()
+        self._executor.shutdown(wait=True)
+
+    def requests_reserve(self):
+        """
+        Estimated number of API requests needed to finish items in flight:
+        upload start or query for every pending item & a batch request for every album with unfinished items
+        """
+        albums = set(album_id for album_id, _ in self._pending.values())
+        albums.update(album_id for album_id, (_, batch) in self._batches.items() if batch)
+        albums.update(album_id for album_id, attachments in self._attachments.items() if attachments)
+        return len(self._pending) + len(albums)
+
+    def _wait(self, return_when):
+        if not self._pending:
+            return
+        done, _ = concurrent.futures.wait(self._pending, return_when=return_when)
+        for future in done:
+            album_id, item_with_meta = self._pending.pop(future)
+            upload_token = future.result()
+            if upload_token is None:
+                self.skipped_items += 1
+                self._items_done(album_id, 1)
+                self._release_waiting(item_with_meta.item.id, None)
+                continue
+            batch = self._batches[album_id][1]
+            batch.append((item_with_meta, upload_token))
+            progress = self._progress[album_id]
+            if len(batch) >= self._batch_size or progress[0] + len(batch) >= progress[1]:
+                self._flush_batch(album_id)
+
+    def _flush_batch(self, album_id):
+        album_google_id, batch = self._batches[album_id]
+        if not batch:
+            return
+        self._batches[album_id] = (album_google_id, [])
+        created = create_google_photos_media_items(album_id, album_google_id, batch, self._archive.zip_files,
+                                                   self._gclient, self._db, self._limiter)
+        self.skipped_items += len(batch) - len(created)
+        self._items_done(album_id, len(batch))
+        for item_with_meta, _ in batch:
+            item_id = item_with_meta.item.id
+            self._release_waiting(item_id, created.get(item_id))
+
+    def _uploaded_google_id(self, item_id):
+        ids = self._duplicates.group(item_id)
+        row = self._db.execute("select google_id from gphotos_items "
+                               "where item_id in ({}) and status = 'uploaded' and google_id is not null "
+                               "limit 1".format(', '.join('?' * len(ids))), ids).fetchone()
+        return row[0] if row else None
+
+    def _release_waiting(self, item_id, google_id):
+        """
+        Items waiting for item with the same content are attached to its media item.
+        If it hasn't been uploaded they are skipped & will be uploaded on the next run.
+        """
+        if self._duplicates is None:
+            return
+        for album_id, waiting_id in self._waiting.pop(self._duplicates.key(item_id), []):
+            if google_id is None:
+                self.skipped_items += 1
+                self._items_done(album_id, 1)
+            else:
+                self._attach(album_id, waiting_id, google_id)
+
+    def _attach(self, album_id, item_id, google_id):
+        attachments = self._attachments[album_id]
+        attachments.append((item_id, google_id))
+        if len(attachments) >= self._batch_size:
+            self._flush_attachments(album_id)
+
+    def _flush_attachments(self, album_id):
+        attachments = self._attachments[album_id]
+        if not attachments:
+            return
+        self._attachments[album_id] = []
+        album_google_id = self._batches[album_id][0]
+        attached = add_google_photos_media_items_to_album(album_id, album_google_id, attachments, self._gclient,
+                                                          self._db, self._limiter)
+        self.attached_items += len(attached)
+        self.skipped_items += len(attachments) - len(attached)
+        self._items_done(album_id, len(attachments))
+
+    def _items_done(self, album_id, count):
+        progress = self._progress[album_id]
+        before = progress[0]
+        progress[0] += count
+        if progress[0] == progress[1]:
+            logger.info('.. %d / %d - Done "%s"', progress[0], progress[1], progress[2])
+        elif progress[0] // 10 != before // 10:
+            logger.info('.. %d / %d "%s"', progress[0], progress[1], progress[2])
+
+
+UPLOAD_ORDERS = ('album', 'smallest', 'date', 'priority')
+# upload units reordered together per concurrent upload, if sizes are interleaved
+UPLOAD_INTERLEAVE_WINDOW = 4
+
+
+def load_upload_priority(path):
+    """
+    Reads priority list: one entry per line, item id or `album:<album id or title>`.
+    Empty lines & lines starting with # are ignored. Returns list of ('item', id) & ('album', id or title) pairs.
+    """
+    entries = []
+    with open(path, encoding='utf-8') as fp:
+        for line in fp:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            if line.startswith('album:'):
+                entries.append(('album', line[len('album:'):].strip()))
+            elif line.isdigit():
+                entries.append(('item', int(line)))
+            else:
+                raise ValueError('wrong priority list entry: {}'.format(line))
+    return entries
+
+
+def interleave_sizes(units, size, window, group=None):
+    """
+    Reorders every `window` consecutive units alternating the largest & the smallest of them.
+    With `group` key function windows don't cross runs of consecutive units of the same group.
+    """
+    if window < 2:
+        return list(units)
+    runs = [list(run) for _, run in itertools.groupby(units, key=group)] if group is not None else [units]
+    result = []
+    for run in runs:
+        for start in range(0, len(run), window):
+            ordered = sorted(run[start:start + window], key=size)
+            low, high = 0, len(ordered) - 1
+            while low <= high:
+                result.append(ordered[high])
+                high -= 1
+                if low <= high:
+                    result.append(ordered[low])
+                    low += 1
+    return result
+
+
+class UploadScheduler:
+    """
+    Orders pending (album id, item id) units of gphotos_items work queue by `order` policy:
+
+      * album - albums in creation order, then items without albums
+      * smallest - the smallest files first, for the most items uploaded per day
+      * date - items taken within `date_range` first, oldest first, then the rest in album order
+      * priority - items & albums of `priority` list first in listed order, then the rest in album order
+
+    Except for smallest-first, sizes are interleaved within windows of `interleave_window` units,
+    so large videos don't occupy all upload threads at once & small items keep the pipe full.
+    Windows don't cross album runs, so albums are still started in order & items of one album stay together.
+    """
+
+    def __init__(self, archive, db, order='album', priority=None, date_range=None, interleave_window=0):
+        if order not in UPLOAD_ORDERS:
+            raise ValueError('unknown upload order {}'.format(order))
+        self._archive = archive
+        self._order = order
+        self._priority = priority or []
+        self._date_range = date_range
+        self._interleave_window = interleave_window
+        self._sizes = {}
+        pending = collections.defaultdict(set)
+        for item_id, album_id in db.execute("select item_id, album_id from gphotos_items where status = 'none'"):
+            pending[album_id].add(item_id)
+        self.pending_counts = collections.Counter({album_id: len(ids) for album_id, ids in pending.items()})
+        self._album_ids = [row[0] for row in db.execute('select album_id from gphotos_albums order by seq_id')]
+        self._pending = pending
+
+    def units(self):
+        units = []
+        for album_id in self._album_ids + [NO_ALBUM]:
+            items = set(self._pending.get(album_id) or ())
+            if not items:
+                continue
+            ids = self._archive.albums[album_id].items_ids if album_id != NO_ALBUM \
+                else self._archive.items_without_albums
+            for item_id in ids:
+                if item_id in items:
+                    items.discard(item_id)
+                    units.append((album_id, item_id))
+
+        if self._order == 'smallest':
+            return sorted(units, key=self.size)
+        if self._order == 'date':
+            units = self._date_order(units)
+        elif self._order == 'priority':
+            units = self._priority_order(units)
+        return interleave_sizes(units, self.size, self._interleave_window, group=operator.itemgetter(0))
+
+    def size(self, unit):
+        item_id = unit[1]
+        size = self._sizes.get(item_id)
+        if size is None:
+            size = self._sizes[item_id] = self._archive.zip_files.file_size(self._archive.matched[item_id].item.file)
+        return size
+
+    def _date_order(self, units):
+        date_from, date_to = self._date_range or (None, None)
+        in_range = []
+        rest = []
+        for unit in units:
+            # date_taken is indexed as 'YYYY-MM-DD hh:mm:ss', so dates are compared as strings
+            taken = (self._archive.matched[unit[1]].metadata.date_taken or '')[:10]
+            if taken and (date_from is None or taken >= date_from) and (date_to is None or taken <= date_to):
+                in_range.append((taken, unit))
+            else:
+                rest.append(unit)
+        in_range.sort(key=operator.itemgetter(0))
+        logger.info('Items taken within date range: %d', len(in_range))
+        return [unit for _, unit in in_range] + rest
+
+    def _priority_order(self, units):
+        item_ranks = {}
+        album_ranks = {}
+        titles = {album.title: album_id for album_id, album in self._archive.albums.items()}
+        for rank, (kind, value) in enumerate(self._priority):
+            if kind == 'item':
+                item_ranks.setdefault(value, rank)
+            elif value in self._archive.albums or value in titles:
+                album_ranks.setdefault(value if value in self._archive.albums else titles[value], rank)
+            else:
+                logger.warning('Album "%s" of priority list not found', value)
+        last = len(self._priority)
+        return sorted(units, key=lambda unit: min(item_ranks.get(unit[1], last), album_ranks.get(unit[0], last)))
+
+
+# mock google photos
+
+MOCK_CHUNK_GRANULARITY = 256 * 1024
+MOCK_SERVER_ERRORS = (500, 502, 503)
+
+
+class MockFaults:
+    """
+    Faults injected by mock Google Photos API into every request. `rate_limited`, `server_errors` & `dropped`
+    are probabilities of 429, 5xx & closing connection without reply. `latency` is mean delay in seconds
+    jittered by ±50%. Upload sessions get chunk granularity randomly chosen from `granularities`.
+    """
+
+    def __init__(self, latency=0.0, rate_limited=0.0, server_errors=0.0, dropped=0.0,
+                 granularities=(MOCK_CHUNK_GRANULARITY, ), retry_after=1.0, seed=None):
+        self.latency = latency
+        self.rate_limited = rate_limited
+        self.server_errors = server_errors
+        self.dropped = dropped
+        self.granularities = tuple(granularities)
+        self.retry_after = retry_after
+        self.seed = seed
+
+
+class MockUploadSession:
+
+    def __init__(self, session_id, file_size, granularity):
+        self.id = session_id
+        self.file_size = file_size
+        self.granularity = granularity
+        self.received = 0
+        self.upload_token = None
+
+    def receive(self, offset, data, finalize):
+        """Returns HTTP status of chunk upload. Only the last chunk may be not a multiple of granularity"""
+        if self.upload_token is not None or offset != self.received:
+            return http.HTTPStatus.BAD_REQUEST
+        if finalize and offset + len(data) != self.file_size:
+            return http.HTTPStatus.BAD_REQUEST
+        if not finalize and len(data) % self.granularity != 0:
+            return http.HTTPStatus.BAD_REQUEST
+        self.received += len(data)
+        if finalize:
+            self.upload_token = 'upload-token-{}'.format(self.id)
+        return http.HTTPStatus.OK
+
+
+class MockGooglePhotosState:
+
+    def __init__(self, seed=None):
+        self.lock = threading.Lock()
+        self.random = random.Random(seed)
+        self.sessions = []
+        self.tokens = {}
+        self.albums = set()
+        self.media_items = 0
+        self.album_additions = 0
+        self.uploaded_bytes = 0
+        self.requests = 0
+        self.rejected_chunks = 0
+        self.faults = collections.Counter()
+
+    def log_stats(self):
+        logger.info('Mock Google Photos API: %d requests, %d upload sessions, %.1f MB uploaded, %d rejected chunks, '
+                    '%d media items, %d albums, %d items added to albums', self.requests, len(self.sessions),
+                    self.uploaded_bytes / 1e6, self.rejected_chunks, self.media_items, len(self.albums),
+                    self.album_additions)
+        logger.info('Injected faults: %s', ', '.join('{} {}'.format(name, count)
+                                                     for name, count in sorted(self.faults.items())) or 'none')
+
+
+def mock_discovery_document(root_url):
+    """Minimal photoslibrary v1 discovery document with methods used by upload"""
+
+    def method(name, path, request, response, parameters=None):
+        return {
+            'id': 'photoslibrary.' + name,
+            'path': path,
+            'flatPath': path,
+            'httpMethod': 'POST',
+            'parameters': parameters or {},
+            'parameterOrder': sorted(parameters or {}),
+            'request': {'$ref': request},
+            'response': {'$ref': response},
+        }
+
+    album_id = {'albumId': {'type': 'string', 'required': True, 'location': 'path', 'pattern': '^[^/]+$'}}
+    schemas = ('CreateAlbumRequest', 'Album', 'BatchCreateMediaItemsRequest', 'BatchCreateMediaItemsResponse',
+               'BatchAddMediaItemsToAlbumRequest', 'BatchAddMediaItemsToAlbumResponse')
+    return {
+        'kind': 'discovery#restDescription',
+        'discoveryVersion': 'v1',
+        'id': 'photoslibrary:v1',
+        'name': 'photoslibrary',
+        'version': 'v1',
+        'protocol': 'rest',
+        'rootUrl': root_url,
+        'servicePath': '',
+        'baseUrl': root_url,
+        'batchPath': 'batch',
+        'parameters': {},
+        'schemas': {name: {'id': name, 'type': 'object'} for name in schemas},
+        'resources': {
+            'albums': {'methods': {
+                'create': method('albums.create', 'v1/albums', 'CreateAlbumRequest', 'Album'),
+                'batchAddMediaItems': method('albums.batchAddMediaItems', 'v1/albums/{+albumId}:batchAddMediaItems',
+                                             'BatchAddMediaItemsToAlbumRequest', 'BatchAddMediaItemsToAlbumResponse',
+                                             album_id),
+            }},
+            'mediaItems': {'methods': {
+                'batchCreate': method('mediaItems.batchCreate', 'v1/mediaItems:batchCreate',
+                                      'BatchCreateMediaItemsRequest', 'BatchCreateMediaItemsResponse'),
+            }},
+        },
+    }
+
+
+class MockGooglePhotosHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Resumable uploads, mediaItems:batchCreate, albums & albums:batchAddMediaItems of Google Photos API.
+    Every API & upload request may be delayed or fail with a fault from server's MockFaults.
+    """
+    protocol_version = 'HTTP/1.1'
+    # headers & body are written separately, Nagle's algorithm would delay every reply
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        if urllib.parse.urlsplit(self.path).path == '/$discovery/rest':
+            self._reply_json(mock_discovery_document(self._base_url() + '/'))
+        else:
+            self._reply(http.HTTPStatus.NOT_FOUND)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        path = urllib.parse.urlsplit(self.path).path
+        state = self.server.state
+        if not self.headers.get('Authorization'):
+            return self._reply(http.HTTPStatus.UNAUTHORIZED)
+        fault = self._inject_fault(state)
+        if fault == 'rate_limited':
+            return self._reply(http.HTTPStatus.TOO_MANY_REQUESTS,
+                               headers={'Retry-After': '{:g}'.format(self.server.faults.retry_after)})
+        if fault == 'server_error':
+            with state.lock:
+                status = state.random.choice(MOCK_SERVER_ERRORS)
+            return self._reply(status)
+        if path.startswith('/v1/uploads/'):
+            return self._upload(state, path[len('/v1/uploads/'):], body, dropped=fault == 'dropped')
+        if fault == 'dropped':
+            self.close_connection = True
+            return
+        if path == '/v1/uploads':
+            self._start_upload(state)
+        elif path == '/v1/mediaItems:batchCreate':
+            self._batch_create(state, json.loads(body.decode('utf-8')))
+        elif path == '/v1/albums':
+            with state.lock:
+                album_id = 'album-{}'.format(len(state.albums) + 1)
+                state.albums.add(album_id)
+            self._reply_json({'id': album_id, 'title': json.loads(body.decode('utf-8'))['album']['title']})
+        elif path.startswith('/v1/albums/') and path.endswith(':batchAddMediaItems'):
+            album_id = path[len('/v1/albums/'):-len(':batchAddMediaItems')]
+            with state.lock:
+                known = album_id in state.albums
+                if known:
+                    state.album_additions += len(json.loads(body.decode('utf-8'))['mediaItemIds'])
+            if known:
+                self._reply_json({})
+            else:
+                self._reply(http.HTTPStatus.NOT_FOUND)
+        else:
+            self._reply(http.HTTPStatus.NOT_FOUND)
+
+    def _inject_fault(self, state):
+        faults = self.server.faults
+        with state.lock:
+            state.requests += 1
+            delay = faults.latency * state.random.uniform(0.5, 1.5)
+            roll = state.random.random()
+        if delay > 0:
+            time.sleep(delay)
+        fault = None
+        if roll < faults.dropped:
+            fault = 'dropped'
+        elif roll < faults.dropped + faults.rate_limited:
+            fault = 'rate_limited'
+        elif roll < faults.dropped + faults.rate_limited + faults.server_errors:
+            fault = 'server_error'
+        if fault is not None:
+            with state.lock:
+                state.faults[fault] += 1
+        return fault
+
+    def _start_upload(self, state):
+        try:
+            file_size = int(self.headers['X-Goog-Upload-Raw-Size'])
+        except (TypeError, ValueError):
+            return self._reply(http.HTTPStatus.BAD_REQUEST)
+        with state.lock:
+            granularity = state.random.choice(self.server.faults.granularities)
+            session = MockUploadSession(len(state.sessions), file_size, granularity)
+            state.sessions.append(session)
+        self._reply(http.HTTPStatus.OK, headers={
+            'X-Goog-Upload-Status': 'active',
+            'X-Goog-Upload-URL': '{}/v1/uploads/{}'.format(self._base_url(), session.id),
+            'X-Goog-Upload-Chunk-Granularity': str(granularity),
+        })
+
+    def _upload(self, state, session_id, body, dropped):
+        """Dropped chunk is partially received, so client has to query the offset to resume upload"""
+        commands = [c.strip() for c in self.headers.get('X-Goog-Upload-Command', '').split(',')]
+        with state.lock:
+            session = None
+            if session_id.isdigit() and int(session_id) < len(state.sessions):
+                session = state.sessions[int(session_id)]
+            if session is None:
+                status = http.HTTPStatus.NOT_FOUND
+            elif 'query' in commands:
+                status = http.HTTPStatus.OK
+            else:
+                offset = int(self.headers.get('X-Goog-Upload-Offset') or 0)
+                if dropped:
+                    body = body[:len(body) // 2 // session.granularity * session.granularity]
+                status = session.receive(offset, body, 'finalize' in commands and not dropped)
+                if status == http.HTTPStatus.OK:
+                    state.uploaded_bytes += len(body)
+                    if session.upload_token is not None:
+                        state.tokens[session.upload_token] = session
                 else:
-                    fp = archive.zip_files.open_file(item.file)
-                    upload_url = headers['X-Goog-Upload-URL']
-                    chunk_size = int(headers['X-Goog-Upload-Chunk-Granularity'])
-                    uploaded_bytes = 0
-                    while True:
-                        chunk_start = uploaded_bytes
-                        if preloaded_body is not None:
-                            chunk_data = preloaded_body[chunk_start:chunk_start+chunk_size]
-                        else:
-                            chunk_data = fp.read(chunk_size)
-                        if len(chunk_data) > chunk_size or chunk_data == b'':
-                            logger.debug('Wrong chunk size on upload #%s %s, expected chunk_size: %d, read size: %d',
-                                         item.id, file_name, chunk_size, len(chunk_data))
-                            raise RetryException('Wrong archive file size', force_size_recalculate=True)
-                        uploaded_bytes += len(chunk_data)
-                        is_last_chunk = uploaded_bytes >= file_size
-                        command = 'upload, finalize' if is_last_chunk else 'upload'
-                        chunk_req = urllib.request.Request(
-                            method='POST',
-                            url=upload_url,
-                            headers={
-                                'Authorization': 'Bearer {}'.format(gcreds.token),
-                                'Content-Length': str(len(chunk_data)),
-                                'X-Goog-Upload-Command': command,
-                                'X-Goog-Upload-Offset': str(chunk_start),
-                            },
-                            data=chunk_data
-                        )
-                        status, headers, body = http_request(chunk_req, timeout=60.0)
-                        logger.debug('upload chunk of %d bytes => %d', len(chunk_data), status)
-                        if status != http.HTTPStatus.OK:
-                            raise RetryException('unable to upload chunk')
-                        if is_last_chunk:
-                            upload_token = body.decode('utf-8')
-                            if len(upload_token) == 0:
-                                raise RetryException('unable to get uploaded item token')
-                            break
-                body = {
-                    'newMediaItems': [{
-                        'description': meta_json.get('description') or file_name,
-                        'simpleMediaItem': {
-                            'uploadToken': upload_token
-                        }
-                    }]
-                }
-                if album_google_id is not None:
-                    body['albumId'] = album_google_id
-                try:
-                    response = gclient.mediaItems().batchCreate(body=body).execute()
-                    item_google_id = response['newMediaItemResults'][0]['mediaItem']['id']
-                except KeyError:
-                    raise RetryException('unable to add item to album: wrong Google API response')
-                except googleapiclient.errors.HttpError as e:
-                    if e.resp.status == http.HTTPStatus.TOO_MANY_REQUESTS:
-                        raise GoogleAPILimitReached()
-                    else:
-                        raise RetryException('unable to add item to album: {}'.format(e))
+                    state.rejected_chunks += 1
+        if dropped:
+            self.close_connection = True
+        elif status != http.HTTPStatus.OK:
+            self._reply(status)
+        elif session.upload_token is not None:
+            self._reply(status, session.upload_token.encode('ascii'), {'X-Goog-Upload-Status': 'final'})
+        else:
+            self._reply(status, headers={'X-Goog-Upload-Status': 'active',
+                                         'X-Goog-Upload-Size-Received': str(session.received)})
+
+    def _batch_create(self, state, body):
+        new_items = body.get('newMediaItems') or []
+        album_id = body.get('albumId')
+        results = []
+        with state.lock:
+            if len(new_items) > GOOGLE_PHOTOS_BATCH_SIZE or (album_id is not None and album_id not in state.albums):
+                results = None
+            else:
+                for new_item in new_items:
+                    token = new_item['simpleMediaItem']['uploadToken']
+                    if state.tokens.pop(token, None) is None:
+                        results.append({'uploadToken': token, 'status': {'code': 3, 'message': 'Invalid token'}})
+                        continue
+                    state.media_items += 1
+                    results.append({'uploadToken': token, 'status': {'message': 'Success'},
+                                    'mediaItem': {'id': 'media-item-{}'.format(state.media_items),
+                                                  'description': new_item.get('description')}})
+        if results is None:
+            self._reply(http.HTTPStatus.BAD_REQUEST)
+        else:
+            self._reply_json({'newMediaItemResults': results})
+
+    def _base_url(self):
+        host = self.headers.get('Host')
+        return 'http://' + host if host else self.server.url
+
+    def _reply_json(self, data):
+        self._reply(http.HTTPStatus.OK, json.dumps(data).encode('utf-8'), {'Content-Type': 'application/json'})
+
+    def _reply(self, status, body=b'', headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug('mock google photos: ' + format, *args)
+
+
+class MockGooglePhotosServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    """
+    Local stand-in for Google Photos API. Used as context manager it serves requests in background thread:
+
+        with MockGooglePhotosServer(faults=MockFaults(server_errors=0.01)) as server:
+            upload_to_google_photos(..., api_url=server.url)
+    """
+    daemon_threads = True
+
+    def __init__(self, host='127.0.0.1', port=0, faults=None):
+        super().__init__((host, port), MockGooglePhotosHandler)
+        self.faults = faults or MockFaults()
+        self.state = MockGooglePhotosState(self.faults.seed)
+        self.url = 'http://{}:{}'.format(host, self.server_address[1])
+        self._thread = None
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self.serve_forever, name='mock-google-photos', daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+        self.server_close()
+        self._thread.join()
+
+
+# extract
+
+EXTRACT_MANIFEST_NAME = '.flickr_archive_extractor_manifest'
+EXTRACT_BUFFER_SIZE = 4 * 1024 * 1024
+EXTRACT_ALBUMS_DIR = 'album'
+EXTRACT_UNSORTED_DIR = 'unsorted'
+
+
+class ExtractManifest:
+    """
+    Size, CRC and mtime of files written by previous extractions. File with the same size & mtime
+    as recorded isn't read again to check its CRC.
+    """
+
+    def __init__(self, db):
+        self._db = db
+        self._db.execute(
+            "create table if not exists extracted_files ("
+            "  path text primary key,"
+            "  size integer not null,"
+            "  crc integer not null,"
+            "  mtime integer not null"
+            ")"
+        )
+        self._db.commit()
 
-                if album_id is not None:
-                    db.execute("update gphotos_items "
-                               "set status = 'uploaded', google_id = ? "
-                               "where item_id = ? and album_id = ?", (item_google_id, item.id, album_id))
+    @classmethod
+    def open(cls, path):
+        import sqlite3
+        return cls(sqlite3.connect(path))
+
+    def load(self):
+        rows = self._db.execute('select path, size, crc, mtime from extracted_files')
+        return {row[0]: tuple(row[1:]) for row in rows}
+
+    def put_many(self, rows):
+        self._db.executemany('insert or replace into extracted_files (path, size, crc, mtime) values (?, ?, ?, ?)',
+                             rows)
+        self._db.commit()
+
+    def close(self):
+        self._db.close()
+
+
+def safe_path_component(name, fallback):
+    name = name.replace('/', '_').replace('\\', '_').replace('\0', '').strip()
+    if name in ('', '.', '..'):
+        return fallback
+    return name
+
+
+def extraction_targets(archive):
+    """Returns dict item id -> list of paths relative to output dir, the first path is the main one"""
+    targets = collections.defaultdict(list)
+    used_titles = set()
+    for album in archive.albums.values():
+        title = safe_path_component(album.title, album.id)
+        if title in used_titles:
+            title = '{} ({})'.format(title, album.id)
+        used_titles.add(title)
+        for item_id in album.items_ids:
+            path = os.path.join(EXTRACT_ALBUMS_DIR, title, archive.items[item_id].file.base_name)
+            if path not in targets[item_id]:
+                targets[item_id].append(path)
+    for item_id in archive.items_without_albums:
+        targets[item_id].append(os.path.join(EXTRACT_UNSORTED_DIR, archive.items[item_id].file.base_name))
+    return targets
+
+
+def plan_extraction(archive, manifest_entries):
+    """
+    Groups extraction tasks by archive. Every task is (path in archive, [(target path, manifest entry)]),
+    tasks are ordered by position in archive, so every archive is read sequentially.
+    """
+    planned = set()
+    tasks = collections.defaultdict(list)
+    for item_id, paths in extraction_targets(archive).items():
+        paths = [path for path in paths if path not in planned]
+        if not paths:
+            # alternative item with swapped name & id shares file with the main one
+            continue
+        planned.update(paths)
+        file = archive.items[item_id].file
+        tasks[file.archive_id].append((file.path, [(path, manifest_entries.get(path)) for path in paths]))
+    for archive_id, archive_tasks in tasks.items():
+        zf = archive.zip_files.archive_by_id(archive_id)
+        archive_tasks.sort(key=lambda task: zf.getinfo(task[0]).header_offset)
+    return tasks
+
+
+def _file_crc(path, view):
+    crc = 0
+    with open(path, 'rb') as fp:
+        while True:
+            read = read_chunk(fp, view)
+            crc = zlib.crc32(view[:read], crc)
+            if read < len(view):
+                return crc
+
+
+def _copy_stream(src, dst, view):
+    while True:
+        read = read_chunk(src, view)
+        dst.write(view[:read])
+        if read < len(view):
+            return
+
+
+def _existing_file_mtime(path, info, known, view):
+    """Returns mtime of existing file if its size & CRC are the same as of archive member, None otherwise"""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    if stat.st_size != info.file_size:
+        return None
+    if known is not None and tuple(known) == (info.file_size, info.CRC, stat.st_mtime_ns):
+        return stat.st_mtime_ns
+    if _file_crc(path, view) == info.CRC:
+        return stat.st_mtime_ns
+    return None
+
+
+def _extract_member(zip_files, file, info, path, view):
+    member_view = zip_files.member_view(file)
+    if member_view is not None:
+        with member_view, open(path, 'wb') as dst:
+            if zlib.crc32(member_view) != info.CRC:
+                raise zipfile.BadZipFile('Bad CRC-32 for file {!r}'.format(file.path))
+            dst.write(member_view)
+    else:
+        with zip_files.open_file(file) as src, open(path, 'wb') as dst:
+            _copy_stream(src, dst, view)
+
+
+def _extract_archive_items(archive_path, tasks, output_dir):
+    """
+    Extracts tasks of one archive. Item is written once, other paths of the item are hardlinked to it
+    (or copied if hardlinks aren't supported). Returns list of (path, size, crc, mtime, action).
+    Corrupted member isn't written, its paths are returned with 'failed' action & None mtime.
+    """
+    results = []
+    view = memoryview(bytearray(EXTRACT_BUFFER_SIZE))
+    with ZipFiles() as zip_files:
+        zip_files.add_archive(0, zipfile.ZipFile(archive_path))
+        for member, targets in tasks:
+            file = ArchiveFile(0, member)
+            info = zip_files.getinfo(file)
+            source = None
+            missing = []
+            for path, known in targets:
+                mtime = _existing_file_mtime(os.path.join(output_dir, path), info, known, view)
+                if mtime is None:
+                    missing.append(path)
                 else:
-                    db.execute("update gphotos_items "
-                               "set status = 'uploaded', google_id = ? "
-                               "where item_id = ? and album_id is null", (item_google_id, item.id))
-                db.commit()
-                break
-            except RetryException as e:
-                retry += 1
-                sleep_time = e.sleep_time * retry
-                if e.force_size_recalculate is not None:
-                    recalculate_size = e.force_size_recalculate
-                if retry < 5:
-                    logger.warning('Retrying uploading item %s (#%s). Error: %s', item.name, item.id, e)
+                    source = source or path
+                    results.append((path, info.file_size, info.CRC, mtime, 'skipped'))
+            for i, path in enumerate(missing):
+                full_path = os.path.join(output_dir, path)
+                tmp_path = full_path + '.part'
+                os.makedirs(os.path.dirname(full_path), exist_ok=True)
+                if os.path.lexists(tmp_path):
+                    os.remove(tmp_path)
+                if source is None:
+                    action = 'extracted'
+                    try:
+                        _extract_member(zip_files, file, info, tmp_path, view)
+                    except (zipfile.BadZipFile, zlib.error, EOFError) as e:
+                        if os.path.lexists(tmp_path):
+                            os.remove(tmp_path)
+                        logger.error('Unable to extract %s from %s: %s', member, archive_path, e)
+                        results.extend((p, info.file_size, info.CRC, None, 'failed') for p in missing[i:])
+                        break
                 else:
-                    logger.error('Unable to upload item %s (#%s), skipping. Last error was: %s',
-                                 item.name, item.id, e)
-    return item_google_id
+                    try:
+                        os.link(os.path.join(output_dir, source), tmp_path)
+                        action = 'linked'
+                    except OSError:
+                        action = 'copied'
+                        with open(os.path.join(output_dir, source), 'rb') as src, open(tmp_path, 'wb') as dst:
+                            _copy_stream(src, dst, view)
+                os.replace(tmp_path, full_path)
+                source = source or path
+                results.append((path, info.file_size, info.CRC, os.stat(full_path).st_mtime_ns, action))
+    return results
+
+
+def extract_archive(archive, output_dir, jobs=1):
+    """Extracts matched items to album/<title>/ and unsorted/ dirs, returns counter of actions & bytes"""
+    os.makedirs(output_dir, exist_ok=True)
+    manifest = ExtractManifest.open(os.path.join(output_dir, EXTRACT_MANIFEST_NAME))
+    stats = collections.Counter()
+    try:
+        tasks = plan_extraction(archive, manifest.load())
+        archive_ids = sorted(tasks.keys())
+        archive_paths = [archive.zip_files.archive_by_id(archive_id).filename for archive_id in archive_ids]
+
+        def collect(results):
+            for done, (archive_path, archive_results) in enumerate(zip(archive_paths, results), 1):
+                manifest.put_many(row[0:4] for row in archive_results if row[4] != 'failed')
+                for _, size, _, _, action in archive_results:
+                    stats[action] += 1
+                    if action != 'skipped':
+                        stats[action + '_bytes'] += size
+                logger.info('.. %d / %d archives - Done "%s"', done, len(archive_paths), archive_path)
+
+        task_lists = [tasks[archive_id] for archive_id in archive_ids]
+        output_dirs = [output_dir] * len(archive_ids)
+        if jobs > 1 and len(archive_ids) > 1:
+            logger.debug('Extracting %d archives in %d processes', len(archive_ids), jobs)
+            with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+                collect(profiling.map(executor, _extract_archive_items, archive_paths, task_lists, output_dirs))
+        else:
+            collect(map(_extract_archive_items, archive_paths, task_lists, output_dirs))
+    finally:
+        manifest.close()
+    return stats
 
 
 # actions
 
 
-def load_archives_and_log_info(archive_globs):
+def load_archives_and_log_info(archive_globs, index_cache_path=None, jobs=1):
     archives_paths, wrong_paths = list_archives(archive_globs)
 
     logger.info('Archives globs:\n * {}'.format('\n * '.join(archive_globs)))
@@ -648,8 +3773,13 @@ def load_archives_and_log_info(archive_globs):
     if wrong_paths:
         logger.warning('Wrong paths:\n * {}'.format('\n * '.join(wrong_paths)))
 
+    index_cache = IndexCache.open(index_cache_path) if index_cache_path else None
     logger.info('Indexing archives ...')
-    archive = FlickrArchive.build(archives_paths)
+    try:
+        archive = FlickrArchive.build(archives_paths, index_cache=index_cache, jobs=jobs)
+    finally:
+        if index_cache is not None:
+            index_cache.close()
     logger.info('Index has been built')
 
     logger.info('Valid items found (items with matched metadata): {}'.format(len(archive.matched)))
@@ -661,8 +3791,10 @@ def load_archives_and_log_info(archive_globs):
     return archive
 
 
-def check(archive_globs, samples_size=30):
-    archive = load_archives_and_log_info(archive_globs)
+def check(archive_globs, samples_size=30, index_cache_path=None, jobs=1, dedup=False, verify_content=False,
+          report_path=None, report_summary_only=False):
+    """Checks all archives. Results are saved to index cache, so the next check may be incremental"""
+    archive = load_archives_and_log_info(archive_globs, index_cache_path, jobs)
 
     logger.info('Items found: {}'.format(len(archive.items)))
     logger.info('Items metadata found: {}'.format(len(archive.items_metadata)))
@@ -705,23 +3837,226 @@ def check(archive_globs, samples_size=30):
             'missed items in albums'
         )
 
+    duplicates = None
+    if dedup:
+        duplicates = find_content_duplicates(archive, index_cache_path)
+        log_sample(
+            sample(duplicates.groups, samples_size),
+            len(duplicates.groups),
+            lambda group: ', '.join('id={id} ({an}: {f.path})'.format(
+                id=item_id, f=archive.items[item_id].file,
+                an=archive.items[item_id].file.archive_name(archive.zip_files)) for item_id in group),
+            'groups of items with the same content'
+        )
+
+    verification = None
+    if verify_content:
+        verification = log_content_verification(archive.zip_files, index_cache_path, jobs, samples_size)
+
+    if report_path:
+        counts = write_jsonl_report(report_path, iter_check_findings(archive, duplicates, verification),
+                                    summary_only=report_summary_only)
+        logger.info('Report with %d findings has been written to %s', sum(counts.values()), report_path)
+
+    if index_cache_path:
+        index_cache = IndexCache.open(index_cache_path)
+        if index_cache is not None:
+            CheckState.from_archive(archive, archive_fingerprints(archive.zip_files)).save(index_cache)
+            index_cache.close()
+    archive.zip_files.close()
+    return archive
+
+
+def iter_check_findings(archive, duplicates=None, verification=None):
+    """Yields check findings one by one as dicts with `kind` key, nothing is accumulated"""
+    for item in archive.without_metadata.values():
+        yield {'kind': 'item_without_metadata', 'id': item.id,
+               'archive': item.file.archive_name(archive.zip_files), 'path': item.file.path}
+    for metadata in archive.without_items.values():
+        yield {'kind': 'item_without_original', 'id': metadata.id, 'page_url': metadata.page_url}
+    for metadata in archive.unprocessed_videos_metadata.values():
+        yield {'kind': 'unprocessed_video', 'id': metadata.id, 'page_url': metadata.page_url}
+    if not archive.albums:
+        yield {'kind': 'albums_not_found'}
+    for album_id, item_id in archive.wrong_items_in_albums:
+        yield {'kind': 'wrong_album_item', 'album_id': album_id, 'item_id': item_id}
+    for album_id, item_id in archive.missed_items_in_albums:
+        yield {'kind': 'missed_album_item', 'album_id': album_id, 'item_id': item_id,
+               'album_url': archive.albums[album_id].url}
+    for item_id, kind, first, duplicate in archive.duplicate_items:
+        yield {'kind': 'duplicate_' + kind, 'id': item_id,
+               'archive': first.archive_name(archive.zip_files), 'path': first.path,
+               'duplicate_archive': duplicate.archive_name(archive.zip_files), 'duplicate_path': duplicate.path}
+    for group in (duplicates.groups if duplicates is not None else ()):
+        yield {'kind': 'duplicate_content', 'ids': group}
+    for path, result, _ in (verification or ()):
+        for member, error in result.errors:
+            yield {'kind': 'broken_member', 'archive': path.split('/')[-1], 'path': member, 'error': error}
+
+
+def write_jsonl_report(path, findings, summary_only=False):
+    """
+    Streams findings to JSON Lines file, one finding per line, and appends summary line
+    {"kind": "summary", "counts": {kind: count}}. With `summary_only` only the summary is written.
+    Returns counter of findings kinds.
+    """
+    counts = collections.Counter()
+    encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'))
+    with open(path, 'w', encoding='utf-8', buffering=1024 * 1024) as fp:
+        for finding in findings:
+            counts[finding['kind']] += 1
+            if not summary_only:
+                fp.write(encoder.encode(finding))
+                fp.write('\n')
+        fp.write(encoder.encode({'kind': 'summary', 'counts': dict(sorted(counts.items()))}))
+        fp.write('\n')
+    return counts
+
+
+def archive_fingerprints(zip_files):
+    """Returns dict absolute archive path -> ArchiveFingerprint"""
+    fingerprints = {}
+    for archive_id in zip_files.ids():
+        zf = zip_files.archive_by_id(archive_id)
+        fingerprints[os.path.abspath(zf.filename)] = ArchiveFingerprint.of(zf.filename, zf)
+    return fingerprints
+
+
+def check_incremental(archive_globs, samples_size=30, index_cache_path=None, jobs=1, verify_content=False):
+    """
+    Checks only archives added since the previous check & logs what has changed.
+    Falls back to a full check if there is no previous state or previously checked archives have changed.
+    """
+    index_cache = IndexCache.open(index_cache_path) if index_cache_path else None
+    if index_cache is None:
+        logger.error('Incremental check requires index cache')
+        return None
+    state = CheckState.load(index_cache)
+    if state is None:
+        index_cache.close()
+        logger.info('Previous check not found, checking all archives')
+        return check(archive_globs, samples_size, index_cache_path, jobs, verify_content=verify_content)
+
+    archives_paths, wrong_paths = list_archives(archive_globs)
+    if wrong_paths:
+        logger.warning('Wrong paths:\n * {}'.format('\n * '.join(wrong_paths)))
+    current = set(os.path.abspath(path) for path in archives_paths)
+    changed = []
+    for path, fingerprint in state.archives.items():
+        stat = os.stat(path) if path in current else None
+        if stat is None or (stat.st_size, stat.st_mtime_ns) != tuple(fingerprint[0:2]):
+            changed.append(path)
+    new_paths = [path for path in archives_paths if os.path.abspath(path) not in state.archives]
+
+    if changed:
+        index_cache.close()
+        logger.info('Archives changed or removed since the previous check: %d, checking all archives',
+                    len(changed))
+        archive = check(archive_globs, samples_size, index_cache_path, jobs, verify_content=verify_content)
+        new_state = CheckState.from_archive(archive, archive_fingerprints(archive.zip_files))
+        log_check_changes(CheckState.diff(state, new_state), new_state, samples_size)
+        return archive
+
+    try:
+        logger.info('Archives checked before: %d, new: %d', len(state.archives), len(new_paths))
+        if new_paths:
+            logger.debug('New archives:\n * {}'.format('\n * '.join(new_paths)))
+            zip_files, indexes = FlickrArchive.index(new_paths, index_cache, jobs)
+            changes = state.apply([(zip_files.archive_by_id(archive_id), entries)
+                                   for archive_id, entries in enumerate(indexes)],
+                                  archive_fingerprints(zip_files))
+            changes = {item_id: change for item_id, change in changes.items() if change[0] != change[1]}
+            log_check_changes(changes, state, samples_size)
+            state.save(index_cache)
+    finally:
+        index_cache.close()
+    if new_paths:
+        with zip_files:
+            if verify_content:
+                log_content_verification(zip_files, index_cache_path, jobs, samples_size)
+
+    logger.info('Valid items: %d, items without metadata: %d, items without an original file: %d',
+                len(state.matched), len(state.without_metadata), len(state.without_items))
+    return state
+
+
+def log_content_verification(zip_files, index_cache_path=None, jobs=1, samples_size=30):
+    logger.info('Verifying archives content ...')
+    index_cache = IndexCache.open(index_cache_path) if index_cache_path else None
+    started = time.monotonic()
+    try:
+        results = verify_archives_content(zip_files, index_cache, jobs)
+    finally:
+        if index_cache is not None:
+            index_cache.close()
+    elapsed = max(time.monotonic() - started, 1e-6)
+
+    verified_bytes = 0
+    corrupted = 0
+    for path, verification, cached in results:
+        name = path.split('/')[-1]
+        if not cached:
+            verified_bytes += verification.bytes
+        if verification.errors:
+            corrupted += 1
+        logger.info('%s %s: %d members, %.1f MB%s, errors: %d',
+                    '⚠️ ' if verification.errors else '✅', name, verification.members, verification.bytes / 1e6,
+                    ' (unchanged since the last verification)' if cached
+                    else ', {:.1f} MB/s'.format(verification.bytes / 1e6 / max(verification.elapsed, 1e-6)),
+                    len(verification.errors))
+        if verification.errors:
+            log_sample(
+                sample(verification.errors, samples_size),
+                len(verification.errors),
+                lambda error: '{}: {}'.format(error[0], error[1]),
+                'broken members in {}'.format(name)
+            )
+
+    logger.info('Archives verified: %d, unchanged: %d, with errors: %d. Decompressed %.1f MB in %.1f s (%.1f MB/s)',
+                sum(1 for r in results if not r[2]), sum(1 for r in results if r[2]), corrupted,
+                verified_bytes / 1e6, elapsed, verified_bytes / 1e6 / elapsed)
+    return results
+
+
+def _start_album_upload(album_id, album_row, archive, uploader, total_items, gclient, db, limiter):
+    """Creates album if needed & starts its upload progress. Returns google album id or None if it wasn't created"""
+    if album_id == NO_ALBUM:
+        logger.info('Uploading %d items without albums', total_items)
+        uploader.start_album(NO_ALBUM, None, 'without albums', total_items)
+        return None
+
+    album = archive.albums[album_id]
+    album_google_id = create_google_photos_album(album, album_status=album_row[0], album_google_id=album_row[1],
+                                                 gclient=gclient, db=db, limiter=limiter)
+    if album_google_id is not None:
+        logger.info('Uploading %d items for album "%s" (%s)',
+                    total_items, album.title, album.created.strftime('%Y-%m-%d'))
+        uploader.start_album(album_id, album_google_id, album.title, total_items)
+    return album_google_id
+
 
-def upload_to_google_photos(archive_globs, db_path):
-    archive = load_archives_and_log_info(archive_globs)
+def upload_to_google_photos(archive_globs, db_path, credentials_path, index_cache_path=None, jobs=1, concurrency=1,
+                            limiter=None, dedup=False, api_url=GOOGLE_PHOTOS_API_URL, buffers=None, order='album',
+                            priority=None, date_range=None, interleave=True):
+    archive = load_archives_and_log_info(archive_globs, index_cache_path, jobs)
+    duplicates = find_content_duplicates(archive, index_cache_path) if dedup else None
 
     db_dir = os.path.dirname(db_path)
     if not os.path.exists(db_dir):
         os.makedirs(db_dir, mode=0o755, exist_ok=True)
     db = init_db(db_path)
     if db is None:
+        archive.zip_files.close()
         return 1
 
-    gcreds, gclient = init_google_photos_api(args.app_credentials, db)
+    gcreds, gclient = init_google_photos_api(credentials_path, db, api_url)
     if gclient is None:
+        archive.zip_files.close()
         return 1
 
     logger.info('Preparing to upload albums ...')
-    albums_existed, albums_created = init_albums_to_upload_to_google_photos(archive.albums, db)
+    with metrics.phase('upload.db_init'):
+        albums_existed, albums_created = init_albums_to_upload_to_google_photos(archive.albums, db)
 
     if albums_existed > 0:
         logger.info('Albums to upload found in DB: %d', albums_existed)
@@ -729,65 +4064,183 @@ def upload_to_google_photos(archive_globs, db_path):
         logger.info('Albums to upload added: %d', albums_created)
 
     logger.info('Preparing to upload items ...')
-    items_existed, items_created = init_items_to_upload_to_google_photos(
-        archive.matched, archive.item_to_albums_index, db
-    )
+    with metrics.phase('upload.db_init'):
+        items_existed, items_created = init_items_to_upload_to_google_photos(
+            archive.matched, archive.item_to_albums_index, db
+        )
 
     if items_existed > 0:
         logger.info('Items to upload found in DB: %d', items_existed)
     if items_created > 0:
         logger.info('Items to upload added: %d', items_created)
 
-    albums = db.execute('select album_id, status, google_id from gphotos_albums order by seq_id').fetchall()
-    skipped_items = 0
+    if limiter is None:
+        limiter = GoogleAPIRateLimiter()
+    if buffers is None:
+        buffers = ChunkBufferPool()
+    albums = dict((row[0], row[1:]) for row in db.execute('select album_id, status, google_id from gphotos_albums'))
+    scheduler = UploadScheduler(archive, db, order, priority, date_range,
+                                interleave_window=UPLOAD_INTERLEAVE_WINDOW * concurrency if interleave else 0)
+    logger.info('Scheduling %d items to upload, order: %s', sum(scheduler.pending_counts.values()), order)
+    units = scheduler.units()
     skipped_albums = 0
-    for album_row in albums:
-        album_id = album_row[0]
-        album = archive.albums[album_id]
-        total_items = len(album.items_ids)
-
-        album_google_id = create_google_photos_album(album, album_status=album_row[1], album_google_id=album_row[2],
-                                                     gclient=gclient, db=db)
-
-        if album_google_id is None:
-            skipped_albums += 1
-            skipped_items += total_items
-            continue
-
-        logger.info('Uploading %d items for album "%s" (%s)',
-                    total_items, album.title, album.created.strftime('%Y-%m-%d'))
-
-        for index, item_id in enumerate(album.items_ids):
-            item = archive.matched[item_id]
-            if upload_item_to_google_photos(archive, album_id, album_google_id, item, gclient, gcreds, db) is None:
-                skipped_items += 1
-            if index != 0 and index % 10 == 0:
-                logger.info('.. %d / %d', index, total_items)
-        logger.info('.. %d / %d - Done', total_items, total_items)
-
-    total_items = len(archive.items_without_albums)
-    logger.info('Uploading %d items without albums', total_items)
-
-    for index, item_id in enumerate(archive.items_without_albums):
-        item = archive.matched[item_id]
-        if upload_item_to_google_photos(archive, None, None, item, gclient, gcreds, db) is None:
-            skipped_items += 1
-        if index != 0 and index % 10 == 0:
-            logger.info('.. %d / %d', index, total_items)
-
-    logger.info('.. %d / %d - Done', total_items, total_items)
+    # album id -> google album id, None if album can't be created
+    started_albums = {}
+    quota_spent = False
+    quota_wait_logged = False
+    sessions = UploadSessions(db_path)
+    uploader = GooglePhotosUploader(archive, gclient, gcreds, db, limiter, sessions, concurrency,
+                                    duplicates=duplicates, api_url=api_url, buffers=buffers)
+    try:
+        with profiling('upload'):
+            for position, (album_id, item_id) in enumerate(units):
+                album_started = album_id in started_albums
+                needed = 1 if album_started or album_id == NO_ALBUM or albums[album_id][0] != 'none' else 2
+                remaining = limiter.remaining_quota()
+                if remaining is not None and remaining < uploader.requests_reserve() + needed:
+                    # uploaded items are created before quota is spent, so upload tokens don't expire
+                    uploader.flush()
+                    if not limiter.wait_for_quota:
+                        logger.warning('Daily quota is spent, %d items are left for the next run',
+                                       len(units) - position)
+                        quota_spent = True
+                        break
+                    if remaining < needed and not quota_wait_logged:
+                        logger.info('Daily quota is spent, the next items will be uploaded in the next 24h')
+                        quota_wait_logged = True
+                elif quota_wait_logged:
+                    quota_wait_logged = False
+
+                if not album_started:
+                    started_albums[album_id] = _start_album_upload(album_id, albums.get(album_id), archive, uploader,
+                                                                   scheduler.pending_counts[album_id], gclient, db,
+                                                                   limiter)
+                    if started_albums[album_id] is None and album_id != NO_ALBUM:
+                        skipped_albums += 1
+                        uploader.skipped_items += scheduler.pending_counts[album_id]
+                if started_albums[album_id] is None and album_id != NO_ALBUM:
+                    continue
+                uploader.submit(album_id, archive.matched[item_id])
+
+            if not quota_spent:
+                # albums without items to upload
+                for album_id, (status, album_google_id) in albums.items():
+                    if album_id not in started_albums and status == 'none':
+                        create_google_photos_album(archive.albums[album_id], status, album_google_id, gclient, db,
+                                                   limiter)
+            uploader.flush()
+    finally:
+        uploader.close()
+        sessions.close()
+        archive.zip_files.close()
+        http_pool.log_stats()
+        buffers.log_stats()
     db.commit()
+    skipped_items = uploader.skipped_items
+    if uploader.attached_items > 0:
+        logger.info('Items with already uploaded content added to albums: %d', uploader.attached_items)
 
     if skipped_albums > 0:
         logger.error('⚠️ Unable to upload %d albums, try running script again', skipped_albums)
     if skipped_items > 0:
         logger.error('⚠️ Unable to upload %d items, try running script again', skipped_items)
 
+    if quota_spent:
+        logger.info('Daily quota is spent, continue upload after 24h')
+    else:
+        logger.info('🎉 Job is done')
+    db.close()
+    return 0
+
+
+def extract(archive_globs, output_dir, index_cache_path=None, jobs=1):
+    archive = load_archives_and_log_info(archive_globs, index_cache_path, jobs)
+
+    logger.info('Extracting items to %s ...', output_dir)
+    started = time.monotonic()
+    with archive.zip_files:
+        stats = extract_archive(archive, output_dir, jobs)
+    elapsed = max(time.monotonic() - started, 1e-6)
+
+    logger.info('Files extracted: %d (%.1f MB, %.1f MB/s)', stats['extracted'], stats['extracted_bytes'] / 1e6,
+                stats['extracted_bytes'] / 1e6 / elapsed)
+    logger.info('Files hardlinked: %d, copied: %d', stats['linked'], stats['copied'])
+    logger.info('Files skipped (already extracted): %d', stats['skipped'])
+    if stats['failed'] > 0:
+        logger.error('⚠️ Unable to extract %d files corrupted in archives', stats['failed'])
     logger.info('🎉 Job is done')
+    return 0
+
+
+def show_upload_status(db_path):
+    if not os.path.exists(db_path):
+        logger.error('DB %s not found', db_path)
+        return 1
+    db = connect_db_readonly(db_path)
+    if db is None:
+        logger.error('DB %s has outdated schema, it is migrated on the next upload-to-google-photo run', db_path)
+        return 1
+    for table, what in (('gphotos_albums', 'Albums'), ('gphotos_items', 'Items')):
+        counts = dict(db.execute('select status, count(*) from {} group by status'.format(table)).fetchall())
+        logger.info('%s: %d total, %d uploaded, %d waiting', what, sum(counts.values()),
+                    counts.get('uploaded', 0) + counts.get('created', 0), counts.get('none', 0))
+    sessions, confirmed, total = db.execute('select count(*), coalesce(sum(confirmed_offset), 0), '
+                                            'coalesce(sum(file_size), 0) from gphotos_upload_sessions').fetchone()
+    if sessions > 0:
+        logger.info('Unfinished uploads: %d, %d / %d bytes confirmed', sessions, confirmed, total)
     db.close()
     return 0
 
 
+def serve_mock_google_photos(host, port, faults):
+    server = MockGooglePhotosServer(host, port, faults)
+    logger.info('Mock Google Photos API is listening on %s, upload with --api-url %s', server.url, server.url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.state.log_stats()
+    return 0
+
+
+def run_command(args):
+    if args.command == 'check':
+        if args.incremental:
+            check_incremental(args.archive, args.samples_size, args.index_cache, args.jobs, args.verify_content)
+        else:
+            check(args.archive, args.samples_size, args.index_cache, args.jobs, args.dedup, args.verify_content,
+                  args.report, args.report_summary_only)
+    elif args.command == 'upload-to-google-photo':
+        try:
+            priority = load_upload_priority(args.priority_file) if args.priority_file else None
+        except ValueError as e:
+            logger.error('Unable to read priority list: %s', e)
+            return
+        try:
+            limiter = GoogleAPIRateLimiter(requests_per_second=args.requests_per_second,
+                                           daily_quota=args.daily_quota, wait_for_quota=not args.exit_on_quota)
+            buffers = ChunkBufferPool(int(args.upload_buffers * 2 ** 20), args.prefetch_chunks)
+            upload_to_google_photos(args.archive, args.db, args.app_credentials, args.index_cache, args.jobs,
+                                    args.concurrency, limiter, args.dedup, args.api_url, buffers, args.order,
+                                    priority, (args.date_from, args.date_to), not args.no_interleave)
+        except GoogleAPILimitReached as e:
+            logger.error("😞 Looks like you've reached Google API limits. Try to continue after 24h.")
+
+    elif args.command == 'extract':
+        extract(args.archive, args.output, args.index_cache, args.jobs)
+    elif args.command == 'status':
+        show_upload_status(args.db)
+    elif args.command == 'mock-google-photos':
+        faults = MockFaults(args.latency, args.rate_limited, args.server_errors, args.dropped,
+                            args.granularity or (MOCK_CHUNK_GRANULARITY, ), args.retry_after, args.seed)
+        serve_mock_google_photos(args.host, args.port, faults)
+    else:
+        print('Unknown command {}'.format(args.command))
+        sys.exit(2)
+
+
 if __name__ == '__main__':
     args = parse_args()
     if args.verbose:
@@ -805,14 +4258,20 @@ if __name__ == '__main__':
     if not args.verbose:
         logging.getLogger('googleapiclient.discovery').setLevel(logging.WARNING)
 
-    if args.command == 'check':
-        check(args.archive, args.samples_size)
-    elif args.command == 'upload-to-google-photo':
-        try:
-            upload_to_google_photos(args.archive, args.db)
-        except GoogleAPILimitReached as e:
-            logger.error("😞 Looks like you've reached Google API limits. Try to continue after 24h.")
-
-    else:
-        print('Unknown command {}'.format(args.command))
-        sys.exit(2)
+    if args.profile:
+        profiling.configure(args.profile, args.profile_scope, args.profile_output, args.profile_top)
+    reporter = None
+    if args.metrics_interval > 0 and args.command not in ('status', 'mock-google-photos'):
+        reporter = MetricsReporter(metrics, args.metrics_interval)
+        reporter.start()
+    try:
+        with profiling('command'):
+            run_command(args)
+    finally:
+        if reporter is not None:
+            reporter.stop()
+        if args.command not in ('status', 'mock-google-photos'):
+            metrics.log()
+        if args.metrics_file:
+            metrics.write(args.metrics_file)
+        profiling.finish()
@@ -0,0 +1,19 @@
+import unittest
+
+import flickr_archive_extractor as fae
+from benchmarks import bench_classifier
+
+
+class TestClassifier(unittest.TestCase):
+
+    def test_same_as_legacy_classification(self):
+        corpus = bench_classifier.synthetic_corpus(20000, seed=42)
+        self.assertEqual(bench_classifier.find_mismatches(corpus), [])
+
+    def test_classify(self):
+        self.assertEqual(fae.classify_archive_entry('my_photo_123_o.jpg'), (fae.ENTRY_ITEM, 123, 'my_photo', 'jpg'))
+        self.assertEqual(fae.classify_archive_entry('123_abc_o.png'), (fae.ENTRY_ITEM, 123, 'abc', 'png'))
+        self.assertEqual(fae.classify_archive_entry('video_12.mov'), (fae.ENTRY_ITEM, 12, 'video', 'mov'))
+        self.assertEqual(fae.classify_archive_entry('photo_5.json'), (fae.ENTRY_METADATA, 5, None, None))
+        self.assertEqual(fae.classify_archive_entry('groups.json')[0], fae.ENTRY_IGNORED)
+        self.assertEqual(fae.classify_archive_entry('other.txt')[0], fae.ENTRY_UNKNOWN)
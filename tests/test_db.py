@@ -0,0 +1,128 @@
+import collections
+import os.path
+import shutil
+import sqlite3
+import tempfile
+import unittest
+import unittest.mock
+
+import flickr_archive_extractor as fae
+
+
+FakeItem = collections.namedtuple('FakeItem', ['id'])
+FakeItemWithMetadata = collections.namedtuple('FakeItemWithMetadata', ['item'])
+FakeAlbum = collections.namedtuple('FakeAlbum', ['created'])
+
+
+class TestDb(unittest.TestCase):
+
+    def test_migrate_db_without_schema_version(self):
+        db = sqlite3.connect(':memory:')
+        db.execute("create table gphotos_token (token blob)")
+        db.execute("create table gphotos_albums (seq_id integer primary key autoincrement, album_id text not null, "
+                   "status text not null default 'none', google_id text)")
+        db.execute("create table gphotos_items (item_id integer, album_id text, status text not null default 'none', "
+                   "google_id text, primary key (item_id, album_id))")
+        db.execute("insert into gphotos_items values (1, null, 'none', null), (1, null, 'uploaded', 'g1'), "
+                   "(1, 'a', 'none', null)")
+        db.execute("insert into gphotos_albums (album_id) values ('a'), ('b'), ('a')")
+        db.commit()
+
+        fae.migrate_db(db)
+
+        self.assertEqual(db.execute('select version from schema_version').fetchall(), [(len(fae.DB_MIGRATIONS), )])
+        self.assertEqual(sorted(db.execute('select item_id, album_id, status from gphotos_items').fetchall()),
+                         [(1, fae.NO_ALBUM, 'uploaded'), (1, 'a', 'none')])
+        self.assertEqual(db.execute('select seq_id, album_id from gphotos_albums order by seq_id').fetchall(),
+                         [(1, 'a'), (2, 'b')])
+
+    def test_failed_migration_is_rolled_back(self):
+        db = sqlite3.connect(':memory:')
+        fae.migrate_db(db)
+        db.execute("insert into gphotos_items (item_id, album_id) values (1, 'a')")
+        db.commit()
+
+        def failed_migration(db):
+            db.execute("create table gphotos_new (id integer)")
+            db.execute("drop index gphotos_items_status")
+            db.execute("update gphotos_items set status = 'uploaded'")
+            raise sqlite3.OperationalError('migration failed')
+
+        with unittest.mock.patch.object(fae, 'DB_MIGRATIONS', fae.DB_MIGRATIONS + (failed_migration, )):
+            with self.assertRaises(sqlite3.OperationalError):
+                fae.migrate_db(db)
+
+        self.assertFalse(db.in_transaction)
+        self.assertEqual(db.execute('select version from schema_version').fetchall(), [(len(fae.DB_MIGRATIONS), )])
+        self.assertEqual(db.execute("select name from sqlite_master where name in "
+                                    "('gphotos_new', 'gphotos_items_status')").fetchall(),
+                         [('gphotos_items_status', )])
+        self.assertEqual(db.execute('select status from gphotos_items').fetchall(), [('none', )])
+        self.assertIsNotNone(db.isolation_level)
+
+    def test_bulk_init(self):
+        db = sqlite3.connect(':memory:')
+        fae.migrate_db(db)
+        items = {i: FakeItemWithMetadata(FakeItem(i)) for i in range(1, 5)}
+        index = {1: ['a'], 2: ['a', 'b']}
+        albums = {'b': FakeAlbum(2), 'a': FakeAlbum(1)}
+
+        self.assertEqual(fae.init_albums_to_upload_to_google_photos(albums, db), (0, 2))
+        self.assertEqual(fae.init_albums_to_upload_to_google_photos(albums, db), (2, 0))
+        self.assertEqual(db.execute('select album_id from gphotos_albums order by seq_id').fetchall(),
+                         [('a', ), ('b', )])
+
+        self.assertEqual(fae.init_items_to_upload_to_google_photos(items, index, db), (0, 5))
+        items[5] = FakeItemWithMetadata(FakeItem(5))
+        self.assertEqual(fae.init_items_to_upload_to_google_photos(items, index, db), (5, 1))
+        self.assertEqual(db.execute('select count(*) from gphotos_items where album_id = ?',
+                                    (fae.NO_ALBUM, )).fetchone(), (3, ))
+
+
+class TestDbFile(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.tmp_dir, 'db')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_wal_journal(self):
+        db = fae.init_db(self.db_path)
+        self.assertEqual(db.execute('pragma journal_mode').fetchone(), ('wal', ))
+        # normal
+        self.assertEqual(db.execute('pragma synchronous').fetchone(), (1, ))
+        db.close()
+
+    def test_status(self):
+        db = fae.init_db(self.db_path)
+        db.executemany("insert into gphotos_items (item_id, album_id, status) values (?, ?, ?)",
+                       [(1, 'a', 'uploaded'), (2, 'a', 'none'), (2, fae.NO_ALBUM, 'none')])
+        db.execute("insert into gphotos_albums (album_id, status) values ('a', 'created')")
+        db.execute("insert into gphotos_upload_sessions values (2, 'a', 'url', 100, 10, 40)")
+        db.commit()
+
+        # status is shown while upload holds a write transaction
+        db.execute("update gphotos_items set status = 'none' where item_id = 1")
+        with self.assertLogs(fae.logger, 'INFO') as logs:
+            self.assertEqual(fae.show_upload_status(self.db_path), 0)
+        db.rollback()
+        db.close()
+        self.assertEqual(logs.output, ['INFO:flickr_archive_extractor:Albums: 1 total, 1 uploaded, 0 waiting',
+                                       'INFO:flickr_archive_extractor:Items: 3 total, 1 uploaded, 2 waiting',
+                                       'INFO:flickr_archive_extractor:Unfinished uploads: 1, 40 / 100 bytes confirmed'])
+
+    def test_status_does_not_migrate(self):
+        db = sqlite3.connect(self.db_path)
+        db.execute('create table gphotos_items (item_id integer, album_id text, status text, google_id text)')
+        db.commit()
+        db.close()
+        with open(self.db_path, 'rb') as f:
+            content = f.read()
+
+        with self.assertLogs(fae.logger, 'ERROR'):
+            self.assertEqual(fae.show_upload_status(self.db_path), 1)
+        with open(self.db_path, 'rb') as f:
+            self.assertEqual(f.read(), content)
+        self.assertEqual(sorted(os.listdir(self.tmp_dir)), ['db'])
@@ -0,0 +1,71 @@
+import os.path
+import shutil
+import tempfile
+import unittest
+
+import flickr_archive_extractor as fae
+
+from tests.test_index import write_archive
+
+
+class TestExtract(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.output_dir = os.path.join(self.tmp_dir, 'out')
+        self.archives = [os.path.join(self.tmp_dir, 'data_{}.zip'.format(i)) for i in range(2)]
+        album = {'url': 'https://example.com/a', 'created': '1500000000', 'last_updated': '1500000001'}
+        write_archive(self.archives[0], [(1, 'first'), (2, 'second')],
+                      albums=[dict(album, id='10', title='a/b', photos=['1', '3']),
+                              dict(album, id='11', title='a/b', photos=['1'])])
+        write_archive(self.archives[1], [(3, 'third'), (4, 'fourth')])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def path(self, *parts):
+        return os.path.join(self.output_dir, *parts)
+
+    def test_extract_and_rerun(self):
+        archive = fae.FlickrArchive.build(self.archives)
+        stats = fae.extract_archive(archive, self.output_dir, jobs=2)
+        self.assertEqual((stats['extracted'], stats['linked'], stats['skipped']), (4, 1, 0))
+
+        with open(self.path('album', 'a_b', 'first_1_o.jpg'), 'rb') as fp:
+            self.assertEqual(fp.read(), b'photo1')
+        self.assertTrue(os.path.samefile(self.path('album', 'a_b', 'first_1_o.jpg'),
+                                         self.path('album', 'a_b (11)', 'first_1_o.jpg')))
+        self.assertTrue(os.path.exists(self.path('album', 'a_b', 'third_3_o.jpg')))
+        self.assertEqual(sorted(os.listdir(self.path('unsorted'))), ['fourth_4_o.jpg', 'second_2_o.jpg'])
+
+        stats = fae.extract_archive(archive, self.output_dir)
+        self.assertEqual((stats['extracted'], stats['linked'], stats['skipped']), (0, 0, 5))
+
+        with open(self.path('unsorted', 'second_2_o.jpg'), 'wb') as fp:
+            fp.write(b'photoX')
+        os.remove(self.path('album', 'a_b', 'first_1_o.jpg'))
+        stats = fae.extract_archive(archive, self.output_dir)
+        self.assertEqual((stats['extracted'], stats['linked'], stats['skipped']), (1, 1, 3))
+        with open(self.path('unsorted', 'second_2_o.jpg'), 'rb') as fp:
+            self.assertEqual(fp.read(), b'photo2')
+
+    def test_corrupted_member_is_skipped(self):
+        with open(self.archives[0], 'r+b') as fp:
+            content = fp.read()
+            fp.seek(content.index(b'photo1'))
+            fp.write(b'photoX')
+        archive = fae.FlickrArchive.build(self.archives)
+        with self.assertLogs(fae.logger, 'ERROR'):
+            stats = fae.extract_archive(archive, self.output_dir)
+        self.assertEqual((stats['extracted'], stats['failed'], stats['linked']), (3, 2, 0))
+
+        written = [os.path.relpath(os.path.join(path, name), self.output_dir)
+                   for path, _, names in os.walk(self.output_dir) for name in names]
+        self.assertEqual(sorted(written), [fae.EXTRACT_MANIFEST_NAME, os.path.join('album', 'a_b', 'third_3_o.jpg'),
+                                           os.path.join('unsorted', 'fourth_4_o.jpg'),
+                                           os.path.join('unsorted', 'second_2_o.jpg')])
+        manifest = fae.ExtractManifest.open(self.path(fae.EXTRACT_MANIFEST_NAME))
+        self.assertEqual(len(manifest.load()), 3)
+        manifest.close()
+        stats = fae.extract_archive(archive, self.output_dir)
+        self.assertEqual((stats['extracted'], stats['failed'], stats['skipped']), (0, 2, 3))
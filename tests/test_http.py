@@ -0,0 +1,60 @@
+import http.server
+import threading
+import unittest
+import urllib.request
+
+import flickr_archive_extractor as fae
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        if self.path == '/drop':
+            # close keep-alive connection without telling client
+            self.close_connection = True
+
+    def log_message(self, *args):
+        pass
+
+
+class TestHttpConnectionPool(unittest.TestCase):
+
+    def setUp(self):
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+        self.pool = fae.HttpConnectionPool()
+
+    def tearDown(self):
+        self.pool.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def post(self, path, data):
+        req = urllib.request.Request(method='POST', url=self.url + path, data=data,
+                                     headers={'Content-Length': str(len(data))})
+        return fae.http_request(req, pool=self.pool)
+
+    def test_connection_is_reused(self):
+        for i in range(5):
+            status, _, body = self.post('/echo', memoryview(b'chunk %d' % i))
+            self.assertEqual((status, body), (200, b'chunk %d' % i))
+        self.assertEqual((self.pool.created, self.pool.reused), (1, 4))
+
+    def test_dropped_connection_is_replaced(self):
+        self.assertEqual(self.post('/drop', b'first')[2], b'first')
+        self.assertEqual(self.post('/echo', b'second')[2], b'second')
+        self.assertEqual(self.pool.created, 2)
+
+    def test_connection_error(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.pool.close()
+        self.assertEqual(self.post('/echo', b'data')[0], 599)
@@ -0,0 +1,353 @@
+import concurrent.futures
+import io
+import json
+import os.path
+import shutil
+import tempfile
+import unittest
+import zipfile
+
+import flickr_archive_extractor as fae
+
+
+def write_archive(path, photos, albums=None, extra=None):
+    with zipfile.ZipFile(path, 'w') as zf:
+        for photo in photos:
+            photo_id, name = photo[0:2]
+            content = photo[2] if len(photo) > 2 else b'photo' + str(photo_id).encode('ascii')
+            zf.writestr('{}_{}_o.jpg'.format(name, photo_id), content)
+            zf.writestr('photo_{}.json'.format(photo_id), json.dumps({
+                'id': str(photo_id),
+                'description': 'description {}'.format(photo_id),
+                'original': 'https://example.com/{}_o.jpg'.format(photo_id),
+                'albums': [],
+                'photopage': 'https://example.com/photos/{}'.format(photo_id),
+            }))
+        if albums is not None:
+            zf.writestr('albums.json', json.dumps({'albums': albums}))
+        for name, content in (extra or {}).items():
+            zf.writestr(name, content)
+
+
+def archive_state(archive):
+    return (
+        sorted(archive.items.items()),
+        sorted((k, v.metadata_file, v.original_name) for k, v in archive.items_metadata.items()),
+        sorted(archive.matched.keys()),
+        sorted(archive.albums.items()),
+        sorted(archive.item_to_albums_index.items()),
+        sorted(archive.items_without_albums),
+    )
+
+
+class TestIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.archives = [os.path.join(self.tmp_dir, 'data_{}.zip'.format(i)) for i in range(3)]
+        write_archive(self.archives[0], [(1, 'first'), (2, 'second')],
+                      albums=[{'id': '10', 'title': 'album', 'url': 'https://example.com/a/10',
+                               'created': '1500000000', 'last_updated': '1500000001', 'photos': ['2', '3']}])
+        write_archive(self.archives[1], [(3, 'third'), (2, 'duplicate')], extra={'groups.json': '{}'})
+        write_archive(self.archives[2], [(4, '5')], extra={'unknown.txt': 'x'})
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_cached_build_is_equal_to_fresh(self):
+        fresh = fae.FlickrArchive.build(self.archives)
+        cache_path = os.path.join(self.tmp_dir, 'index_cache')
+
+        cache = fae.IndexCache.open(cache_path)
+        first = fae.FlickrArchive.build(self.archives, index_cache=cache)
+        cache.close()
+
+        cache = fae.IndexCache.open(cache_path)
+        with self.assertLogs(fae.logger, 'INFO') as logs:
+            cached = fae.FlickrArchive.build(self.archives, index_cache=cache)
+        cache.close()
+
+        self.assertEqual(archive_state(fresh), archive_state(first))
+        self.assertEqual(archive_state(fresh), archive_state(cached))
+        self.assertIn('Archives loaded from index cache: 3, scanned: 0', '\n'.join(logs.output))
+        self.assertIn('Duplicate item with id 2', '\n'.join(logs.output))
+        self.assertIn(5, cached.items)
+        self.assertEqual(cached.item_to_albums_index, {2: ['10'], 3: ['10']})
+
+    def test_changed_archive_is_rescanned(self):
+        cache_path = os.path.join(self.tmp_dir, 'index_cache')
+        cache = fae.IndexCache.open(cache_path)
+        fae.FlickrArchive.build(self.archives, index_cache=cache)
+        cache.close()
+
+        write_archive(self.archives[2], [(4, '5'), (6, 'sixth')])
+        cache = fae.IndexCache.open(cache_path)
+        with self.assertLogs(fae.logger, 'INFO') as logs:
+            archive = fae.FlickrArchive.build(self.archives, index_cache=cache)
+        cache.close()
+
+        self.assertIn('Archives loaded from index cache: 2, scanned: 1', '\n'.join(logs.output))
+        self.assertIn(6, archive.matched)
+
+    def test_parallel_build_is_equal_to_sequential(self):
+        with self.assertLogs(fae.logger, 'WARNING') as sequential_logs:
+            sequential = fae.FlickrArchive.build(self.archives)
+        with self.assertLogs(fae.logger, 'WARNING') as parallel_logs:
+            parallel = fae.FlickrArchive.build(self.archives, jobs=3)
+
+        self.assertEqual(archive_state(sequential), archive_state(parallel))
+        self.assertEqual(sequential_logs.output, parallel_logs.output)
+
+    def test_metadata_is_loaded_on_demand(self):
+        archive = fae.FlickrArchive.build(self.archives)
+        metadata = archive.items_metadata[1]
+        self.assertEqual(metadata.load_data(archive.zip_files)['description'], 'description 1')
+        self.assertIs(metadata.load_data(archive.zip_files), metadata.load_data(archive.zip_files))
+
+
+class TestZipFiles(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'data.zip')
+        self.contents = {'{}.jpg'.format(i): os.urandom(1000 + i * 5000) for i in range(20)}
+        with zipfile.ZipFile(self.path, 'w') as zf:
+            for i, (name, content) in enumerate(sorted(self.contents.items())):
+                zf.writestr(name, content, compress_type=zipfile.ZIP_DEFLATED if i % 2 else zipfile.ZIP_STORED)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_stored_members_are_views(self):
+        zip_files = fae.ZipFiles()
+        zip_files.add_archive(0, zipfile.ZipFile(self.path))
+        self.assertEqual(zip_files.member_view(fae.ArchiveFile(0, '0.jpg')), self.contents['0.jpg'])
+        self.assertIsNone(zip_files.member_view(fae.ArchiveFile(0, '1.jpg')))
+        with self.assertRaises(RuntimeError):
+            zip_files.member_view(fae.ArchiveFile(0, 'missing.jpg'))
+
+        with open(self.path, 'rb') as fp:
+            zip_files = fae.ZipFiles()
+            zip_files.add_archive(0, zipfile.ZipFile(io.BytesIO(fp.read())))
+        self.assertIsNone(zip_files.member_view(fae.ArchiveFile(0, '0.jpg')))
+        self.assertEqual(zip_files.get_file_content(fae.ArchiveFile(0, '0.jpg')), self.contents['0.jpg'])
+
+    def test_close(self):
+        zip_file = zipfile.ZipFile(self.path)
+        with fae.ZipFiles() as zip_files:
+            zip_files.add_archive(0, zip_file)
+            view = zip_files.member_view(fae.ArchiveFile(0, '0.jpg'))
+            self.assertEqual(zip_files.get_file_content(fae.ArchiveFile(0, '2.jpg')), self.contents['2.jpg'])
+            mapped = zip_files._mapped_archive(0)
+            view.release()
+        self.assertTrue(mapped.closed)
+        self.assertIsNone(zip_file.fp)
+
+    def test_local_header_name_is_checked(self):
+        with open(self.path, 'r+b') as fp:
+            content = fp.read()
+            # the first occurrence is in local header, central directory is at the end
+            fp.seek(content.index(b'0.jpg'))
+            fp.write(b'X.jpg')
+        with fae.ZipFiles() as zip_files:
+            zip_files.add_archive(0, zipfile.ZipFile(self.path))
+            for read in (zip_files.member_view, zip_files.open_file):
+                with self.assertRaises(zipfile.BadZipFile):
+                    read(fae.ArchiveFile(0, '0.jpg'))
+            self.assertEqual(zip_files.get_file_content(fae.ArchiveFile(0, '1.jpg')), self.contents['1.jpg'])
+
+    def test_concurrent_reads(self):
+        zip_files = fae.ZipFiles()
+        zip_files.add_archive(0, zipfile.ZipFile(self.path))
+        names = sorted(self.contents) * 10
+
+        def read(name):
+            with zip_files.open_file(fae.ArchiveFile(0, name)) as fp:
+                content = b''
+                while True:
+                    chunk = fp.read(777)
+                    if not chunk:
+                        return content
+                    content += chunk
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+            self.assertEqual(list(executor.map(read, names)), [self.contents[name] for name in names])
+
+
+class TestContentDuplicates(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.archives = [os.path.join(self.tmp_dir, 'data_{}.zip'.format(i)) for i in range(2)]
+        # 'photo1' & 'photo7' have the same size but different CRC32
+        write_archive(self.archives[0], [(1, 'first'), (2, 'second', b'photo1'), (3, 'third', b'photoX')])
+        write_archive(self.archives[1], [(7, 'seventh'), (8, 'eighth', b'photo1'), (9, 'ninth', b'photoX')])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_find_duplicates(self):
+        archive = fae.FlickrArchive.build(self.archives)
+        cache_path = os.path.join(self.tmp_dir, 'index_cache')
+        cache = fae.IndexCache.open(cache_path)
+        duplicates = fae.ContentDuplicates.find(archive, cache)
+        cache.close()
+        self.assertEqual(duplicates.groups, [[1, 2, 8], [3, 9]])
+        self.assertEqual(duplicates.group(8), [1, 2, 8])
+        self.assertEqual(duplicates.group(7), [7])
+        self.assertEqual(duplicates.key(9), 3)
+        self.assertEqual(duplicates.redundant_items, 3)
+
+        cache = fae.IndexCache.open(cache_path)
+        with self.assertLogs(fae.logger, 'DEBUG') as logs:
+            self.assertEqual(fae.ContentDuplicates.find(archive, cache).groups, duplicates.groups)
+        cache.close()
+        self.assertIn('Content hashes calculated: 0, loaded from index cache: 5', '\n'.join(logs.output))
+
+
+class TestParseJsonFields(unittest.TestCase):
+
+    def test_parse_json_fields(self):
+        fields = {'original', 'albums', 'photopage'}
+        docs = [
+            '{"id": "1", "original": "o\\u00e9\\"", "tags": [{"a": [1, 2.5e3]}], "albums": [], '
+            '"photopage": "p", "comments": [{"x": "y"}]}',
+            ' {\n"albums" : [{"id": "1"}] ,"original":null}  ',
+            '{}',
+            '{"original": "o", "photopage": "p", "albums": [] ,}',
+        ]
+        for doc in docs[0:3]:
+            expected = {k: v for k, v in json.loads(doc).items() if k in fields}
+            self.assertEqual(fae.parse_json_fields(doc, fields), expected)
+        self.assertEqual(fae.parse_json_fields(docs[3], fields), {'original': 'o', 'photopage': 'p', 'albums': []})
+        with self.assertRaises(ValueError):
+            fae.parse_json_fields('{"id": 1,}', fields)
+
+
+class TestCompactStore(unittest.TestCase):
+
+    def test_string_column(self):
+        values = ['', 'a', 'épsilon', 'bc']
+        column = fae.StringColumn(values)
+        self.assertEqual(list(column), values)
+        self.assertEqual(column[-1], 'bc')
+
+    def test_merge_sorted_ids(self):
+        merged = fae.merge_sorted_ids([1, 3, 5], [2, 3, 6])
+        self.assertEqual([list(positions) for positions in merged], [[0, 2], [1], [1], [0, 2]])
+
+
+class TestVerifyContent(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.archives = [os.path.join(self.tmp_dir, 'data_{}.zip'.format(i)) for i in range(2)]
+        write_archive(self.archives[0], [(1, 'first'), (2, 'second')])
+        write_archive(self.archives[1], [(3, 'third'), (4, 'fourth', b'')])
+        with open(self.archives[0], 'rb') as fp:
+            content = fp.read()
+        with open(self.archives[0], 'wb') as fp:
+            fp.write(content.replace(b'photo2', b'photoX'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_verify_and_skip_unchanged(self):
+        archive = fae.FlickrArchive.build(self.archives)
+        cache_path = os.path.join(self.tmp_dir, 'index_cache')
+        cache = fae.IndexCache.open(cache_path)
+        results = fae.verify_archives_content(archive.zip_files, cache, jobs=2)
+        cache.close()
+
+        self.assertEqual([(path, cached) for path, _, cached in results], [(p, False) for p in self.archives])
+        self.assertEqual([v.members for _, v, _ in results], [4, 4])
+        with zipfile.ZipFile(self.archives[1]) as zf:
+            self.assertEqual(results[1][1].bytes, sum(info.file_size for info in zf.infolist()))
+        self.assertEqual([member for member, _ in results[0][1].errors], ['second_2_o.jpg'])
+        self.assertIn('CRC', results[0][1].errors[0][1])
+        self.assertEqual(results[1][1].errors, [('fourth_4_o.jpg', 'empty member')])
+
+        cache = fae.IndexCache.open(cache_path)
+        cached = fae.verify_archives_content(archive.zip_files, cache)
+        cache.close()
+        self.assertEqual([(path, v.errors, is_cached) for path, v, is_cached in cached],
+                         [(path, v.errors, True) for path, v, _ in results])
+
+
+def metadata_json(photo_id, original=None):
+    return json.dumps({'id': str(photo_id), 'original': original or 'https://example.com/{}_o.jpg'.format(photo_id),
+                       'albums': [], 'photopage': 'https://example.com/photos/{}'.format(photo_id)})
+
+
+class TestIncrementalCheck(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.archives = [os.path.join(self.tmp_dir, 'data_{}.zip'.format(i)) for i in range(3)]
+        album = {'url': 'https://example.com/a', 'created': '1500000000', 'last_updated': '1500000001'}
+        write_archive(self.archives[0], [(1, 'first')],
+                      albums=[dict(album, id='10', title='old', photos=['1', '20'])],
+                      extra={'orphan_20_o.jpg': b'x', '30_31_o.jpg': b'y'})
+        write_archive(self.archives[1], [(2, 'second')],
+                      extra={'photo_21.json': metadata_json(21), 'photo_22.json': metadata_json(22)})
+        write_archive(self.archives[2], [(3, 'third'), (1, 'duplicate')],
+                      albums=[dict(album, id='11', title='new', photos=['3', '20', '22', '30'])],
+                      extra={'photo_20.json': metadata_json(20), 'photo_30.json': metadata_json(30),
+                             'video_22_o.jpg': b'v', 'photo_40.json': metadata_json(40, 'x/video_encoding.jpg')})
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_apply_is_equal_to_full_check(self):
+        old = fae.FlickrArchive.build(self.archives[0:2])
+        state = fae.CheckState.from_archive(old, fae.archive_fingerprints(old.zip_files))
+        previous = fae.CheckState.from_archive(old, {})
+        self.assertEqual(state.partners, {30: (30, 31), 31: (30, 31)})
+        self.assertEqual(list(state.without_metadata), [20, 30, 31])
+
+        zip_files, indexes = fae.FlickrArchive.index(self.archives[2:])
+        changes = state.apply([(zip_files.archive_by_id(0), indexes[0])], fae.archive_fingerprints(zip_files))
+
+        full = fae.FlickrArchive.build(self.archives)
+        expected = fae.CheckState.from_archive(full, fae.archive_fingerprints(full.zip_files))
+        for field in ('archives', 'items', 'metadata', 'unprocessed', 'partners', 'matched', 'without_metadata',
+                      'without_items', 'album_titles', 'album_members'):
+            self.assertEqual(getattr(state, field), getattr(expected, field), field)
+        self.assertEqual({k: v for k, v in changes.items() if v[0] != v[1]}, fae.CheckState.diff(previous, state))
+        self.assertFalse(changes[20][0].matched)
+        self.assertEqual(changes[20][1].albums, ('11', ))
+
+    def test_report(self):
+        report_path = os.path.join(self.tmp_dir, 'report.jsonl')
+        fae.check(self.archives[0:2], report_path=report_path)
+        with open(report_path) as fp:
+            findings = [json.loads(line) for line in fp]
+
+        self.assertEqual(findings[-1], {'kind': 'summary', 'counts': {
+            'item_without_metadata': 3, 'item_without_original': 2, 'missed_album_item': 1,
+        }})
+        self.assertIn({'kind': 'item_without_metadata', 'id': 31, 'archive': 'data_0.zip', 'path': '30_31_o.jpg'},
+                      findings)
+        self.assertIn({'kind': 'missed_album_item', 'album_id': '10', 'item_id': 20,
+                       'album_url': 'https://example.com/a'}, findings)
+
+        duplicated_album = os.path.join(self.tmp_dir, 'data_3.zip')
+        album = {'url': 'https://example.com/b', 'created': '1500000000', 'last_updated': '1500000001'}
+        write_archive(duplicated_album, [], albums=[dict(album, id='12', title='first', photos=['2']),
+                                                    dict(album, id='12', title='second', photos=['3'])])
+        fae.check(self.archives + [duplicated_album], report_path=report_path)
+        with open(report_path) as fp:
+            findings = [json.loads(line) for line in fp]
+        self.assertEqual(findings[-1]['counts']['duplicate_item'], 1)
+        self.assertEqual(findings[-1]['counts']['duplicate_metadata'], 1)
+        self.assertEqual(findings[-1]['counts']['duplicate_album'], 1)
+        self.assertIn({'kind': 'duplicate_item', 'id': 1, 'archive': 'data_0.zip', 'path': 'first_1_o.jpg',
+                       'duplicate_archive': 'data_2.zip', 'duplicate_path': 'duplicate_1_o.jpg'}, findings)
+        self.assertIn({'kind': 'duplicate_metadata', 'id': 1, 'archive': 'data_0.zip', 'path': 'photo_1.json',
+                       'duplicate_archive': 'data_2.zip', 'duplicate_path': 'photo_1.json'}, findings)
+        self.assertIn({'kind': 'duplicate_album', 'id': '12', 'archive': 'data_3.zip', 'path': 'albums.json',
+                       'duplicate_archive': 'data_3.zip', 'duplicate_path': 'albums.json'}, findings)
+
+        fae.check(self.archives, report_path=report_path, report_summary_only=True)
+        with open(report_path) as fp:
+            self.assertEqual([json.loads(line)['kind'] for line in fp], ['summary'])
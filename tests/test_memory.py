@@ -0,0 +1,14 @@
+import unittest
+
+from benchmarks import bench_memory
+
+
+class TestMemoryBenchmark(unittest.TestCase):
+
+    def test_index_representations_are_built(self):
+        _, items_metadata, matched, _, _, _ = bench_memory.build_legacy(300)
+        archive = bench_memory.build_columnar(300)
+        self.assertEqual(len(archive.items_metadata), len(items_metadata))
+        item_id = next(iter(matched))
+        self.assertEqual(archive.matched[item_id].metadata, matched[item_id].metadata)
+        self.assertIsNotNone(matched[item_id].metadata.date_taken)
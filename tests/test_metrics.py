@@ -0,0 +1,44 @@
+import unittest
+
+import flickr_archive_extractor as fae
+
+from tests.test_rate_limiter import FakeClock
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_snapshot(self):
+        clock = FakeClock()
+        metrics = fae.Metrics(clock=clock)
+        with metrics.phase('index.scan'):
+            pass
+        metrics.merge_phases({'index.scan': [2, 1.5]})
+        metrics.add('upload.bytes', 4000000)
+        for latency in range(1, 101):
+            metrics.observe('upload.chunk_latency', latency / 100.0)
+        clock.now += 2.0
+
+        snapshot = metrics.snapshot()
+        self.assertEqual(snapshot['phases']['index.scan']['count'], 3)
+        self.assertGreaterEqual(snapshot['phases']['index.scan']['seconds'], 1.5)
+        self.assertEqual(snapshot['rates']['upload.bytes_per_second'], 2000000)
+        self.assertEqual(snapshot['latencies']['upload.chunk_latency'],
+                         {'count': 100, 'p50': 0.5, 'p95': 0.95, 'p99': 0.99, 'max': 1.0})
+        self.assertIn('upload.bytes 4.0 MB (2.00 MB/s)', metrics.format(snapshot))
+
+    def test_latency_samples_are_bounded(self):
+        metrics = fae.Metrics()
+        for latency in range(100000):
+            metrics.observe('upload.chunk_latency', latency / 100000.0)
+        reservoir = metrics.latencies['upload.chunk_latency']
+        self.assertEqual(len(reservoir.samples), fae.LATENCY_RESERVOIR_SIZE)
+
+        latency = metrics.snapshot()['latencies']['upload.chunk_latency']
+        self.assertEqual((latency['count'], latency['max']), (100000, 0.99999))
+        for p in (50, 95, 99):
+            self.assertAlmostEqual(latency['p{}'.format(p)], p / 100.0, delta=0.03)
+
+    def test_percentile(self):
+        self.assertIsNone(fae.percentile([], 50))
+        self.assertEqual(fae.percentile([3.0], 99), 3.0)
+        self.assertEqual(fae.percentile([1, 2, 3, 4], 50), 2)
@@ -0,0 +1,88 @@
+import os.path
+import shutil
+import sqlite3
+import tempfile
+import unittest
+import unittest.mock
+import urllib.request
+
+import flickr_archive_extractor as fae
+from benchmarks import synthetic
+
+try:
+    import googleapiclient
+except ImportError:
+    googleapiclient = None
+
+
+def upload_request(url, command, data=b'', **headers):
+    headers.update({'Authorization': 'Bearer test', 'Content-Length': str(len(data)), 'X-Goog-Upload-Command': command})
+    return fae.http_request(urllib.request.Request(method='POST', url=url, headers=headers, data=data))
+
+
+class TestMockGooglePhotos(unittest.TestCase):
+
+    def tearDown(self):
+        fae.http_pool.close()
+
+    def test_resumable_upload(self):
+        with fae.MockGooglePhotosServer(faults=fae.MockFaults(granularities=(4, ))) as server:
+            status, headers, _ = upload_request(server.url + '/v1/uploads', 'start', **{'X-Goog-Upload-Raw-Size': '10'})
+            self.assertEqual((status, headers['X-Goog-Upload-Chunk-Granularity']), (200, '4'))
+            upload_url = headers['X-Goog-Upload-URL']
+
+            status, _, _ = upload_request(upload_url, 'upload', b'abcde', **{'X-Goog-Upload-Offset': '0'})
+            self.assertEqual(status, 400)
+            status, _, _ = upload_request(upload_url, 'upload', b'abcd', **{'X-Goog-Upload-Offset': '0'})
+            self.assertEqual(status, 200)
+            status, headers, _ = upload_request(upload_url, 'query')
+            self.assertEqual(headers['X-Goog-Upload-Size-Received'], '4')
+            status, _, token = upload_request(upload_url, 'upload, finalize', b'efghij',
+                                              **{'X-Goog-Upload-Offset': '4'})
+            self.assertEqual(status, 200)
+            status, headers, body = upload_request(upload_url, 'query')
+            self.assertEqual((headers['X-Goog-Upload-Status'], body), ('final', token))
+            self.assertEqual(server.state.uploaded_bytes, 10)
+            self.assertEqual(server.state.rejected_chunks, 1)
+
+    def test_faults(self):
+        faults = fae.MockFaults(dropped=1.0, granularities=(4, ))
+        with fae.MockGooglePhotosServer(faults=faults) as server:
+            session = fae.MockUploadSession(0, 16, 4)
+            server.state.sessions.append(session)
+            status, _, _ = upload_request(server.url + '/v1/uploads/0', 'upload, finalize', b'a' * 16,
+                                          **{'X-Goog-Upload-Offset': '0'})
+            self.assertEqual(status, 599)
+            # half of dropped chunk is received
+            self.assertEqual(session.received, 8)
+
+            faults.dropped, faults.rate_limited, faults.retry_after = 0.0, 1.0, 7
+            status, headers, _ = upload_request(server.url + '/v1/uploads', 'start', **{'X-Goog-Upload-Raw-Size': '1'})
+            self.assertEqual((status, headers['Retry-After']), (429, '7'))
+            self.assertEqual(server.state.faults, {'dropped': 1, 'rate_limited': 1})
+
+    @unittest.skipIf(googleapiclient is None, 'google photo requirements are not installed')
+    def test_upload_with_faults(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        export = synthetic.generate_export(os.path.join(tmp_dir, 'export'), items=120, archives=2, albums=4,
+                                           max_size=600 * 1024)
+        db_path = os.path.join(tmp_dir, 'db', 'db')
+        faults = fae.MockFaults(latency=0.001, rate_limited=0.03, server_errors=0.05, dropped=0.05,
+                                granularities=(64 * 1024, 256 * 1024), retry_after=0, seed=1)
+        limiter = fae.GoogleAPIRateLimiter(requests_per_second=10000.0)
+        with fae.MockGooglePhotosServer(faults=faults) as server, \
+                unittest.mock.patch.object(limiter, 'backoff_delay', return_value=0.0):
+            # item may run out of retries with these fault rates, it's uploaded on the next run
+            for _ in range(2):
+                fae.upload_to_google_photos(export.paths, db_path, None, concurrency=4, limiter=limiter,
+                                            api_url=server.url)
+
+        db = sqlite3.connect(db_path)
+        statuses = dict(db.execute('select status, count(*) from gphotos_items group by status').fetchall())
+        db.close()
+        rows = sum(statuses.values())
+        self.assertEqual(statuses, {'uploaded': rows})
+        self.assertEqual(server.state.media_items, rows)
+        self.assertEqual(len(server.state.albums), export.albums)
+        self.assertGreater(sum(server.state.faults.values()), 0)
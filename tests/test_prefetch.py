@@ -0,0 +1,73 @@
+import io
+import threading
+import unittest
+
+import flickr_archive_extractor as fae
+
+
+def read_all(prefetcher):
+    chunks = []
+    while True:
+        buffer, read, trailing = prefetcher.next()
+        if read == 0:
+            return chunks
+        chunks.append((bytes(buffer[:read]), trailing))
+        prefetcher.release(buffer)
+
+
+class TestChunkPrefetcher(unittest.TestCase):
+
+    def test_read_ahead_is_equal_to_on_demand(self):
+        data = bytes(range(256)) * 5
+        pool = fae.ChunkBufferPool(budget=1024, prefetch=3)
+        for buffers in (None, pool):
+            with fae.ChunkPrefetcher(io.BytesIO(data), 256, len(data), offset=512, buffers=buffers) as prefetcher:
+                self.assertEqual(read_all(prefetcher), [(data[512:768], False), (data[768:1024], False),
+                                                        (data[1024:], False)])
+            with fae.ChunkPrefetcher(io.BytesIO(data), 512, 1024, buffers=buffers) as prefetcher:
+                self.assertEqual([trailing for _, trailing in read_all(prefetcher)], [False, True])
+        self.assertLessEqual(pool.peak, 1024)
+
+    def test_member_view_chunks(self):
+        data = bytes(range(256)) * 5
+        with fae.MemberViewChunks(memoryview(data), 256, len(data), offset=512) as chunks:
+            self.assertEqual(read_all(chunks), [(data[512:768], False), (data[768:1024], False), (data[1024:], False)])
+        with fae.MemberViewChunks(memoryview(data), 512, 1024) as chunks:
+            self.assertEqual([trailing for _, trailing in read_all(chunks)], [False, True])
+
+    def test_close_returns_buffers(self):
+        pool = fae.ChunkBufferPool(budget=300, prefetch=4)
+        prefetcher = fae.ChunkPrefetcher(io.BytesIO(b'x' * 1000), 100, 1000, buffers=pool)
+        buffer, read, _ = prefetcher.next()
+        self.assertEqual(read, 100)
+        prefetcher.release(buffer)
+        prefetcher.close()
+        self.assertEqual(pool.in_use, 0)
+
+    def test_budget_blocks_acquire(self):
+        pool = fae.ChunkBufferPool(budget=200)
+        first, second = pool.acquire(100), pool.acquire(100)
+        acquired = threading.Event()
+        third = []
+
+        def acquire():
+            third.append(pool.acquire(100))
+            acquired.set()
+
+        thread = threading.Thread(target=acquire)
+        thread.start()
+        self.assertFalse(acquired.wait(0.1))
+        pool.release(first)
+        self.assertTrue(acquired.wait(5))
+        thread.join()
+        pool.release(second)
+        pool.release(third[0])
+        # free buffers of other size are dropped to fit into budget
+        self.assertEqual(len(pool.acquire(200)), 200)
+        self.assertEqual(pool.peak, 200)
+
+    def test_read_error_is_raised(self):
+        pool = fae.ChunkBufferPool(prefetch=2)
+        with fae.ChunkPrefetcher(io.BytesIO(b'short'), 4, 100, offset=50, buffers=pool) as prefetcher:
+            with self.assertRaises(fae.RetryException):
+                prefetcher.next()
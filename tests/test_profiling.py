@@ -0,0 +1,56 @@
+import concurrent.futures
+import os.path
+import pstats
+import shutil
+import tempfile
+import unittest
+
+import flickr_archive_extractor as fae
+
+
+def square_in_worker(value):
+    return value * value
+
+
+def sum_in_thread(values):
+    return sum(values)
+
+
+def profiled_functions(path):
+    return set(name for _, _, name in pstats.Stats(path).stats)
+
+
+class TestProfiling(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.output = os.path.join(self.tmp_dir, 'profile.pstats')
+        self.profiling = fae.Profiling()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_worker_processes_are_profiled(self):
+        self.profiling.configure('cpu', 'build', self.output)
+        with self.profiling('build'), concurrent.futures.ProcessPoolExecutor(max_workers=2) as executor:
+            squares = list(self.profiling.map(executor, square_in_worker, range(4)))
+        self.assertEqual(squares, [0, 1, 4, 9])
+        self.profiling.finish()
+        self.assertIn('square_in_worker', profiled_functions(self.output))
+
+    def test_worker_threads_are_profiled(self):
+        self.profiling.configure('cpu', 'upload', self.output)
+        with self.profiling('upload'), concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+            futures = [executor.submit(self.profiling.thread_target(sum_in_thread), range(n)) for n in range(4)]
+            self.assertEqual([f.result() for f in futures], [0, 0, 1, 3])
+        self.profiling.finish()
+        self.assertIn('sum_in_thread', profiled_functions(self.output))
+
+    def test_workers_outside_of_scope_are_not_wrapped(self):
+        self.profiling.configure('cpu', 'upload', self.output)
+        with self.profiling('build'):
+            self.assertIs(self.profiling.thread_target(sum_in_thread), sum_in_thread)
+            with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+                self.assertEqual(list(self.profiling.map(executor, square_in_worker, range(3))), [0, 1, 4])
+        self.profiling.finish()
+        self.assertFalse(os.path.exists(self.output))
@@ -0,0 +1,94 @@
+import unittest
+import unittest.mock
+
+import flickr_archive_extractor as fae
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, delay):
+        self.sleeps.append(delay)
+        self.now += delay
+
+
+class TestRateLimiter(unittest.TestCase):
+
+    def test_token_bucket(self):
+        clock = FakeClock()
+        limiter = fae.GoogleAPIRateLimiter(requests_per_second=2.0, clock=clock, sleep=clock.sleep)
+        for _ in range(6):
+            limiter.acquire()
+        self.assertEqual(limiter.requests, 6)
+        self.assertAlmostEqual(clock.now, 1002.0)
+
+    def test_daily_quota(self):
+        clock = FakeClock()
+        limiter = fae.GoogleAPIRateLimiter(requests_per_second=100.0, daily_quota=3, clock=clock, sleep=clock.sleep)
+        for _ in range(4):
+            limiter.acquire()
+        self.assertGreaterEqual(clock.now, 1000.0 + 24 * 3600)
+
+        limiter = fae.GoogleAPIRateLimiter(daily_quota=1, wait_for_quota=False, clock=clock, sleep=clock.sleep)
+        limiter.acquire()
+        with self.assertRaises(fae.GoogleAPILimitReached):
+            limiter.acquire()
+
+    def test_pause_honours_retry_after(self):
+        clock = FakeClock()
+        limiter = fae.GoogleAPIRateLimiter(clock=clock, sleep=clock.sleep)
+        self.assertEqual(limiter.pause(1, retry_after=30.0), 30.0)
+        limiter.wait_if_paused()
+        limiter.acquire()
+        self.assertAlmostEqual(clock.now, 1030.0)
+        self.assertEqual(fae.parse_retry_after('12'), 12.0)
+        self.assertIsNone(fae.parse_retry_after('soon'))
+
+
+class FlakyAction:
+
+    def __init__(self, errors, result='done'):
+        self.errors = list(errors)
+        self.result = result
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return self.result
+
+
+class TestCallWithRetries(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.limiter = fae.GoogleAPIRateLimiter(clock=self.clock, sleep=self.clock.sleep)
+        patcher = unittest.mock.patch.object(self.limiter, 'backoff_delay', return_value=0.0)
+        self.backoff_delay = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_succeeds_after_failures(self):
+        action = FlakyAction([fae.RetryException('error', sleep_time=2.0)] * 4)
+        self.assertEqual(fae.call_with_retries(action, 'testing', self.limiter), 'done')
+        self.assertEqual(action.calls, 5)
+        self.assertEqual([c[0] for c in self.backoff_delay.call_args_list], [(1, 2.0), (2, 2.0), (3, 2.0), (4, 2.0)])
+
+    def test_permanent_failure(self):
+        action = FlakyAction([fae.RetryException('error')] * 10)
+        self.assertIsNone(fae.call_with_retries(action, 'testing', self.limiter, retries=3))
+        self.assertEqual(action.calls, 3)
+
+    def test_rate_limited_calls_are_not_retries(self):
+        errors = [fae.RateLimitedException('too many requests', retry_after=20.0)] * 3
+        action = FlakyAction(errors + [fae.RetryException('error')])
+        self.assertEqual(fae.call_with_retries(action, 'testing', self.limiter, retries=2), 'done')
+        self.assertEqual((action.calls, self.limiter.throttled), (5, 3))
+        self.limiter.wait_if_paused()
+        self.assertAlmostEqual(self.clock.now, 1020.0)
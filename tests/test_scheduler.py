@@ -0,0 +1,107 @@
+import itertools
+import operator
+import os.path
+import shutil
+import sqlite3
+import tempfile
+import unittest
+import unittest.mock
+
+import flickr_archive_extractor as fae
+from benchmarks import synthetic
+
+try:
+    import googleapiclient
+except ImportError:
+    googleapiclient = None
+
+
+def album_runs(units):
+    return [album_id for album_id, _ in itertools.groupby(units, key=operator.itemgetter(0))]
+
+
+class TestUploadScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        export = synthetic.generate_export(os.path.join(self.tmp_dir, 'export'), items=200, archives=2, albums=4,
+                                           max_size=100 * 1024)
+        self.paths = export.paths
+        self.archive = fae.FlickrArchive.build(export.paths)
+        self.db = sqlite3.connect(':memory:')
+        fae.migrate_db(self.db)
+        fae.init_albums_to_upload_to_google_photos(self.archive.albums, self.db)
+        fae.init_items_to_upload_to_google_photos(self.archive.matched, self.archive.item_to_albums_index, self.db)
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def units(self, order='album', **kwargs):
+        return fae.UploadScheduler(self.archive, self.db, order, **kwargs).units()
+
+    def test_album_order(self):
+        albums = [row[0] for row in self.db.execute('select album_id from gphotos_albums order by seq_id')]
+        expected = [(album_id, item_id) for album_id in albums for item_id in self.archive.albums[album_id].items_ids]
+        expected += [(fae.NO_ALBUM, item_id) for item_id in self.archive.items_without_albums]
+        self.assertEqual(self.units(), expected)
+
+        first = expected[0]
+        self.db.execute("update gphotos_items set status = 'uploaded' where album_id = ? and item_id = ?", first)
+        self.assertEqual(self.units(), expected[1:])
+
+    def test_policies(self):
+        scheduler = fae.UploadScheduler(self.archive, self.db, 'smallest')
+        sizes = [scheduler.size(unit) for unit in scheduler.units()]
+        self.assertEqual(sizes, sorted(sizes))
+
+        album = self.archive.albums[sorted(self.archive.albums)[-1]]
+        item_id = self.archive.items_without_albums[-1]
+        units = self.units('priority', priority=[('item', item_id), ('album', album.title)])
+        self.assertEqual(units[0], (fae.NO_ALBUM, item_id))
+        self.assertEqual(units[1:len(album.items_ids) + 1], [(album.id, i) for i in album.items_ids])
+
+        # date taken is indexed, metadata files aren't read
+        with unittest.mock.patch.object(self.archive.zip_files, 'open_file', side_effect=AssertionError):
+            units = self.units('date', date_range=('2015-03-01', '2015-04-30'))
+        taken = [self.archive.matched[i].metadata.date_taken for _, i in units]
+        self.assertEqual(taken, [self.archive.matched[i].metadata.load_data(self.archive.zip_files)['date_taken']
+                                 for _, i in units])
+        in_range = sum(1 for date in taken if '2015-03-01' <= date[:10] <= '2015-04-30')
+        self.assertGreater(in_range, 0)
+        self.assertEqual(taken[:in_range], sorted(date for date in taken if '2015-03-01' <= date[:10] <= '2015-04-30'))
+
+    def test_interleave_sizes(self):
+        self.assertEqual(fae.interleave_sizes([1, 5, 2, 4, 3, 9, 8], lambda x: x, 5), [5, 1, 4, 2, 3, 9, 8])
+        self.assertEqual(fae.interleave_sizes([1, 5, 2, 14, 13, 19, 18], lambda x: x, 5, group=lambda x: x // 10),
+                         [5, 1, 2, 19, 13, 18, 14])
+
+        # window passed by upload with default concurrency of upload-to-google-photo command
+        window = fae.UPLOAD_INTERLEAVE_WINDOW * 4
+        for order, kwargs in (('album', {}), ('date', {'date_range': ('2015-03-01', '2015-04-30')})):
+            plain = self.units(order, **kwargs)
+            units = self.units(order, interleave_window=window, **kwargs)
+            self.assertNotEqual(units, plain)
+            self.assertEqual(sorted(units), sorted(plain))
+            # albums are started in the same order & their items aren't mixed
+            self.assertEqual(album_runs(units), album_runs(plain))
+        albums = [row[0] for row in self.db.execute('select album_id from gphotos_albums order by seq_id')]
+        self.assertEqual(album_runs(self.units(interleave_window=window)), albums + [fae.NO_ALBUM])
+
+    @unittest.skipIf(googleapiclient is None, 'google photo requirements are not installed')
+    def test_upload_stops_before_quota_is_spent(self):
+        db_path = os.path.join(self.tmp_dir, 'db', 'db')
+        with fae.MockGooglePhotosServer() as server:
+            limiter = fae.GoogleAPIRateLimiter(requests_per_second=10000.0, daily_quota=60, wait_for_quota=False)
+            fae.upload_to_google_photos(self.paths, db_path, None, concurrency=4, limiter=limiter,
+                                        api_url=server.url, order='smallest')
+        fae.http_pool.close()
+
+        db = sqlite3.connect(db_path)
+        uploaded = db.execute("select count(*) from gphotos_items where status = 'uploaded'").fetchone()[0]
+        db.close()
+        self.assertLessEqual(limiter.requests, 60)
+        self.assertGreater(uploaded, 0)
+        # every uploaded content has its media item, no upload token is wasted
+        self.assertEqual(server.state.media_items, uploaded)
+        self.assertEqual(len(server.state.sessions), uploaded)
@@ -5,7 +5,7 @@ import pycodestyle
 
 
 class TestStyle(unittest.TestCase):
-    CHECKED_PATHS = ('tests', 'flickr_archive_extractor.py', 'setup.py')
+    CHECKED_PATHS = ('tests', 'benchmarks', 'flickr_archive_extractor.py', 'setup.py')
     ROOT = os.path.join(os.path.dirname(os.path.dirname(__file__)))
 
     def test_pycodestyle(self):
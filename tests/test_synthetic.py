@@ -0,0 +1,27 @@
+import os.path
+import shutil
+import tempfile
+import unittest
+
+import flickr_archive_extractor as fae
+from benchmarks import synthetic
+
+
+class TestSyntheticExport(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.export = synthetic.generate_export(os.path.join(self.tmp_dir, 'export'), items=300, archives=3,
+                                                albums=5, max_size=300 * 1024)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_index_matches_generated_export(self):
+        archive = fae.FlickrArchive.build(self.export.paths)
+        self.assertEqual(len(archive.items), self.export.items + self.export.alternative_ids)
+        self.assertEqual(len(archive.items_metadata), self.export.metadata)
+        self.assertEqual(len(archive.matched), self.export.matched)
+        self.assertEqual(len(archive.without_items), self.export.without_items)
+        self.assertEqual(len(archive.unprocessed_videos_metadata), self.export.unprocessed_videos)
+        self.assertEqual(len(archive.albums), self.export.albums)
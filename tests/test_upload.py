@@ -0,0 +1,284 @@
+import collections
+import http
+import os.path
+import shutil
+import sqlite3
+import tempfile
+import unittest
+import unittest.mock
+
+import flickr_archive_extractor as fae
+from benchmarks import synthetic
+
+try:
+    import googleapiclient
+except ImportError:
+    googleapiclient = None
+
+
+FakeCredentials = collections.namedtuple('FakeCredentials', ['token'])
+
+
+@unittest.skipIf(googleapiclient is None, 'google photo requirements are not installed')
+class TestGooglePhotosUploader(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        export = synthetic.generate_export(os.path.join(self.tmp_dir, 'export'), items=130, archives=2, albums=2,
+                                           max_size=64 * 1024)
+        self.archive = fae.FlickrArchive.build(export.paths)
+        self.db = sqlite3.connect(':memory:')
+        fae.migrate_db(self.db)
+        fae.init_albums_to_upload_to_google_photos(self.archive.albums, self.db)
+        fae.init_items_to_upload_to_google_photos(self.archive.matched, self.archive.item_to_albums_index, self.db)
+        self.server = fae.MockGooglePhotosServer().__enter__()
+        self.gcreds, self.gclient = fae.init_google_photos_api(None, self.db, self.server.url)
+        self.limiter = fae.GoogleAPIRateLimiter(requests_per_second=10000.0)
+
+    def tearDown(self):
+        self.server.__exit__(None, None, None)
+        fae.http_pool.close()
+        self.db.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def upload(self, album_id, items_ids, album_google_id=None):
+        uploader = fae.GooglePhotosUploader(self.archive, self.gclient, self.gcreds, self.db, self.limiter,
+                                            concurrency=4, api_url=self.server.url)
+        create = unittest.mock.Mock(wraps=fae.create_google_photos_media_items)
+        with unittest.mock.patch.object(fae, 'create_google_photos_media_items', create):
+            uploader.start_album(album_id, album_google_id, album_id or 'no album', len(items_ids))
+            for item_id in items_ids:
+                uploader.submit(album_id, self.archive.matched[item_id])
+            uploader.flush()
+        uploader.close()
+        return uploader, [c[0] for c in create.call_args_list]
+
+    def statuses(self, album_id):
+        return dict(self.db.execute('select item_id, status from gphotos_items where album_id = ?', (album_id, )))
+
+    def test_items_are_created_in_batches(self):
+        items_ids = sorted(self.archive.matched)
+        self.db.executemany('insert or ignore into gphotos_items (item_id, album_id) values (?, ?)',
+                            [(i, fae.NO_ALBUM) for i in items_ids])
+        uploader, calls = self.upload(fae.NO_ALBUM, items_ids)
+
+        self.assertEqual([len(args[2]) for args in calls], [50, 50, len(items_ids) - 100])
+        self.assertEqual(sorted(i.item.id for args in calls for i, _ in args[2]), items_ids)
+        self.assertEqual(self.statuses(fae.NO_ALBUM), {i: 'uploaded' for i in items_ids})
+        self.assertEqual((uploader.skipped_items, self.server.state.media_items), (0, len(items_ids)))
+
+    def test_items_are_created_in_album(self):
+        album = self.archive.albums[sorted(self.archive.albums)[0]]
+        album_google_id = self.gclient.albums().create(body={'album': {'title': album.title}}).execute()['id']
+        _, calls = self.upload(album.id, album.items_ids, album_google_id)
+
+        self.assertEqual(set((args[0], args[1]) for args in calls), {(album.id, album_google_id)})
+        self.assertEqual(self.statuses(album.id), {i: 'uploaded' for i in album.items_ids})
+        google_ids = self.db.execute('select google_id from gphotos_items where album_id = ?', (album.id, ))
+        self.assertTrue(all(row[0].startswith('media-item-') for row in google_ids))
+        # items of other albums aren't touched
+        self.assertEqual(self.db.execute("select count(*) from gphotos_items where album_id != ? "
+                                         "and status != 'none'", (album.id, )).fetchone(), (0, ))
+
+    def test_partially_failed_batch(self):
+        items_ids = self.archive.items_without_albums[:10]
+        failed = set(items_ids[::3])
+        upload = fae.upload_item_to_google_photos
+
+        def upload_or_invalid_token(archive, item, *args):
+            token = upload(archive, item, *args)
+            return 'invalid-token-{}'.format(item.id) if item.id in failed else token
+
+        self.db.executemany("insert into gphotos_upload_sessions values (?, ?, 'url', 1, 1, 1)",
+                            [(i, fae.NO_ALBUM) for i in items_ids])
+        with unittest.mock.patch.object(fae, 'upload_item_to_google_photos', upload_or_invalid_token):
+            uploader, calls = self.upload(fae.NO_ALBUM, items_ids)
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(uploader.skipped_items, len(failed))
+        statuses = self.statuses(fae.NO_ALBUM)
+        self.assertEqual({i: statuses[i] for i in items_ids},
+                         {i: 'none' if i in failed else 'uploaded' for i in items_ids})
+        self.assertEqual(self.server.state.media_items, len(items_ids) - len(failed))
+        # finalized sessions of failed items aren't resumed with the same token on the next run
+        self.assertEqual(self.db.execute('select count(*) from gphotos_upload_sessions').fetchone(), (0, ))
+
+    def upload_duplicates(self, units, album_google_id):
+        """Uploads (album id, item id) units, items are duplicates of each other. Returns uploader"""
+        album = self.archive.albums[sorted(self.archive.albums)[0]]
+        self.db.executemany('insert or ignore into gphotos_items (album_id, item_id) values (?, ?)', units)
+        group = sorted(set(item_id for _, item_id in units))
+        uploader = fae.GooglePhotosUploader(self.archive, self.gclient, self.gcreds, self.db, self.limiter,
+                                            concurrency=4, duplicates=fae.ContentDuplicates([group]),
+                                            api_url=self.server.url)
+        totals = collections.Counter(album_id for album_id, _ in units)
+        uploader.start_album(fae.NO_ALBUM, None, 'no album', totals[fae.NO_ALBUM])
+        uploader.start_album(album.id, album_google_id, album.title, totals[album.id])
+        for album_id, item_id in units:
+            uploader.submit(album_id, self.archive.matched[item_id])
+        uploader.flush()
+        uploader.close()
+        return uploader
+
+    def google_ids(self, units):
+        return [self.db.execute('select google_id from gphotos_items where album_id = ? and item_id = ?',
+                                unit).fetchone()[0] for unit in units]
+
+    def create_album(self):
+        album = self.archive.albums[sorted(self.archive.albums)[0]]
+        return album.id, self.gclient.albums().create(body={'album': {'title': album.title}}).execute()['id']
+
+    def test_duplicates_are_attached(self):
+        album_id, album_google_id = self.create_album()
+        first, second, third = self.archive.items_without_albums[:3]
+        # the 2nd & 3rd items wait for the 1st one which is being uploaded
+        units = [(fae.NO_ALBUM, first), (album_id, second), (fae.NO_ALBUM, third)]
+        uploader = self.upload_duplicates(units, album_google_id)
+
+        google_ids = self.google_ids(units)
+        self.assertEqual(len(set(google_ids)), 1)
+        self.assertIsNotNone(google_ids[0])
+        self.assertEqual((uploader.attached_items, uploader.skipped_items), (2, 0))
+        state = self.server.state
+        self.assertEqual((len(state.sessions), state.media_items, state.album_additions), (1, 1, 1))
+
+        # already uploaded content is found in DB on the next run
+        units = [(album_id, third), (fae.NO_ALBUM, second)]
+        uploader = self.upload_duplicates(units, album_google_id)
+        self.assertEqual(self.google_ids(units), google_ids[:2])
+        self.assertEqual((uploader.attached_items, uploader.skipped_items), (2, 0))
+        # the content is already in the album, it isn't added again
+        self.assertEqual((len(state.sessions), state.media_items, state.album_additions), (1, 1, 1))
+
+    def test_waiting_duplicates_are_skipped_if_upload_failed(self):
+        album_id, album_google_id = self.create_album()
+        first, second, third = self.archive.items_without_albums[:3]
+        units = [(fae.NO_ALBUM, first), (album_id, second), (fae.NO_ALBUM, third)]
+        with unittest.mock.patch.object(fae, 'upload_item_to_google_photos', return_value=None):
+            uploader = self.upload_duplicates(units, album_google_id)
+
+        self.assertEqual((uploader.attached_items, uploader.skipped_items), (0, 3))
+        self.assertEqual(self.google_ids(units), [None] * 3)
+        self.assertEqual(self.server.state.album_additions, 0)
+
+
+class TestUploadItemContent(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        export = synthetic.generate_export(os.path.join(self.tmp_dir, 'export'), items=20, archives=1, albums=1,
+                                           min_size=40 * 1024, max_size=64 * 1024)
+        self.archive = fae.FlickrArchive.build(export.paths)
+        zip_files = self.archive.zip_files
+        self.item = max((i.item for i in self.archive.matched.values()), key=lambda i: zip_files.file_size(i.file))
+        self.size = zip_files.file_size(self.item.file)
+        self.server = fae.MockGooglePhotosServer(faults=fae.MockFaults(granularities=(4096, ))).__enter__()
+        self.limiter = fae.GoogleAPIRateLimiter(requests_per_second=10000.0)
+
+    def tearDown(self):
+        self.server.__exit__(None, None, None)
+        fae.http_pool.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def upload(self, sessions=None, buffers=None):
+        return fae._upload_item_content(self.archive, self.item, FakeCredentials('test'), self.limiter, sessions,
+                                        fae.NO_ALBUM, None, False, self.server.url, buffers)
+
+    def test_item_is_streamed_by_chunks(self):
+        stored = self.upload()
+        with unittest.mock.patch.object(self.archive.zip_files, 'member_view', return_value=None):
+            streamed = self.upload(buffers=fae.ChunkBufferPool(budget=3 * 4096, prefetch=2))
+
+        state = self.server.state
+        self.assertEqual([stored, streamed], [s.upload_token for s in state.sessions])
+        self.assertEqual([s.received for s in state.sessions], [self.size] * 2)
+        chunks = -(-self.size // 4096)
+        self.assertGreater(chunks, 1)
+        # start & chunks requests for every upload
+        self.assertEqual(state.requests, 2 * (1 + chunks))
+        self.assertEqual(state.rejected_chunks, 0)
+
+    def test_wrong_size_is_detected(self):
+        for wrong_size in (self.size - 1, self.size + 1, self.size + 4096):
+            for member_view in (self.archive.zip_files.member_view, lambda file: None):
+                with unittest.mock.patch.object(self.archive.zip_files, 'file_size', return_value=wrong_size), \
+                        unittest.mock.patch.object(self.archive.zip_files, 'member_view', member_view):
+                    with self.assertRaises(fae.RetryException) as raised:
+                        self.upload()
+                self.assertTrue(raised.exception.force_size_recalculate)
+        self.assertTrue(all(s.upload_token is None for s in self.server.state.sessions))
+
+    def test_interrupted_upload_is_resumed(self):
+        db_path = os.path.join(self.tmp_dir, 'db')
+        fae.init_db(db_path).close()
+        http_request = fae.http_request
+        requests = []
+        interrupt_after = 4
+
+        class Interrupted(Exception):
+            pass
+
+        def interrupted_after_third_chunk(req, *args, **kwargs):
+            reply = http_request(req, *args, **kwargs)
+            requests.append(req.get_header('X-goog-upload-offset'))
+            if len(requests) == interrupt_after:
+                raise Interrupted()
+            return reply
+
+        sessions = fae.UploadSessions(db_path)
+        with unittest.mock.patch.object(fae, 'http_request', interrupted_after_third_chunk), \
+                unittest.mock.patch.object(fae, 'UPLOAD_SESSION_SAVE_INTERVAL', 0.0):
+            with self.assertRaises(Interrupted):
+                fae.upload_item_to_google_photos(self.archive, self.item, FakeCredentials('test'), self.limiter,
+                                                 sessions, fae.NO_ALBUM, self.server.url)
+        sessions.close()
+
+        sessions = fae.UploadSessions(db_path)
+        saved = sessions.get(self.item.id, fae.NO_ALBUM)
+        # the last chunk is received by server but not saved
+        self.assertEqual(saved.confirmed_offset, 2 * 4096)
+        self.assertEqual(self.server.state.sessions[0].received, 3 * 4096)
+        del requests[:]
+        interrupt_after = None
+        with unittest.mock.patch.object(fae, 'http_request', interrupted_after_third_chunk):
+            token = fae.upload_item_to_google_photos(self.archive, self.item, FakeCredentials('test'), self.limiter,
+                                                     sessions, fae.NO_ALBUM, self.server.url)
+        sessions.close()
+
+        state = self.server.state
+        self.assertEqual((len(state.sessions), state.sessions[0].upload_token), (1, token))
+        self.assertEqual(requests[:2], [None, str(3 * 4096)])
+        self.assertEqual((state.uploaded_bytes, state.rejected_chunks), (self.size, 0))
+
+    def test_session_is_kept_when_query_fails(self):
+        db_path = os.path.join(self.tmp_dir, 'db')
+        fae.init_db(db_path).close()
+        http_request = fae.http_request
+        failed = []
+
+        def unavailable_for_third_chunk_and_query(req, *args, **kwargs):
+            command = req.get_header('X-goog-upload-command')
+            offset = req.get_header('X-goog-upload-offset')
+            if (command == 'upload' and offset == str(2 * 4096) or command == 'query') and command not in failed:
+                failed.append(command)
+                return http.HTTPStatus.SERVICE_UNAVAILABLE, {}, b''
+            return http_request(req, *args, **kwargs)
+
+        sessions = fae.UploadSessions(db_path)
+        with unittest.mock.patch.object(fae, 'http_request', unavailable_for_third_chunk_and_query), \
+                unittest.mock.patch.object(self.limiter, 'backoff_delay', return_value=0.0):
+            token = fae.upload_item_to_google_photos(self.archive, self.item, FakeCredentials('test'), self.limiter,
+                                                     sessions, fae.NO_ALBUM, self.server.url)
+        sessions.close()
+
+        state = self.server.state
+        self.assertEqual(failed, ['upload', 'query'])
+        self.assertEqual((len(state.sessions), state.sessions[0].upload_token), (1, token))
+        self.assertEqual((state.uploaded_bytes, state.rejected_chunks), (self.size, 0))
+
+    def test_gone_session_is_restarted(self):
+        session = fae.UploadSession(self.server.url + '/v1/uploads/404', self.size, 4096, 4096)
+        self.assertEqual(fae.query_upload_session(session, FakeCredentials('test'), self.limiter), (None, None))
+        token = fae._upload_item_content(self.archive, self.item, FakeCredentials('test'), self.limiter, None,
+                                         fae.NO_ALBUM, session, False, self.server.url, None)
+        self.assertEqual([s.upload_token for s in self.server.state.sessions], [token])